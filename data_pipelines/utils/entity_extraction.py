@@ -0,0 +1,335 @@
+"""Extract structured metadata from processed documents with one LLM call per document.
+
+Compared to one call per (document, entity) pair, all the entity schemas of a document
+are merged into a single JSON schema and extracted together. Pages are looked up in an
+index keyed by (company, year, page) instead of scanning the pages per chunk, and
+documents run concurrently as they are streamed in. Each finished document is appended
+to a JSON Lines file, so an interrupted run resumes with the documents still missing.
+"""
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+logger = logging.getLogger(__name__)
+
+ENTITY_EXTRACTION_PROMPT_TEMPLATE = """\n\nHuman: Extract the information described by the json schema inside the <schema></schema> XML tags from the documents inside <documents></documents> XML tags.
+Follow the rules inside the <rules></rules> XML tags during extraction:
+<rules>
+1. You must output a valid JSON.
+2. You must extract the value for each from the text inside <documents></documents>, and the value must match the description and type in JSON schema.
+3. Expand numbers into full digits format: example 1: 212,765,000,000 becomes 212765000000, example 2: $469.822 million becomes 469822000, example 3: 132,452 people becomes 132452.
+4. Don't use comma as thousands separator in the numbers you extract. For example 212,765 must be written as 212765.
+5. Consider the context inside <context></context> XML tags.
+6. If the document does not contain the value, put null.
+</rules>
+
+The JSON schema inside the <schema></schema> XML tags contains the information to extract:
+<schema>
+{serialized_json_schema}
+</schema>
+
+Extract information from the documents inside <documents></documents> XML tags below:
+<documents>
+{document_excerpts}
+</documents>
+
+Use the metadata inside the <context></context> XML tags when relevant to assist you during extraction:
+<context>
+The company is {company}.
+The year of the financial report is {year}.
+</context>
+
+Follow the extraction examples inside the <examples></examples> XML tags below:
+<examples>
+{few_shot_examples}
+</examples>
+
+Only write the JSON output inside <json></json> XML tags without further explanation.
+
+\n\nAssistant: <json>\n"""
+
+
+FEW_SHOT_EXAMPLE_TEMPLATE = """
+Example {index}: Given the information inside <schema> and <documents>, the correct output is inside <json> below:
+
+<schema>
+{serialized_json_schema}
+</schema>
+
+<documents>
+{document_excerpts}
+</documents>
+
+Correct output:
+<json>
+{json_output}
+</json>
+"""
+
+
+class NoExcerptsError(ValueError):
+    """No chunk was retrieved for a document, it is retried by the next run."""
+
+
+def page_key(company, year, page):
+    return (str(company), str(year), int(page))
+
+
+def build_page_index(documents_processed):
+    """Index the pages of all documents by (company, year, page)."""
+    page_index = {}
+    for document in documents_processed:
+        company = document["metadata"]["company"]
+        year = document["metadata"]["year"]
+        for page in document["pages"]:
+            page_index[page_key(company, year, page["page"])] = page
+    return page_index
+
+
+def add_tables(chunk, page_index):
+    """Return the chunk text followed by all the tables of the page it came from."""
+    page = page_index.get(
+        page_key(
+            chunk.metadata["company"],
+            chunk.metadata["year"],
+            chunk.metadata["page_number"],
+        )
+    )
+    if page is None:
+        return chunk.page_content
+    # The tables (in markdown) that are present on the page that the chunk came from
+    tables = "\n".join(page.get("page_tables", []))
+    return chunk.page_content + "\n" + tables.strip()
+
+
+def merge_entity_schemas(entity_schema):
+    """Merge the JSON schemas of all entity models into one object schema."""
+    merged_schema = {
+        "title": "DocumentEntities",
+        "type": "object",
+        "properties": {},
+    }
+    for entity_model in entity_schema.values():
+        model_schema = entity_model.schema()
+        merged_schema["properties"].update(model_schema.get("properties", {}))
+        # pydantic v1 puts nested models under "definitions", v2 under "$defs".
+        for definitions_key in ("definitions", "$defs"):
+            if definitions_key in model_schema:
+                merged_schema.setdefault(definitions_key, {}).update(
+                    model_schema[definitions_key]
+                )
+    return merged_schema
+
+
+def format_few_shot_examples(example_pairs, entity_schema):
+    """Format the examples against the merged schema the prompt asks for.
+
+    The n-th examples of all the entities are combined into one example, their
+    excerpts concatenated and their JSON outputs merged, like a document whose
+    entities are all extracted by the same call.
+
+    Args:
+        example_pairs (dict): Maps an entity name to a list of examples, each a dict
+            with `document_excerpts` and `json_output`, the JSON fields of the entity.
+        entity_schema (dict): Maps an entity name to its pydantic model.
+
+    Returns:
+        str: The formatted examples.
+    """
+    serialized_json_schema = json.dumps(merge_entity_schemas(entity_schema), indent=1)
+    num_examples = max((len(example_pairs.get(entity, [])) for entity in entity_schema), default=0)
+    examples = []
+    for index in range(num_examples):
+        document_excerpts, json_output = [], {}
+        for entity in entity_schema:
+            entity_examples = example_pairs.get(entity, [])
+            if index >= len(entity_examples):
+                continue
+            example = entity_examples[index]
+            document_excerpts.append(example["document_excerpts"])
+            output = example["json_output"]
+            json_output.update(json.loads(output) if isinstance(output, str) else output)
+        examples.append(
+            FEW_SHOT_EXAMPLE_TEMPLATE.format(
+                index=index + 1,
+                serialized_json_schema=serialized_json_schema,
+                document_excerpts="\n".join(document_excerpts),
+                json_output=json.dumps(json_output, indent=1),
+            )
+        )
+    return "\n".join(examples)
+
+
+def format_document_excerpts(chunks, page_index):
+    """Format the retrieved chunks, skipping chunks retrieved for several entities."""
+    document_excerpts = []
+    seen = set()
+    for chunk in chunks:
+        chunk_id = (chunk.metadata.get("page_number"), chunk.page_content)
+        if chunk_id in seen:
+            continue
+        seen.add(chunk_id)
+        document_excerpts.append(
+            "\n".join([
+                f"- Below Excerpt of page {chunk.metadata['original_page_number']}",
+                "\n",
+                add_tables(chunk, page_index),
+            ])
+        )
+    return "\n".join(document_excerpts)
+
+
+def parse_json_output(result):
+    """Parse the JSON object the model wrote after the prefilled <json> tag."""
+    text = result.split("</json>")[0]
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end == -1:
+        raise ValueError(f"No JSON object found in the model output: {result}")
+    return json.loads(text[start:end + 1])
+
+
+def validate_entities(extracted, entity_schema):
+    """Validate the fields of each entity model, keeping the fields that parse."""
+    entities = {}
+    for entity, entity_model in entity_schema.items():
+        fields = {
+            name: extracted.get(name) for name in entity_model.__fields__ if name in extracted
+        }
+        try:
+            entities.update(entity_model(**fields).dict())
+        except Exception as e:
+            logger.warning("Failed to validate %s with error %s", entity, e)
+    return entities
+
+
+class EntityExtractionEngine:
+    """Extract all the entities of a document in a single structured LLM call.
+
+    Args:
+        llm: A LangChain LLM or chat model, called with `invoke(prompt)`.
+        entity_schema (dict): Maps an entity name to its pydantic model.
+        example_pairs (dict): Maps an entity name to its examples, see
+            `format_few_shot_examples`.
+        retrieve_chunks (callable): `retrieve_chunks(document, entity)` returns the
+            chunks relevant to `entity` in `document`.
+        max_workers (int): Number of documents processed concurrently.
+    """
+
+    def __init__(
+        self,
+        llm,
+        entity_schema,
+        example_pairs,
+        retrieve_chunks,
+        max_workers=4,
+    ):
+        self.llm = llm
+        self.entity_schema = entity_schema
+        self.retrieve_chunks = retrieve_chunks
+        self.max_workers = max_workers
+        self.serialized_json_schema = json.dumps(merge_entity_schemas(entity_schema), indent=1)
+        self.few_shot_examples = format_few_shot_examples(example_pairs, entity_schema)
+
+    def build_prompt(self, document, chunks):
+        return ENTITY_EXTRACTION_PROMPT_TEMPLATE.format(
+            serialized_json_schema=self.serialized_json_schema,
+            # The chunks come from this document, its pages are enough to find their tables.
+            document_excerpts=format_document_excerpts(chunks, build_page_index([document])),
+            company=document["metadata"]["company"],
+            year=document["metadata"]["year"],
+            few_shot_examples=self.few_shot_examples,
+        )
+
+    def extract_document(self, document):
+        """Extract every entity of one document, returning one row of the entities table.
+
+        Raises:
+            NoExcerptsError: If no chunk was retrieved for the document.
+        """
+        chunks = []
+        for entity in self.entity_schema:
+            chunks.extend(self.retrieve_chunks(document, entity))
+
+        row = {
+            "company": document["metadata"]["company"],
+            "year": document["metadata"]["year"],
+            "source_doc": document["source_location"],
+        }
+        if not chunks:
+            # Not checkpointed, e.g. the document may not be indexed yet.
+            raise NoExcerptsError(f"No chunks were retrieved for {row['source_doc']}")
+
+        result = self.llm.invoke(self.build_prompt(document, chunks))
+        # Chat models return a message, completion models a string.
+        result = getattr(result, "content", result)
+        row.update(validate_entities(parse_json_output(result), self.entity_schema))
+        return row
+
+    def run(self, documents, output_path):
+        """Extract all documents, resuming from the rows already in `output_path`.
+
+        The documents are consumed as they are extracted, at most `2 * max_workers`
+        of them are held at once, so they can be streamed from the processed
+        documents file.
+
+        Args:
+            documents (iterable): The documents to extract entities from, can be a generator.
+            output_path (str): JSON Lines file receiving one row per finished document.
+
+        Returns:
+            list: One row per document, in the order of `documents`.
+        """
+        rows_by_source = {}
+        if os.path.exists(output_path):
+            with open(output_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        rows_by_source[row["source_doc"]] = row
+
+        order = []
+        failed = {}
+        already_extracted = 0
+
+        def collect(done_futures):
+            for future in done_futures:
+                source_doc = running.pop(future)
+                try:
+                    row = future.result()
+                except Exception as e:
+                    logger.error("Failed to extract entities from %s: %s", source_doc, e)
+                    failed[source_doc] = e
+                    continue
+                rows_by_source[source_doc] = row
+                output_file.write(json.dumps(row) + "\n")
+                output_file.flush()
+
+        with open(output_path, "a") as output_file, ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            running = {}
+            for document in documents:
+                source_doc = document["source_location"]
+                order.append(source_doc)
+                if source_doc in rows_by_source:
+                    already_extracted += 1
+                    continue
+                if len(running) >= 2 * self.max_workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    collect(done)
+                running[executor.submit(self.extract_document, document)] = source_doc
+            collect(list(as_completed(running)))
+
+        logger.info(
+            "%s documents already extracted, %s extracted, %s failed",
+            already_extracted,
+            len(order) - already_extracted - len(failed),
+            len(failed),
+        )
+        if failed:
+            logger.error(
+                "Entity extraction failed for %s, run again to retry them.", sorted(failed)
+            )
+        return [rows_by_source[source_doc] for source_doc in order if source_doc in rows_by_source]
@@ -0,0 +1,148 @@
+"""Local stand-ins of the AWS clients used by the processing stages, to run them offline.
+
+The fakes implement only the calls the stages make, with configurable latency and
+throttling, so the concurrency, retry and caching paths run without AWS. See
+`local_benchmarks.py` for the runs measuring the stages against them.
+"""
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+
+def _client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakeBedrockRuntime:
+    """Stand-in for the bedrock-runtime client of `markdown_improvement`.
+
+    Each call sleeps for `latency` seconds and is throttled with probability
+    `throttle_rate`. The response echoes the page markdown inside <results> tags.
+    """
+
+    def __init__(self, latency=0.2, throttle_rate=0.0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self.throttled_calls = 0
+        self._lock = threading.Lock()
+
+    def invoke_model(self, body, modelId):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttled_calls += 1
+            raise _client_error("ThrottlingException", "Rate exceeded", "InvokeModel")
+        user_input = json.loads(body)["messages"][0]["content"]
+        text = f"<results>{user_input.split(chr(10))[-1]}</results>"
+        response_body = json.dumps({"content": [{"type": "text", "text": text}]})
+        return {"body": io.BytesIO(response_body.encode("utf-8"))}
+
+
+class FakeTextractClient:
+    """Stand-in for the Textract client of `TextractAnalysisStage`.
+
+    Jobs finish `job_duration` seconds after they start and return one LINE block
+    per page, paginated by `blocks_per_page`. Starting more than `max_running_jobs`
+    jobs raises LimitExceededException, and polls are throttled with probability
+    `throttle_rate`.
+    """
+
+    def __init__(
+        self,
+        job_duration=0.1,
+        pages_per_document=2,
+        blocks_per_page=1,
+        max_running_jobs=None,
+        throttle_rate=0.0,
+    ):
+        self.job_duration = job_duration
+        self.pages_per_document = pages_per_document
+        self.blocks_per_page = blocks_per_page
+        self.max_running_jobs = max_running_jobs
+        self.throttle_rate = throttle_rate
+        self.jobs = {}
+        self.started_jobs = 0
+        self.peak_running_jobs = 0
+        self.throttled_calls = 0
+        self._lock = threading.Lock()
+
+    def _running_jobs(self):
+        now = time.monotonic()
+        return sum(1 for _, started_at in self.jobs.values() if now - started_at < self.job_duration)
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes):
+        with self._lock:
+            running_jobs = self._running_jobs()
+            if self.max_running_jobs is not None and running_jobs >= self.max_running_jobs:
+                self.throttled_calls += 1
+                raise _client_error(
+                    "LimitExceededException", "Open jobs exceed maximum concurrent job limit", "StartDocumentAnalysis"
+                )
+            job_id = str(uuid.uuid4())
+            self.jobs[job_id] = (DocumentLocation["S3Object"]["Name"], time.monotonic())
+            self.started_jobs += 1
+            self.peak_running_jobs = max(self.peak_running_jobs, running_jobs + 1)
+        return {"JobId": job_id}
+
+    def get_document_analysis(self, JobId, NextToken=None, MaxResults=1000):
+        if random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttled_calls += 1
+            raise _client_error("ProvisionedThroughputExceededException", "Rate exceeded", "GetDocumentAnalysis")
+        name, started_at = self.jobs[JobId]
+        if time.monotonic() - started_at < self.job_duration:
+            return {"JobStatus": "IN_PROGRESS"}
+        blocks = [
+            {
+                "BlockType": "LINE",
+                "Id": f"{JobId}-{page}",
+                "Page": page,
+                "Text": f"{name} page {page}",
+            }
+            for page in range(1, self.pages_per_document + 1)
+        ]
+        start = int(NextToken or 0)
+        end = start + self.blocks_per_page
+        response = {
+            "JobStatus": "SUCCEEDED",
+            "DocumentMetadata": {"Pages": self.pages_per_document},
+            "Blocks": blocks[start:end],
+        }
+        if end < len(blocks):
+            response["NextToken"] = str(end)
+        return response
+
+
+class FakeS3Client:
+    """In-memory stand-in for the S3 calls of `textract_cache`."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def _not_found(self, operation):
+        return _client_error("404", "Not Found", operation)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._not_found("HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.encode("utf-8") if isinstance(Body, str) else Body
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._not_found("GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
@@ -1,9 +1,16 @@
+import gzip
+import io
 import json
+import os
+
 import boto3
 
 # Initialize the S3 client
 s3_client = boto3.client("s3")
 
+# S3 multipart uploads need parts of at least 5 MiB, except for the last one.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
 
 def store_list_to_s3(bucket_name, object_key, data):
     # Serialize the list using json
@@ -18,4 +25,171 @@ def load_list_from_s3(bucket_name, object_key):
     json_data = response["Body"].read()
 
     data = json.loads(json_data)
-    return data
\ No newline at end of file
+    return data
+
+
+# ============================================================================
+# Record oriented storage for processed documents.
+#
+# Documents are stored as gzip compressed JSON Lines, one document per line.
+# Every line is its own gzip member, concatenated gzip members are still a
+# valid gzip file, so the whole file can be streamed with any gzip reader
+# while a single document can be read from its byte range. The byte ranges
+# are stored in a `<object_key>.index.json` index keyed by the document
+# `source_location`, since different companies publish reports with the same
+# file name. Each entry also holds the document `name`.
+# ============================================================================
+
+
+def index_key_for(object_key):
+    return f"{object_key}.index.json"
+
+
+def _compress_document(document):
+    return gzip.compress((json.dumps(document) + "\n").encode("utf-8"))
+
+
+def _add_index_entry(index, document, offset, length):
+    source_location = document["source_location"]
+    if source_location in index:
+        raise ValueError(f"The document {source_location} is stored twice")
+    index[source_location] = {"name": document["name"], "offset": offset, "length": length}
+
+
+def store_documents_to_s3(bucket_name, object_key, documents, part_size=MULTIPART_PART_SIZE):
+    """Stream documents to S3 as gzip JSON Lines with a multipart upload.
+
+    Args:
+        bucket_name (str): Destination bucket.
+        object_key (str): Destination key, for example `documents_processed.jsonl.gz`.
+        documents (iterable): The documents, can be a generator.
+        part_size (int): Size of the buffered parts sent to S3.
+
+    Returns:
+        dict: The index mapping each document `source_location` to its `name`, byte
+        `offset` and `length`.
+
+    Raises:
+        ValueError: If two documents have the same `source_location`.
+    """
+    upload = s3_client.create_multipart_upload(Bucket=bucket_name, Key=object_key)
+    upload_id = upload["UploadId"]
+    parts = []
+    buffer = io.BytesIO()
+    index = {}
+    offset = 0
+
+    def upload_part(body):
+        part_number = len(parts) + 1
+        response = s3_client.upload_part(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    try:
+        for document in documents:
+            record = _compress_document(document)
+            _add_index_entry(index, document, offset, len(record))
+            offset += len(record)
+            buffer.write(record)
+            if buffer.tell() >= part_size:
+                upload_part(buffer.getvalue())
+                buffer = io.BytesIO()
+        # The last part can be smaller than the minimum part size, it can not be empty
+        # unless it is the only part.
+        if buffer.tell() or not parts:
+            upload_part(buffer.getvalue())
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name,
+            Key=object_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+        raise
+
+    s3_client.put_object(
+        Bucket=bucket_name, Key=index_key_for(object_key), Body=json.dumps(index)
+    )
+    return index
+
+
+def iter_documents_from_s3(bucket_name, object_key):
+    """Yield the documents of a gzip JSON Lines object one at a time."""
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    with gzip.GzipFile(fileobj=response["Body"]) as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_documents_index_from_s3(bucket_name, object_key):
+    return load_list_from_s3(bucket_name, index_key_for(object_key))
+
+
+def load_document_from_s3(bucket_name, object_key, source_location, index=None):
+    """Read a single document by `source_location` with a ranged GET, using the index."""
+    if index is None:
+        index = load_documents_index_from_s3(bucket_name, object_key)
+    entry = index[source_location]
+    byte_range = f"bytes={entry['offset']}-{entry['offset'] + entry['length'] - 1}"
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=byte_range)
+    return json.loads(gzip.decompress(response["Body"].read()))
+
+
+def store_documents_to_file(file_path, documents):
+    """Write documents as gzip JSON Lines to a local file and its index next to it."""
+    index = {}
+    offset = 0
+    with open(file_path, "wb") as f:
+        for document in documents:
+            record = _compress_document(document)
+            _add_index_entry(index, document, offset, len(record))
+            offset += len(record)
+            f.write(record)
+    with open(index_key_for(file_path), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def iter_documents_from_file(file_path):
+    """Yield the documents of a local file one at a time.
+
+    Supports the gzip JSON Lines format (`.jsonl.gz`), plain JSON Lines (`.jsonl`)
+    and, for older outputs, a single JSON array (`.json`) which is loaded at once.
+    """
+    if file_path.endswith(".json"):
+        with open(file_path, "rb") as f:
+            yield from json.load(f)
+        return
+
+    opener = gzip.open if file_path.endswith(".gz") else open
+    with opener(file_path, "rb") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_document_from_file(file_path, source_location, index=None):
+    """Read a single document by `source_location` from a local gzip JSON Lines file."""
+    if index is None:
+        with open(index_key_for(file_path), "r") as f:
+            index = json.load(f)
+    entry = index[source_location]
+    with open(file_path, "rb") as f:
+        f.seek(entry["offset"])
+        return json.loads(gzip.decompress(f.read(entry["length"])))
+
+
+def find_processed_documents_file(directory):
+    """Return the processed documents file in a directory, preferring the streaming format."""
+    for file_name in ["documents_processed.jsonl.gz", "documents_processed.jsonl", "documents_processed.json"]:
+        file_path = os.path.join(directory, file_name)
+        if os.path.isfile(file_path):
+            return file_path
+    return None
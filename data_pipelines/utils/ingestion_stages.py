@@ -0,0 +1,311 @@
+"""The document ingestion stages of notebooks 03 and 05-2, as `PipelineRunner` stages.
+
+- `triage`: flag the pages of the prepared PDFs needing OCR from their text layer,
+  and write the PDFs of the pages to send to Textract.
+- `textract`: Textract layout analysis of those PDFs, through the sha256 keyed cache.
+- `markdown`: improve the Textract markdown with an LLM, merge it with the pages
+  extracted locally and write the processed documents.
+- `entities`: extract the entities of every processed document.
+
+These stages cover notebooks 03 and 05-2 only. Downloading and preparing the PDFs
+(notebook 02), chunking and embedding them into the vector store (notebooks 04 and 99)
+and loading the SQL tables (notebook 05) are not stages yet and still run from their
+notebooks, before and after the pipeline.
+
+`build_ingestion_stages` wires them together from the prepared documents of notebook 02:
+
+    from utils.ingestion_stages import build_ingestion_stages
+    from utils.pipeline_runner import PipelineRunner
+
+    stages = build_ingestion_stages("raw_documents/prepared", "pipeline_outputs", bucket_name, llm_model_id)
+    results = PipelineRunner(stages).run()
+"""
+import hashlib
+import inspect
+import json
+import logging
+import os
+
+import boto3
+
+from .helpers import find_processed_documents_file, iter_documents_from_file, store_documents_to_file
+from .markdown_improvement import improve_textract_markdown_output
+from .pdf_triage import DEFAULT_MIN_QUALITY, PageTriage, merge_pages, ocr_input_for, triage_pdf
+from .pipeline_runner import Stage, function_reference, load_function
+from .textract_cache import S3TextractCache, TextractAnalysisStage
+
+logger = logging.getLogger(__name__)
+
+PROCESSED_DOCUMENTS_FILE_NAME = "documents_processed.jsonl.gz"
+
+# The OCR input of a document is either its prepared PDF or a subset of its pages.
+PREPARED_INPUT = "prepared"
+OCR_PAGES_INPUT = "ocr_pages"
+
+
+def _prepared_pdf_path(prepared_dir, doc_meta):
+    # Notebook 02 writes the PDFs as <company>/<file name>, `local_pdf_path` is only
+    # valid from the directory the notebook ran in.
+    return os.path.join(prepared_dir, doc_meta["company"], os.path.basename(doc_meta["local_pdf_path"]))
+
+
+def _textract_response_name(document):
+    return f"{document['ocr_input']['path']}.textract.json"
+
+
+def _utils_files(*module_names):
+    """Source files of the utils modules a stage calls, hashed with the stage code."""
+    utils_dir = os.path.dirname(os.path.abspath(__file__))
+    return [os.path.join(utils_dir, f"{module_name}.py") for module_name in module_names]
+
+
+def triage_documents(inputs, outputs, min_quality=DEFAULT_MIN_QUALITY):
+    """Triage the pages of the prepared documents listed in `metadata.json`.
+
+    Inputs: `prepared`, the prepared documents directory. Outputs: `triage`, a JSON
+    list with the pages of each document and its OCR input, and `ocr_pages`, the
+    directory of the PDFs holding only the pages needing OCR.
+    """
+    with open(os.path.join(inputs["prepared"], "metadata.json"), "r") as f:
+        docs_metadata = json.load(f)
+    os.makedirs(outputs["ocr_pages"], exist_ok=True)
+
+    documents = []
+    for doc_meta in docs_metadata:
+        pdf_path = _prepared_pdf_path(inputs["prepared"], doc_meta)
+        triaged_pages = triage_pdf(pdf_path, min_quality=min_quality)
+        ocr_input, ocr_pages = ocr_input_for(pdf_path, triaged_pages, outputs["ocr_pages"])
+        if ocr_input == pdf_path:
+            ocr_input = {"in": PREPARED_INPUT, "path": os.path.relpath(pdf_path, inputs["prepared"])}
+        elif ocr_input is not None:
+            ocr_input = {"in": OCR_PAGES_INPUT, "path": os.path.relpath(ocr_input, outputs["ocr_pages"])}
+        logger.info("%s: %s of %s pages need OCR", pdf_path, len(ocr_pages), len(triaged_pages))
+        documents.append(
+            {
+                "metadata": doc_meta,
+                "pages": [vars(page) for page in triaged_pages],
+                "ocr_input": ocr_input,
+                "ocr_pages": ocr_pages,
+            }
+        )
+
+    with open(outputs["triage"], "w") as f:
+        json.dump(documents, f)
+
+
+def analyze_documents(
+    inputs,
+    outputs,
+    bucket_name,
+    cache_prefix="textract_cache",
+    upload_prefix="input_documents",
+    region=None,
+    max_in_flight=20,
+):
+    """Run the Textract layout analysis of the OCR inputs of the triaged documents.
+
+    Inputs: `prepared`, `triage` and `ocr_pages`, see `triage_documents`. Outputs:
+    `textract`, a directory with the Textract response of each OCR input.
+    """
+    with open(inputs["triage"], "r") as f:
+        documents = [document for document in json.load(f) if document["ocr_input"]]
+    os.makedirs(outputs["textract"], exist_ok=True)
+    if not documents:
+        return
+
+    s3_client = boto3.client("s3")
+    textract_stage = TextractAnalysisStage(
+        boto3.client("textract", region_name=region),
+        s3_client,
+        upload_bucket=bucket_name,
+        cache=S3TextractCache(s3_client, bucket_name, prefix=cache_prefix),
+        upload_prefix=upload_prefix,
+        max_in_flight=max_in_flight,
+    )
+    file_paths = {
+        os.path.join(inputs[document["ocr_input"]["in"]], document["ocr_input"]["path"]): document
+        for document in documents
+    }
+    for file_path, response in textract_stage.analyze(list(file_paths)).items():
+        response_path = os.path.join(outputs["textract"], _textract_response_name(file_paths[file_path]))
+        os.makedirs(os.path.dirname(response_path), exist_ok=True)
+        with open(response_path, "w") as f:
+            json.dump(response, f)
+
+
+def extract_documents(
+    inputs,
+    outputs,
+    llm_model_id,
+    region=None,
+    checkpoint_dir="markdown_checkpoints",
+    max_workers=8,
+):
+    """Write the processed documents, with the LLM improved markdown of the OCR pages.
+
+    Inputs: `triage` and `textract`, see `analyze_documents`. Outputs: `processed`,
+    a directory with the documents as gzip JSON Lines and their index.
+
+    The improved pages are checkpointed under `checkpoint_dir`, outside of the stage
+    outputs, so an interrupted run resumes from the pages already improved.
+    """
+    # Only this stage needs textractor.
+    from textractor.entities.document import Document
+
+    with open(inputs["triage"], "r") as f:
+        documents = json.load(f)
+    bedrock_runtime = boto3.client("bedrock-runtime", region_name=region)
+
+    def processed_documents():
+        for document in documents:
+            doc_meta = document["metadata"]
+            ocr_results = {}
+            if document["ocr_input"]:
+                with open(os.path.join(inputs["textract"], _textract_response_name(document)), "r") as f:
+                    textract_document = Document.open(json.load(f))
+                ocr_input = document["ocr_input"]
+                improved_markdown = improve_textract_markdown_output(
+                    textract_document,
+                    llm_model_id,
+                    bedrock_runtime,
+                    os.path.join(checkpoint_dir, ocr_input["in"], os.path.splitext(ocr_input["path"])[0]),
+                    max_workers=max_workers,
+                )
+                # Map the pages of the OCR input back to their page index in the original document.
+                ocr_results = {
+                    original_page: {
+                        "page_text": page_text,
+                        "page_tables": [
+                            table.to_markdown() for table in textract_document.pages[index].tables
+                        ],
+                    }
+                    for index, (original_page, page_text) in enumerate(
+                        zip(document["ocr_pages"], improved_markdown)
+                    )
+                }
+            yield {
+                "metadata": doc_meta,
+                "name": doc_meta["doc_url"].split("/")[-1],
+                "source_location": doc_meta["doc_url"],
+                "pages": merge_pages([PageTriage(**page) for page in document["pages"]], ocr_results),
+            }
+
+    os.makedirs(outputs["processed"], exist_ok=True)
+    store_documents_to_file(
+        os.path.join(outputs["processed"], PROCESSED_DOCUMENTS_FILE_NAME), processed_documents()
+    )
+
+
+def extract_entities(inputs, outputs, engine_factory, max_workers=4):
+    """Extract the entities of the processed documents.
+
+    Inputs: `processed`, see `extract_documents`. Outputs: `entities`, a JSON Lines
+    file with one row per document.
+
+    Args:
+        engine_factory (str): `module:function` of a module level function returning
+            the EntityExtractionEngine, called with `max_workers`. The entity schema,
+            the examples and the chunk retrieval are defined with it.
+    """
+    processed_path = find_processed_documents_file(inputs["processed"])
+    if processed_path is None:
+        raise FileNotFoundError(f"No processed documents in {inputs['processed']}")
+    engine = load_function(engine_factory)(max_workers=max_workers)
+
+    # The rows of an interrupted run are reused while the documents do not change.
+    with open(processed_path, "rb") as f:
+        documents_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+    partial_path = f"{outputs['entities']}.{documents_hash}.partial"
+    engine.run(iter_documents_from_file(processed_path), partial_path)
+
+    # Documents without excerpts are not in the output, the next run retries them.
+    document_count = sum(1 for _ in iter_documents_from_file(processed_path))
+    with open(partial_path, "r") as f:
+        row_count = sum(1 for line in f if line.strip())
+    if row_count < document_count:
+        raise RuntimeError(
+            f"Entities of {document_count - row_count} of {document_count} documents"
+            " were not extracted, run again to retry them"
+        )
+    os.replace(partial_path, outputs["entities"])
+
+
+def build_ingestion_stages(
+    prepared_dir,
+    output_dir,
+    bucket_name,
+    llm_model_id,
+    region=None,
+    entity_engine_factory=None,
+    min_quality=DEFAULT_MIN_QUALITY,
+    max_concurrent_llm_calls=8,
+):
+    """Build the ingestion stages, from the prepared documents to the extracted entities.
+
+    Args:
+        prepared_dir (str): The prepared documents and their `metadata.json`, see notebook 02.
+        output_dir (str): Directory receiving the outputs of the stages.
+        bucket_name (str): Bucket of the Textract uploads and cache.
+        llm_model_id (str): Bedrock model improving the Textract markdown.
+        region (str): Region of the Textract and Bedrock clients, the session region when None.
+        entity_engine_factory (callable): Module level function returning the
+            EntityExtractionEngine, see `extract_entities`. The `entities` stage is
+            left out when None.
+        min_quality (float): Pages with a text layer scoring below this go through OCR.
+        max_concurrent_llm_calls (int): Concurrent Bedrock calls of the markdown stage.
+
+    Returns:
+        list: The `Stage`s of the pipeline.
+    """
+    triage_path = os.path.join(output_dir, "triage.json")
+    ocr_pages_dir = os.path.join(output_dir, "ocr_pages")
+    textract_dir = os.path.join(output_dir, "textract")
+    processed_dir = os.path.join(output_dir, "processed")
+
+    stages = [
+        Stage(
+            "triage",
+            triage_documents,
+            {"prepared": prepared_dir},
+            {"triage": triage_path, "ocr_pages": ocr_pages_dir},
+            {"min_quality": min_quality},
+            code_paths=_utils_files("pdf_triage", "textract_cache"),
+        ),
+        Stage(
+            "textract",
+            analyze_documents,
+            {"prepared": prepared_dir, "triage": triage_path, "ocr_pages": ocr_pages_dir},
+            {"textract": textract_dir},
+            {"bucket_name": bucket_name, "region": region},
+            code_paths=_utils_files("textract_cache"),
+        ),
+        Stage(
+            "markdown",
+            extract_documents,
+            {"triage": triage_path, "textract": textract_dir},
+            {"processed": processed_dir},
+            {
+                "llm_model_id": llm_model_id,
+                "region": region,
+                "checkpoint_dir": os.path.join(output_dir, "markdown_checkpoints"),
+                "max_workers": max_concurrent_llm_calls,
+            },
+            code_paths=_utils_files("markdown_improvement", "pdf_triage", "helpers"),
+        ),
+    ]
+    if entity_engine_factory is not None:
+        stages.append(
+            Stage(
+                "entities",
+                extract_entities,
+                {"processed": processed_dir},
+                {"entities": os.path.join(output_dir, "extracted_entities.jsonl")},
+                {"engine_factory": function_reference(entity_engine_factory)},
+                # The schema, examples and retrieval of the engine are part of the stage code.
+                code_paths=[
+                    inspect.getsourcefile(entity_engine_factory),
+                    *_utils_files("entity_extraction", "helpers"),
+                ],
+            )
+        )
+    return stages
@@ -0,0 +1,105 @@
+"""Measure the processing stages offline, against the fake clients of `fakes.py`.
+
+Usage, from the `data_pipelines` directory:
+
+    python -m utils.local_benchmarks markdown --pages 40 --latency 0.1 --throttle-rate 0.05
+    python -m utils.local_benchmarks textract --documents 30 --max-in-flight 10 --throttle-rate 0.2
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from .fakes import FakeBedrockRuntime, FakeS3Client, FakeTextractClient
+from .markdown_improvement import improve_pages_markdown
+from .textract_cache import S3TextractCache, TextractAnalysisStage
+
+
+def benchmark_markdown_improvement(pages, latency, throttle_rate, max_workers):
+    """Improve `pages` fake pages twice, the second run resuming from the checkpoint."""
+    pages_markdown = [f"# Page {page}\nSome text" for page in range(pages)]
+    fake_client = FakeBedrockRuntime(latency=latency, throttle_rate=throttle_rate)
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        _, stats = improve_pages_markdown(
+            pages_markdown, fake_client, "fake-model", checkpoint_dir, max_workers=max_workers
+        )
+        _, resumed_stats = improve_pages_markdown(
+            pages_markdown, fake_client, "fake-model", checkpoint_dir, max_workers=max_workers
+        )
+    print(f"max_workers={max_workers}: {stats}")
+    print(f"  throughput {stats.pages_per_second:.1f} pages/s, {fake_client.throttled_calls} calls throttled")
+    print(f"  resumed run: {resumed_stats}")
+    return stats
+
+
+def benchmark_textract_analysis(documents, job_duration, max_in_flight, max_running_jobs, throttle_rate):
+    """Analyze `documents` fake PDFs twice, the second run only reading the S3 cache."""
+    fake_textract = FakeTextractClient(
+        job_duration=job_duration,
+        blocks_per_page=1,
+        max_running_jobs=max_running_jobs,
+        throttle_rate=throttle_rate,
+    )
+    fake_s3 = FakeS3Client()
+    stage = TextractAnalysisStage(
+        fake_textract,
+        fake_s3,
+        "fake-bucket",
+        S3TextractCache(fake_s3, "fake-bucket"),
+        max_in_flight=max_in_flight,
+        poll_interval=0.05,
+        max_poll_interval=0.5,
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_paths = []
+        for index in range(documents):
+            pdf_path = os.path.join(tmp_dir, f"document_{index}.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(f"%PDF-1.4 fake document {index}".encode("utf-8"))
+            pdf_paths.append(pdf_path)
+        # The same bytes under another path are analyzed once.
+        pdf_paths.append(os.path.join(tmp_dir, "copy_of_document_0.pdf"))
+        with open(pdf_paths[0], "rb") as source, open(pdf_paths[-1], "wb") as copy:
+            copy.write(source.read())
+
+        for run in ["cold", "cached"]:
+            start_time = time.perf_counter()
+            results = stage.analyze(pdf_paths)
+            print(
+                f"{run} run: {len(results)} documents in {time.perf_counter() - start_time:.2f}s,"
+                f" {fake_textract.started_jobs} Textract jobs started so far,"
+                f" at most {fake_textract.peak_running_jobs} at once,"
+                f" {fake_textract.throttled_calls} calls throttled"
+            )
+    return fake_textract
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    markdown = subparsers.add_parser("markdown", help="Pages per second of the markdown improvement.")
+    markdown.add_argument("--pages", type=int, default=40)
+    markdown.add_argument("--latency", type=float, default=0.1, help="Seconds per Bedrock call.")
+    markdown.add_argument("--throttle-rate", type=float, default=0.05, help="Share of throttled calls.")
+    markdown.add_argument("--max-workers", type=int, nargs="+", default=[1, 8])
+    textract = subparsers.add_parser("textract", help="Textract analysis with its cache and throttled polling.")
+    textract.add_argument("--documents", type=int, default=30)
+    textract.add_argument("--job-duration", type=float, default=0.5, help="Seconds per Textract job.")
+    textract.add_argument("--max-in-flight", type=int, default=10)
+    textract.add_argument("--max-running-jobs", type=int, help="Textract concurrent job limit.")
+    textract.add_argument("--throttle-rate", type=float, default=0.2, help="Share of throttled polls.")
+    args = parser.parse_args(argv)
+
+    if args.command == "markdown":
+        for max_workers in args.max_workers:
+            benchmark_markdown_improvement(args.pages, args.latency, args.throttle_rate, max_workers)
+    elif args.command == "textract":
+        benchmark_textract_analysis(
+            args.documents, args.job_duration, args.max_in_flight, args.max_running_jobs, args.throttle_rate
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
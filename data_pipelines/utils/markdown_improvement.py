@@ -0,0 +1,259 @@
+"""Improve the Textract markdown of each document page with an LLM on Amazon Bedrock.
+
+Pages are sent to Bedrock on a bounded thread pool. Throttling errors are retried
+with exponential backoff and each finished page is written to a checkpoint
+directory right away, so a re-run only calls the LLM for the pages that are missing.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# Define a template prompt for improving markdown formatting
+USER_PROMPT = """
+Improve the markdown while keeping all original information. Put the improved markdown inside a <results> xml tags with no explanation:
+\n{markdown_doc}
+""".strip()
+
+# Define a system prompt for guiding the language model's task
+SYSTEM_PROMPT = "Your task is to review and improve the results of Amazon textract in markdown."
+
+# Bedrock error codes that are worth retrying after a pause.
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+}
+
+
+# https://docs.aws.amazon.com/bedrock/latest/userguide/bedrock-runtime_example_bedrock-runtime_InvokeModel_AnthropicClaude_section.html
+def generate_message(bedrock_runtime, model_id, system_prompt, messages, max_tokens):
+    # Create a JSON payload for the model request
+    body = json.dumps(
+        {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "system": system_prompt,
+            "messages": messages,
+        }
+    )
+    response = bedrock_runtime.invoke_model(body=body, modelId=model_id)
+    return json.loads(response.get("body").read())
+
+
+def call_llm_with_retry(
+    user_input,
+    model_id,
+    system_prompt,
+    bedrock_runtime,
+    max_tokens=3000,
+    max_attempts=6,
+    base_delay=1.0,
+    max_delay=30.0,
+    on_retry=None,
+):
+    """Call the Anthropic Claude message API, backing off on throttling.
+
+    Args:
+        user_input (str): The user message.
+        model_id (str): The Bedrock model id.
+        system_prompt (str): The system prompt.
+        bedrock_runtime: A bedrock-runtime client, or any object with the same `invoke_model`.
+        max_tokens (int): Maximum tokens for the response.
+        max_attempts (int): Total number of attempts before giving up.
+        base_delay (float): First backoff delay in seconds, doubled on every retry.
+        max_delay (float): Upper bound of a single backoff delay in seconds.
+        on_retry (callable): Optional callback invoked with the error before each retry.
+
+    Returns:
+        dict: The parsed response body.
+    """
+    messages = [{"role": "user", "content": user_input}]
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return generate_message(
+                bedrock_runtime, model_id, system_prompt, messages, max_tokens
+            )
+        except ClientError as err:
+            error_code = err.response["Error"]["Code"]
+            if error_code not in RETRYABLE_ERROR_CODES or attempt == max_attempts:
+                raise
+            # Full jitter keeps concurrent workers from retrying in lockstep.
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            logger.warning(
+                "%s on attempt %s, retrying in %.2fs", error_code, attempt, delay
+            )
+            if on_retry is not None:
+                on_retry(err)
+            time.sleep(delay)
+
+
+def extract_results(text):
+    """Extract the improved markdown text from within the <results> XML tags."""
+    return text.split("<results>")[-1].split("</results>")[0].strip()
+
+
+class PageCheckpoint:
+    """One JSON file per page under `directory`, written atomically.
+
+    A checkpoint is only reused when it was produced from the same page markdown
+    with the same model, so changed inputs are processed again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, page):
+        return os.path.join(self.directory, f"page_{page:05d}.json")
+
+    @staticmethod
+    def input_key(page_markdown, model_id):
+        return hashlib.sha256(f"{model_id}\n{page_markdown}".encode("utf-8")).hexdigest()
+
+    def load(self, page, input_key):
+        try:
+            with open(self._path(page), "r") as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if checkpoint.get("input_key") != input_key:
+            return None
+        return checkpoint["page_text"]
+
+    def save(self, page, input_key, page_text):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"page": page, "input_key": input_key, "page_text": page_text}, f)
+        os.replace(tmp_path, self._path(page))
+
+
+@dataclass
+class PagePipelineStats:
+    pages_total: int = 0
+    pages_from_checkpoint: int = 0
+    pages_processed: int = 0
+    retries: int = 0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def pages_per_second(self):
+        if not self.elapsed_seconds:
+            return 0.0
+        return self.pages_processed / self.elapsed_seconds
+
+
+def improve_pages_markdown(
+    pages_markdown,
+    bedrock_runtime,
+    model_id,
+    checkpoint_dir,
+    max_workers=8,
+    max_tokens=3000,
+    max_attempts=6,
+):
+    """Improve the markdown of every page, resuming from `checkpoint_dir`.
+
+    Args:
+        pages_markdown (list): The Textract markdown of each page, in page order.
+        bedrock_runtime: A bedrock-runtime client, or any object with the same `invoke_model`.
+        model_id (str): The Bedrock model id.
+        checkpoint_dir (str): Directory holding the per page checkpoints of this document.
+        max_workers (int): Maximum number of concurrent Bedrock calls.
+        max_tokens (int): Maximum tokens for each response.
+        max_attempts (int): Attempts per page before the page is reported as failed.
+
+    Returns:
+        tuple: The improved markdown of each page in page order, and a PagePipelineStats.
+
+    Raises:
+        RuntimeError: If some pages still failed after retries. The pages that succeeded
+            are checkpointed, so running again only retries the failed ones.
+    """
+    start_time = time.perf_counter()
+    checkpoint = PageCheckpoint(checkpoint_dir)
+    stats = PagePipelineStats(pages_total=len(pages_markdown))
+    stats_lock = threading.Lock()
+
+    def count_retry(_err):
+        with stats_lock:
+            stats.retries += 1
+
+    improved_markdown = [None] * len(pages_markdown)
+    pending = []
+    for page, page_markdown in enumerate(pages_markdown):
+        input_key = PageCheckpoint.input_key(page_markdown, model_id)
+        cached = checkpoint.load(page, input_key)
+        if cached is None:
+            pending.append((page, page_markdown, input_key))
+        else:
+            improved_markdown[page] = cached
+            stats.pages_from_checkpoint += 1
+
+    def process_page(page, page_markdown, input_key):
+        result = call_llm_with_retry(
+            USER_PROMPT.format(markdown_doc=page_markdown),
+            model_id,
+            SYSTEM_PROMPT,
+            bedrock_runtime,
+            max_tokens=max_tokens,
+            max_attempts=max_attempts,
+            on_retry=count_retry,
+        )
+        page_text = extract_results(result["content"][0]["text"])
+        checkpoint.save(page, input_key, page_text)
+        return page_text
+
+    failed_pages = {}
+    if pending:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(process_page, *page_args): page_args[0]
+                for page_args in pending
+            }
+            for future in as_completed(futures):
+                page = futures[future]
+                try:
+                    improved_markdown[page] = future.result()
+                    stats.pages_processed += 1
+                except Exception as e:
+                    logger.error("Failed to improve page %s: %s", page, e)
+                    failed_pages[page] = e
+
+    stats.elapsed_seconds = time.perf_counter() - start_time
+    if failed_pages:
+        raise RuntimeError(
+            f"Failed to improve pages {sorted(failed_pages)}."
+            " Run again to resume from the checkpoint."
+        )
+    return improved_markdown, stats
+
+
+def improve_textract_markdown_output(
+    document, llm_model_id, bedrock_runtime, checkpoint_dir, **kwargs
+):
+    """Improve the markdown of a textractor Document, see improve_pages_markdown."""
+    pages_markdown = [page.to_markdown() for page in document.pages]
+    improved_markdown, stats = improve_pages_markdown(
+        pages_markdown, bedrock_runtime, llm_model_id, checkpoint_dir, **kwargs
+    )
+    logger.info(
+        "Improved %s pages (%s from checkpoint, %s retries) at %.2f pages/s",
+        stats.pages_total,
+        stats.pages_from_checkpoint,
+        stats.retries,
+        stats.pages_per_second,
+    )
+    return improved_markdown
@@ -0,0 +1,157 @@
+"""Decide which PDF pages need OCR by looking at their embedded text layer.
+
+Born-digital PDFs, like most uploaded CVs, already contain their text. Those pages are
+extracted locally with pypdf and only scanned or low quality pages are sent to Textract.
+The merged output uses the page structure of `documents_processed.json`:
+`{"page": ..., "page_text": ..., "page_tables": [...]}`.
+"""
+import hashlib
+import os
+import re
+from dataclasses import dataclass
+
+from pypdf import PdfReader, PdfWriter
+
+from .textract_cache import sha256_of_file
+
+# Pages with less text than this are most likely scanned images.
+MIN_PAGE_CHARACTERS = 200
+# Pages scoring below this are sent to OCR.
+DEFAULT_MIN_QUALITY = 0.6
+
+_WORD_PATTERN = re.compile(r"^[^\W\d_]{2,}[.,;:!?)]*$")
+
+
+@dataclass
+class PageTriage:
+    page: int
+    text: str
+    quality: float
+    needs_ocr: bool
+
+
+def score_page_text(text):
+    """Score how usable an extracted text layer is, from 0 (unusable) to 1.
+
+    The score combines the amount of text, the share of alphanumeric characters
+    and the share of tokens that look like words. Broken encodings and glyph soup
+    from scanned pages with a bad OCR layer score low on the last two.
+    """
+    stripped = text.strip()
+    if not stripped:
+        return 0.0
+
+    non_space = [char for char in stripped if not char.isspace()]
+    # Many replacement characters means the font has no usable unicode mapping.
+    if stripped.count("\ufffd") > 0.05 * len(non_space):
+        return 0.0
+
+    length_score = min(len(non_space) / MIN_PAGE_CHARACTERS, 1.0)
+    alnum_ratio = sum(char.isalnum() for char in non_space) / len(non_space)
+    tokens = stripped.split()
+    word_ratio = sum(bool(_WORD_PATTERN.match(token)) for token in tokens) / len(tokens)
+
+    return round(length_score * (0.5 * alnum_ratio + 0.5 * min(word_ratio / 0.6, 1.0)), 3)
+
+
+def triage_pdf(pdf_path, min_quality=DEFAULT_MIN_QUALITY):
+    """Extract the text layer of every page and flag the pages needing OCR.
+
+    Args:
+        pdf_path (str): Path of the PDF file.
+        min_quality (float): Pages with a text quality score below this need OCR.
+
+    Returns:
+        list: One PageTriage per page, in page order (0-indexed).
+    """
+    reader = PdfReader(pdf_path)
+    triaged_pages = []
+    for page_index, page in enumerate(reader.pages):
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            # A malformed text layer is treated like a scanned page.
+            text = ""
+        quality = score_page_text(text)
+        triaged_pages.append(
+            PageTriage(
+                page=page_index,
+                text=text,
+                quality=quality,
+                needs_ocr=quality < min_quality,
+            )
+        )
+    return triaged_pages
+
+
+def write_pages_subset(pdf_path, pages, output_path):
+    """Write the given pages (0-indexed) of a PDF into a new PDF.
+
+    An existing output is kept as is, so the bytes, and therefore the Textract
+    cache key, stay the same across runs.
+    """
+    if os.path.exists(output_path):
+        return output_path
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    reader = PdfReader(pdf_path)
+    writer = PdfWriter()
+    for page_index in pages:
+        writer.add_page(reader.pages[page_index])
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        writer.write(f)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def ocr_input_for(pdf_path, triaged_pages, subset_base_directory):
+    """Return the PDF to send to OCR and the original page index of each of its pages.
+
+    Returns the original file when every page needs OCR, a PDF with only the pages
+    needing OCR otherwise, and `(None, [])` when no page needs OCR.
+    """
+    ocr_pages = [page.page for page in triaged_pages if page.needs_ocr]
+    if not ocr_pages:
+        return None, []
+    if len(ocr_pages) == len(triaged_pages):
+        return pdf_path, ocr_pages
+
+    # The source hash in the name keeps a stale subset from being reused
+    # when the original PDF changes. The pages are hashed too, listing them
+    # would exceed the file name length limit for long scanned documents.
+    pages_hash = hashlib.sha256(
+        ",".join(str(page) for page in ocr_pages).encode("utf-8")
+    ).hexdigest()[:12]
+    file_stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    source_hash = sha256_of_file(pdf_path)[:12]
+    subset_path = os.path.join(
+        subset_base_directory,
+        f"{file_stem}_{source_hash}_ocr_pages_{pages_hash}.pdf",
+    )
+    return write_pages_subset(pdf_path, ocr_pages, subset_path), ocr_pages
+
+
+def merge_pages(triaged_pages, ocr_results):
+    """Combine locally extracted pages with the OCR results.
+
+    Args:
+        triaged_pages (list): The PageTriage list of the document.
+        ocr_results (dict): Maps an original page index to a dict with `page_text`
+            and optionally `page_tables`, for the pages that went through OCR.
+
+    Returns:
+        list: The pages in the `documents_processed.json` format, in page order.
+    """
+    pages = []
+    for triaged_page in triaged_pages:
+        if triaged_page.page in ocr_results:
+            ocr_page = ocr_results[triaged_page.page]
+            page_text = ocr_page["page_text"]
+            page_tables = ocr_page.get("page_tables", [])
+        else:
+            page_text = triaged_page.text.strip()
+            page_tables = []
+        pages.append(
+            {"page": triaged_page.page, "page_text": page_text, "page_tables": page_tables}
+        )
+    return pages
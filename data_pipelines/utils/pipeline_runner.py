@@ -0,0 +1,566 @@
+"""Run the document processing stages as a DAG, skipping the stages whose inputs did not change.
+
+Each `Stage` names its input and output paths and the function producing the outputs
+from the inputs. The stages depend on each other through their paths: a stage reading
+a path written by another stage runs after it. The runner computes a key for each stage
+from the sha256 of its inputs, the source of its code and its parameters, and keeps the
+outputs of every run under that key in the cache directory. When the key of a stage is
+found in the cache its outputs are restored instead of running it again, so a re-run
+with no change only hashes the inputs, and the hashes of unchanged files are themselves
+reused from their size and modification time. Independent stages run in parallel
+processes.
+
+The same stage functions run as SageMaker Processing steps, see
+`sagemaker_processing_step`: the job calls `python pipeline_runner.py run-stage` with
+the container paths of the inputs and outputs, and the code hash of the stage is part
+of the job arguments, so SageMaker step caching reruns the step when the code changes.
+"""
+import argparse
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import marshal
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+try:
+    from .textract_cache import sha256_of_file
+except ImportError:
+    # Run as the script of a processing job, where `utils` is a top level package.
+    from utils.textract_cache import sha256_of_file
+
+logger = logging.getLogger(__name__)
+
+CACHED = "cached"
+COMPLETED = "completed"
+FAILED = "failed"
+OUTDATED = "outdated"
+SKIPPED = "skipped"
+
+PROCESSING_INPUT_DIR = "/opt/ml/processing/input"
+PROCESSING_OUTPUT_DIR = "/opt/ml/processing/output"
+
+
+class PipelineError(RuntimeError):
+    """Raised after a run where at least one stage failed, with the results of every stage."""
+
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
+
+
+@dataclass
+class Stage:
+    """One step of the pipeline, `function(inputs, outputs, **params)`.
+
+    Args:
+        name (str): Unique name of the stage.
+        function (callable): Module level function, so it can run in another process.
+            It receives the `inputs` and `outputs` dicts and the `params` as keywords,
+            and must write every output path.
+        inputs (dict): Maps an input name to a file or directory path.
+        outputs (dict): Maps an output name to a file or directory path.
+        params (dict): JSON serializable keyword arguments of the function.
+        code_paths (list): Other files or directories whose content is part of the code
+            of the stage, such as a prompt file or a helper module.
+    """
+
+    name: str
+    function: object
+    inputs: dict = field(default_factory=dict)
+    outputs: dict = field(default_factory=dict)
+    params: dict = field(default_factory=dict)
+    code_paths: list = field(default_factory=list)
+
+
+@dataclass
+class StageResult:
+    name: str
+    status: str
+    key: str = ""
+    seconds: float = 0.0
+    error: str = ""
+
+
+def function_reference(function):
+    return f"{function.__module__}:{function.__qualname__}"
+
+
+def load_function(reference):
+    module_name, _, qualname = reference.partition(":")
+    target = importlib.import_module(module_name)
+    for attribute in qualname.split("."):
+        target = getattr(target, attribute)
+    return target
+
+
+def _sha256_json(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class FileHasher:
+    """sha256 of files and directories, reusing the hash of a file while its size and
+    modification time do not change.
+
+    Args:
+        state_path (str): JSON file keeping the known hashes between runs, None to keep
+            them in memory only.
+    """
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self._hashes = {}
+        self._lock = threading.Lock()
+        if state_path and os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                self._hashes = json.load(f)
+
+    def hash_file(self, file_path):
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            known = self._hashes.get(file_path)
+        if known is not None and known[0] == signature:
+            return known[1]
+        digest = sha256_of_file(file_path)
+        with self._lock:
+            self._hashes[file_path] = [signature, digest]
+        return digest
+
+    def hash_path(self, path):
+        """Hash a file, or a directory from the relative path and hash of its files."""
+        if os.path.isfile(path):
+            return self.hash_file(path)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"{path} does not exist")
+        entries = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                entries.append([os.path.relpath(file_path, path), self.hash_file(file_path)])
+        return _sha256_json(entries)
+
+    def save(self):
+        if not self.state_path:
+            return
+        with self._lock:
+            state = dict(self._hashes)
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+
+def code_hash(stage, hasher=None):
+    """Hash the source of the module defining the stage function and the `code_paths`.
+
+    The whole module is hashed so a change to a helper of the function is a change of
+    the stage. Functions without a source file, e.g. defined in a notebook, fall back
+    to their bytecode.
+    """
+    hasher = hasher or FileHasher()
+    module = inspect.getmodule(stage.function)
+    try:
+        source = inspect.getsource(module if module is not None else stage.function)
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    except (OSError, TypeError):
+        digest = hashlib.sha256(marshal.dumps(stage.function.__code__)).hexdigest()
+    return _sha256_json(
+        {
+            "function": function_reference(stage.function),
+            "source": digest,
+            "code_paths": [hasher.hash_path(path) for path in stage.code_paths],
+        }
+    )
+
+
+def _copy_path(source, destination):
+    if os.path.isdir(destination):
+        shutil.rmtree(destination)
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        # copy2 keeps the modification time, so the restored file hash is reused.
+        shutil.copy2(source, destination)
+
+
+def _run_stage_function(reference_or_function, inputs, outputs, params):
+    """Run a stage function, in the pool process, and return its duration in seconds."""
+    function = (
+        load_function(reference_or_function)
+        if isinstance(reference_or_function, str)
+        else reference_or_function
+    )
+    for path in outputs.values():
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    start_time = time.perf_counter()
+    function(inputs=dict(inputs), outputs=dict(outputs), **params)
+    missing = [name for name, path in outputs.items() if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError(f"The stage did not write its outputs {missing}")
+    return time.perf_counter() - start_time
+
+
+class PipelineRunner:
+    """Run stages in dependency order, in parallel, restoring cached outputs.
+
+    Args:
+        stages (list): The `Stage`s of the pipeline.
+        cache_dir (str): Directory keeping the outputs of each stage under its key.
+        max_workers (int): Number of stages running at once. With 1, the stages run
+            in the current process, which is easier to debug.
+    """
+
+    def __init__(self, stages, cache_dir=".pipeline_cache", max_workers=None):
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicate stage name {stage.name}")
+            self.stages[stage.name] = stage
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.hasher = FileHasher(os.path.join(cache_dir, "file_hashes.json"))
+        self.dependencies = self._dependencies()
+        self.order = self._topological_order()
+
+    def _dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for path in stage.outputs.values():
+                path = os.path.abspath(path)
+                if path in producers:
+                    raise ValueError(f"{path} is an output of {producers[path]} and {stage.name}")
+                producers[path] = stage.name
+        dependencies = {}
+        for stage in self.stages.values():
+            dependencies[stage.name] = {
+                producers[os.path.abspath(path)]
+                for path in stage.inputs.values()
+                if os.path.abspath(path) in producers
+            }
+        return dependencies
+
+    def _topological_order(self):
+        order, visiting, visited = [], set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"The stages have a cycle through {name}")
+            visiting.add(name)
+            for dependency in sorted(self.dependencies[name]):
+                visit(dependency)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _with_ancestors(self, targets):
+        selected, pending = set(), list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in self.stages:
+                raise KeyError(f"Unknown stage {name}")
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.dependencies[name])
+        return selected
+
+    def stage_key(self, stage, known_hashes=None):
+        """Cache key of a stage, from its code, parameters and the content of its inputs.
+
+        `known_hashes` maps absolute paths to the hash they will have, for the outputs
+        of cached stages that a dry run does not restore.
+        """
+        known_hashes = known_hashes or {}
+        return _sha256_json(
+            {
+                "stage": stage.name,
+                "code": code_hash(stage, self.hasher),
+                "params": stage.params,
+                "inputs": {
+                    name: known_hashes.get(os.path.abspath(path)) or self.hasher.hash_path(path)
+                    for name, path in stage.inputs.items()
+                },
+                "outputs": sorted(stage.outputs),
+            }
+        )
+
+    def _entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, "stages", stage.name, key)
+
+    def _manifest(self, stage, key):
+        manifest_path = os.path.join(self._entry_dir(stage, key), "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def restore(self, stage, key):
+        """Put the cached outputs of `key` in place, return False when there are none."""
+        entry_dir = self._entry_dir(stage, key)
+        manifest = self._manifest(stage, key)
+        if manifest is None:
+            return False
+        for name, path in stage.outputs.items():
+            if os.path.exists(path) and self.hasher.hash_path(path) == manifest["outputs"][name]:
+                continue
+            _copy_path(os.path.join(entry_dir, "outputs", name), path)
+        return True
+
+    def store(self, stage, key, seconds):
+        """Copy the outputs of a finished stage into the cache under `key`."""
+        entry_dir = self._entry_dir(stage, key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{key}.", dir=os.path.dirname(entry_dir))
+        manifest = {"stage": stage.name, "key": key, "seconds": seconds, "outputs": {}}
+        for name, path in stage.outputs.items():
+            _copy_path(path, os.path.join(tmp_dir, "outputs", name))
+            manifest["outputs"][name] = self.hasher.hash_path(path)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+        # The manifest is only visible once all the outputs are copied.
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.replace(tmp_dir, entry_dir)
+
+    def run(self, targets=None, force=(), dry_run=False, raise_on_failure=True):
+        """Run the pipeline.
+
+        Args:
+            targets (list): Stages to bring up to date, with the stages they depend on.
+                All the stages when None.
+            force (list): Stages to run even when their outputs are cached.
+            dry_run (bool): Only report which stages are cached, without running or
+                restoring any. The stages depending on an outdated stage are outdated.
+            raise_on_failure (bool): Raise a PipelineError at the end of a run where a
+                stage failed. The stages depending on a failed stage are skipped.
+
+        Returns:
+            dict: Maps the stage names to their StageResult, in execution order.
+        """
+        selected = self._with_ancestors(targets) if targets else set(self.stages)
+        pending = [name for name in self.order if name in selected]
+        results = {}
+        running = {}
+        # Output hashes of the cached stages of a dry run, whose outputs stay as they are.
+        known_hashes = {}
+        pool = None if self.max_workers == 1 or dry_run else ProcessPoolExecutor(self.max_workers)
+        try:
+            while pending or running:
+                for name in self._ready(pending, results):
+                    pending.remove(name)
+                    results[name] = self._start(name, force, dry_run, results, pool, running, known_hashes)
+                if not running:
+                    if pending and not self._ready(pending, results):
+                        raise RuntimeError(f"Stages {pending} can never start")
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, key = running.pop(future)
+                    results[name] = self._finish(name, key, future)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            self.hasher.save()
+
+        for result in results.values():
+            logger.info(f"{result.name}: {result.status} {result.seconds:.2f}s {result.error}")
+        failed = [name for name, result in results.items() if result.status == FAILED]
+        if failed and raise_on_failure:
+            raise PipelineError(f"Stages {failed} failed", results)
+        return results
+
+    def _ready(self, pending, results):
+        return [
+            name
+            for name in pending
+            if all(dependency in results and results[dependency].status != "running"
+                   for dependency in self.dependencies[name])
+        ]
+
+    def _start(self, name, force, dry_run, results, pool, running, known_hashes):
+        stage = self.stages[name]
+        failed_dependencies = [
+            dependency
+            for dependency in self.dependencies[name]
+            if results[dependency].status in (FAILED, SKIPPED)
+        ]
+        if failed_dependencies:
+            return StageResult(name, SKIPPED, error=f"depends on {sorted(failed_dependencies)}")
+        outdated_dependencies = [
+            dependency for dependency in self.dependencies[name] if results[dependency].status == OUTDATED
+        ]
+        if outdated_dependencies:
+            # The inputs are not written yet, the stage will run after its dependencies.
+            return StageResult(name, OUTDATED, error=f"depends on {sorted(outdated_dependencies)}")
+        try:
+            key = self.stage_key(stage, known_hashes)
+        except Exception as e:
+            return StageResult(name, FAILED, error=f"cannot hash the inputs: {e}")
+
+        if dry_run:
+            manifest = None if name in force else self._manifest(stage, key)
+            if manifest is None:
+                return StageResult(name, OUTDATED, key)
+            for output_name, path in stage.outputs.items():
+                known_hashes[os.path.abspath(path)] = manifest["outputs"][output_name]
+            return StageResult(name, CACHED, key)
+        if name not in force and self.restore(stage, key):
+            logger.info(f"{name}: cached ({key[:12]})")
+            return StageResult(name, CACHED, key)
+
+        logger.info(f"{name}: running ({key[:12]})")
+        if pool is None:
+            try:
+                seconds = _run_stage_function(stage.function, stage.inputs, stage.outputs, stage.params)
+            except Exception as e:
+                logger.exception(f"{name} failed")
+                return StageResult(name, FAILED, key, error=repr(e))
+            self.store(stage, key, seconds)
+            return StageResult(name, COMPLETED, key, seconds)
+
+        future = pool.submit(_run_stage_function, stage.function, stage.inputs, stage.outputs, stage.params)
+        running[future] = (name, key)
+        return StageResult(name, "running", key)
+
+    def _finish(self, name, key, future):
+        try:
+            seconds = future.result()
+        except Exception as e:
+            logger.error(f"{name} failed: {e!r}")
+            return StageResult(name, FAILED, key, error=repr(e))
+        self.store(self.stages[name], key, seconds)
+        return StageResult(name, COMPLETED, key, seconds)
+
+
+def _container_path(base_dir, name, local_path):
+    """Path of an input or output inside the processing container.
+
+    SageMaker mounts every input and output as a directory, a file keeps its name in it.
+    """
+    directory = os.path.join(base_dir, name)
+    if os.path.splitext(local_path.rstrip("/"))[1]:
+        return os.path.join(directory, os.path.basename(local_path))
+    return directory
+
+
+def sagemaker_processing_step(
+    stage,
+    processor,
+    input_sources,
+    output_destinations,
+    code=__file__,
+    cache_expire_after="P30D",
+    **step_kwargs,
+):
+    """Build a SageMaker ProcessingStep running `stage` with `run-stage`.
+
+    The `utils` package and the module of the stage function must be importable in the
+    processing image.
+
+    Args:
+        stage (Stage): The stage to run.
+        processor: A SageMaker processor, e.g. a ScriptProcessor.
+        input_sources (dict): Maps each input name to its S3 URI or pipeline property.
+        output_destinations (dict): Maps each output name to its S3 URI.
+        code (str): The entry point of the job, this file by default.
+        cache_expire_after (str): ISO 8601 duration of the SageMaker step cache.
+        **step_kwargs: Other ProcessingStep arguments, such as `depends_on`.
+
+    Returns:
+        ProcessingStep: The step, cached by SageMaker while its inputs, its arguments
+        and therefore the code hash of the stage do not change.
+    """
+    from sagemaker.processing import ProcessingInput, ProcessingOutput
+    from sagemaker.workflow.steps import CacheConfig, ProcessingStep
+
+    arguments = [
+        "run-stage",
+        function_reference(stage.function),
+        "--code-hash",
+        code_hash(stage),
+        "--params",
+        json.dumps(stage.params, sort_keys=True),
+    ]
+    processing_inputs = []
+    for name, local_path in stage.inputs.items():
+        processing_inputs.append(
+            ProcessingInput(
+                input_name=name,
+                source=input_sources[name],
+                destination=os.path.join(PROCESSING_INPUT_DIR, name),
+            )
+        )
+        arguments += ["--input", f"{name}={_container_path(PROCESSING_INPUT_DIR, name, local_path)}"]
+    processing_outputs = []
+    for name, local_path in stage.outputs.items():
+        processing_outputs.append(
+            ProcessingOutput(
+                output_name=name,
+                source=os.path.join(PROCESSING_OUTPUT_DIR, name),
+                destination=output_destinations[name],
+            )
+        )
+        arguments += ["--output", f"{name}={_container_path(PROCESSING_OUTPUT_DIR, name, local_path)}"]
+
+    return ProcessingStep(
+        name=stage.name,
+        processor=processor,
+        inputs=processing_inputs,
+        outputs=processing_outputs,
+        job_arguments=arguments,
+        code=code,
+        cache_config=CacheConfig(enable_caching=True, expire_after=cache_expire_after),
+        **step_kwargs,
+    )
+
+
+def _parse_mapping(values):
+    mapping = {}
+    for value in values or []:
+        name, separator, path = value.partition("=")
+        if not separator:
+            raise ValueError(f"Expected name=path, got {value}")
+        mapping[name] = path
+    return mapping
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_stage = subparsers.add_parser("run-stage", help="Run one stage function, e.g. in a processing job.")
+    run_stage.add_argument("function", help="module:function of the stage")
+    run_stage.add_argument("--input", action="append", help="name=path of an input")
+    run_stage.add_argument("--output", action="append", help="name=path of an output")
+    run_stage.add_argument("--params", default="{}", help="JSON keyword arguments of the function")
+    # Only part of the arguments so the SageMaker step cache changes with the code.
+    run_stage.add_argument("--code-hash", default="")
+    args = parser.parse_args(argv)
+
+    seconds = _run_stage_function(
+        args.function, _parse_mapping(args.input), _parse_mapping(args.output), json.loads(args.params)
+    )
+    logger.info(f"{args.function} finished in {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,257 @@
+"""Textract layout analysis with a cache keyed by the sha256 of the PDF bytes.
+
+Cache hits are read back from S3 or a local directory. Cache misses are uploaded
+and submitted as asynchronous Textract jobs, many at once, and all running jobs
+are polled together. A PDF is analyzed again only when its bytes change.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# Textract errors meaning "too many requests right now", the call is made again later.
+RETRYABLE_ERROR_CODES = {
+    "LimitExceededException",
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+}
+
+
+def _is_retryable(error):
+    return error.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+
+
+def sha256_of_file(file_path, chunk_size=1024 * 1024):
+    """Hash the content of a file without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalTextractCache:
+    """Textract responses stored as `<sha256>.textract.json` in a local directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.textract.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, response):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(response, f)
+        os.replace(tmp_path, self._path(key))
+
+
+class S3TextractCache:
+    """Textract responses stored as `s3://<bucket>/<prefix>/<sha256>.textract.json`."""
+
+    def __init__(self, s3_client, bucket_name, prefix="textract_cache"):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}.textract.json"
+
+    def get(self, key):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(response["Body"].read())
+
+    def put(self, key, response):
+        self.s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=self._key(key),
+            Body=json.dumps(response),
+        )
+
+
+class TextractAnalysisStage:
+    """Run Textract document analysis on many PDFs, reusing cached results.
+
+    Args:
+        textract_client: A boto3 Textract client.
+        s3_client: A boto3 S3 client used to upload the PDFs to analyze.
+        upload_bucket (str): Bucket where PDFs are uploaded for Textract.
+        cache: A LocalTextractCache or S3TextractCache.
+        upload_prefix (str): Prefix of the uploaded PDFs, which are named by their sha256.
+        features (list): Textract FeatureTypes to request.
+        max_in_flight (int): Maximum number of Textract jobs running at once.
+        poll_interval (float): Seconds to wait between polling rounds.
+        timeout (float): Seconds after which jobs still running are reported as failed.
+        max_poll_interval (float): Longest wait between polling rounds while Textract
+            throttles the polling.
+    """
+
+    def __init__(
+        self,
+        textract_client,
+        s3_client,
+        upload_bucket,
+        cache,
+        upload_prefix="input_documents",
+        features=("LAYOUT",),
+        max_in_flight=20,
+        poll_interval=5.0,
+        timeout=1800.0,
+        max_poll_interval=60.0,
+    ):
+        self.textract_client = textract_client
+        self.s3_client = s3_client
+        self.upload_bucket = upload_bucket
+        self.cache = cache
+        self.upload_prefix = upload_prefix.strip("/")
+        self.features = list(features)
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_poll_interval = max_poll_interval
+
+    def _upload(self, file_path, key):
+        s3_key = f"{self.upload_prefix}/{key}.pdf"
+        try:
+            self.s3_client.head_object(Bucket=self.upload_bucket, Key=s3_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+            self.s3_client.upload_file(file_path, self.upload_bucket, s3_key)
+        return s3_key
+
+    def _start(self, s3_key):
+        response = self.textract_client.start_document_analysis(
+            DocumentLocation={"S3Object": {"Bucket": self.upload_bucket, "Name": s3_key}},
+            FeatureTypes=self.features,
+        )
+        return response["JobId"]
+
+    def _get_page(self, job_id, next_token):
+        """Get a page of the results of a finished job, backing off while throttled."""
+        delay = self.poll_interval
+        while True:
+            try:
+                return self.textract_client.get_document_analysis(
+                    JobId=job_id, NextToken=next_token
+                )
+            except ClientError as e:
+                if not _is_retryable(e):
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+
+    def _collect(self, job_id, first_page):
+        """Merge the paginated results of a finished job into a single response."""
+        response = dict(first_page)
+        blocks = list(first_page.get("Blocks", []))
+        next_token = first_page.get("NextToken")
+        while next_token:
+            page = self._get_page(job_id, next_token)
+            blocks.extend(page.get("Blocks", []))
+            next_token = page.get("NextToken")
+        response.pop("NextToken", None)
+        response.pop("ResponseMetadata", None)
+        response["Blocks"] = blocks
+        return response
+
+    def analyze(self, file_paths):
+        """Analyze the PDFs and return a dict mapping each file path to its Textract response.
+
+        Raises:
+            RuntimeError: If some jobs failed. Finished jobs are cached, so running
+                again only resubmits the failed documents.
+        """
+        results = {}
+        # The same bytes under different paths are analyzed once.
+        paths_by_key = {}
+        for file_path in file_paths:
+            key = sha256_of_file(file_path)
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[file_path] = cached
+            else:
+                paths_by_key.setdefault(key, []).append(file_path)
+
+        logger.info(
+            "Textract cache: %s hits, %s documents to analyze",
+            len(results),
+            len(paths_by_key),
+        )
+
+        queued = list(paths_by_key.items())
+        running = {}  # job_id -> (key, start time)
+        failed = {}
+        poll_interval = self.poll_interval
+        while queued or running:
+            # Fill the free slots with queued documents.
+            while queued and len(running) < self.max_in_flight:
+                key, paths = queued[0]
+                try:
+                    job_id = self._start(self._upload(paths[0], key))
+                except ClientError as e:
+                    if _is_retryable(e):
+                        break
+                    failed[key] = e
+                    queued.pop(0)
+                    continue
+                queued.pop(0)
+                running[job_id] = (key, time.monotonic())
+
+            if running or queued:
+                time.sleep(poll_interval)
+
+            throttled = False
+            for job_id, (key, started_at) in list(running.items()):
+                try:
+                    first_page = self.textract_client.get_document_analysis(JobId=job_id)
+                except ClientError as e:
+                    if not _is_retryable(e):
+                        raise
+                    # The jobs left are still running, they are polled in the next round.
+                    throttled = True
+                    break
+                status = first_page["JobStatus"]
+                if status == "IN_PROGRESS":
+                    if time.monotonic() - started_at > self.timeout:
+                        failed[key] = TimeoutError(f"Textract job {job_id} timed out")
+                        del running[job_id]
+                    continue
+                del running[job_id]
+                if status in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+                    response = self._collect(job_id, first_page)
+                    self.cache.put(key, response)
+                    for file_path in paths_by_key[key]:
+                        results[file_path] = response
+                else:
+                    failed[key] = RuntimeError(
+                        f"Textract job {job_id} {status}: {first_page.get('StatusMessage')}"
+                    )
+            # Back off while Textract throttles the polling.
+            poll_interval = (
+                min(poll_interval * 2, self.max_poll_interval) if throttled else self.poll_interval
+            )
+
+        if failed:
+            failed_paths = [path for key in failed for path in paths_by_key[key]]
+            raise RuntimeError(f"Textract analysis failed for {failed_paths}: {failed}")
+        return results
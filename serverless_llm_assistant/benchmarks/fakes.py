@@ -0,0 +1,221 @@
+"""In-process stand-ins for the AWS clients the Lambda handlers create at import time.
+
+The Bedrock runtime fake answers the Converse and InvokeModel calls made by
+ChatBedrockConverse and BedrockEmbeddings after a configurable latency. Its chat
+answers follow the prompts of the assistant: the agent calls AnalyticsQA once then
+answers, the SQL chain gets a valid query on `extracted_entities`, and the basic
+chatbot gets a markdown answer.
+"""
+import hashlib
+import io
+import json
+import math
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+EMBEDDING_DIMENSIONS = 1024
+
+
+class _Meta:
+    def __init__(self, region_name):
+        self.region_name = region_name
+
+
+def _sleep(latency, jitter):
+    if latency > 0:
+        time.sleep(max(latency * (1 + random.uniform(-jitter, jitter)), 0))
+
+
+class FakeBedrockRuntime:
+    """Fake `bedrock-runtime` client.
+
+    Args:
+        chat_latency (float): Seconds before the first token of a chat call.
+        seconds_per_output_token (float): Extra seconds per generated token.
+        embedding_latency (float): Seconds per embedding call.
+        jitter (float): Relative random variation of every latency.
+        throttle_rate (float): Share of chat calls failing with a ThrottlingException.
+    """
+
+    def __init__(
+        self,
+        chat_latency=0.5,
+        seconds_per_output_token=0.005,
+        embedding_latency=0.05,
+        jitter=0.1,
+        throttle_rate=0.0,
+        region_name="us-east-1",
+    ):
+        self.chat_latency = chat_latency
+        self.seconds_per_output_token = seconds_per_output_token
+        self.embedding_latency = embedding_latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.meta = _Meta(region_name)
+        self.calls = {"converse": 0, "throttled": 0, "embeddings": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] += 1
+
+    # ------------------------------------------------------------------ chat
+
+    @staticmethod
+    def _prompt_text(system, messages):
+        parts = [block.get("text", "") for block in system or []]
+        for message in messages:
+            parts.extend(block.get("text", "") for block in message.get("content", []))
+        return "\n".join(parts)
+
+    @staticmethod
+    def _answer(prompt):
+        if "syntactically correct" in prompt:
+            return "SELECT company, year, source_doc FROM extracted_entities LIMIT 5"
+        if "Available tools" in prompt:
+            # The scratchpad, after the user input, holds the observations of previous steps.
+            if "<observation>" in prompt.split("</user_input>")[-1]:
+                return (
+                    "<final_answer>Based on the query results, there are 5 matching"
+                    " documents in the database.</final_answer>"
+                )
+            return (
+                "<thinking>The question is an aggregate over the CV data.</thinking>"
+                "<tool>AnalyticsQA</tool><tool_input>How many documents are in the"
+                " database?</tool_input>"
+            )
+        if "<observation>" in prompt:
+            return "<final_answer>There are 5 matching documents in the database.</final_answer>"
+        if "<markdown>" in prompt or "markdown xml tags" in prompt:
+            return "<markdown>Hello! How can I help you today?</markdown>"
+        return "The CV mentions 3 projects, including a machine learning project."
+
+    @staticmethod
+    def _apply_stop_sequences(text, inference_config):
+        # Bedrock ends the generation at a stop sequence and does not return it.
+        cut = len(text)
+        for stop in (inference_config or {}).get("stopSequences", []):
+            position = text.find(stop)
+            if position != -1:
+                cut = min(cut, position)
+        return text[:cut]
+
+    def _generate(self, modelId, messages, system=None, inferenceConfig=None):
+        self._count("converse")
+        if random.random() < self.throttle_rate:
+            self._count("throttled")
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "Converse"
+            )
+        prompt = self._prompt_text(system, messages)
+        text = self._apply_stop_sequences(self._answer(prompt), inferenceConfig)
+        usage = {
+            "inputTokens": max(len(prompt) // 4, 1),
+            "outputTokens": max(len(text) // 4, 1),
+        }
+        usage["totalTokens"] = usage["inputTokens"] + usage["outputTokens"]
+        return text, usage
+
+    def converse(self, modelId, messages, system=None, inferenceConfig=None, **kwargs):
+        start_time = time.perf_counter()
+        text, usage = self._generate(modelId, messages, system, inferenceConfig)
+        _sleep(self.chat_latency + usage["outputTokens"] * self.seconds_per_output_token, self.jitter)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+            "stopReason": "end_turn",
+            "usage": usage,
+            "metrics": {"latencyMs": int((time.perf_counter() - start_time) * 1000)},
+            "ResponseMetadata": {"HTTPStatusCode": 200},
+        }
+
+    def converse_stream(self, modelId, messages, system=None, inferenceConfig=None, **kwargs):
+        start_time = time.perf_counter()
+        text, usage = self._generate(modelId, messages, system, inferenceConfig)
+
+        def events():
+            _sleep(self.chat_latency, self.jitter)
+            yield {"messageStart": {"role": "assistant"}}
+            # Stream about 4 characters per token.
+            for start in range(0, len(text), 16):
+                _sleep(4 * self.seconds_per_output_token, self.jitter)
+                yield {
+                    "contentBlockDelta": {
+                        "delta": {"text": text[start:start + 16]},
+                        "contentBlockIndex": 0,
+                    }
+                }
+            yield {"contentBlockStop": {"contentBlockIndex": 0}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {
+                "metadata": {
+                    "usage": usage,
+                    "metrics": {"latencyMs": int((time.perf_counter() - start_time) * 1000)},
+                }
+            }
+
+        return {"stream": events(), "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    # ------------------------------------------------------------ embeddings
+
+    @staticmethod
+    def embed(text, dimensions=EMBEDDING_DIMENSIONS):
+        """Deterministic normalized bag of words embedding."""
+        vector = [0.0] * dimensions
+        for word in text.lower().split():
+            digest = hashlib.md5(word.strip(".,;:!?()").encode("utf-8")).digest()
+            vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def invoke_model(self, body, modelId, accept="application/json", contentType="application/json", **kwargs):
+        self._count("embeddings")
+        request = json.loads(body)
+        _sleep(self.embedding_latency, self.jitter)
+        embedding = self.embed(request.get("inputText", ""), request.get("dimensions", EMBEDDING_DIMENSIONS))
+        payload = {"embedding": embedding, "inputTextTokenCount": len(request.get("inputText", "")) // 4}
+        return {"body": io.BytesIO(json.dumps(payload).encode("utf-8")), "contentType": "application/json"}
+
+
+class FakeSSM:
+    def __init__(self, parameters):
+        self.parameters = dict(parameters)
+
+    def get_parameter(self, Name, **kwargs):
+        if Name not in self.parameters:
+            raise ClientError({"Error": {"Code": "ParameterNotFound", "Message": Name}}, "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+
+class FakeSecretsManager:
+    def __init__(self, secret):
+        self.secret = secret
+
+    def get_secret_value(self, SecretId, **kwargs):
+        return {"SecretString": json.dumps(self.secret)}
+
+
+class FakeS3:
+    def __init__(self, latency=0.02, jitter=0.1):
+        self.latency = latency
+        self.jitter = jitter
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        _sleep(self.latency, self.jitter)
+        with self._lock:
+            self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {"ETag": hashlib.md5(self.objects[(Bucket, Key)]).hexdigest()}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        _sleep(self.latency, self.jitter)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+        body = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            body = body[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(body)}
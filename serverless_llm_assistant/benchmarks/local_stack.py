@@ -0,0 +1,258 @@
+"""Point the Lambda handlers at local stand-ins of the AWS stack.
+
+`install` must run before a handler module is imported: the handlers read their
+configuration and create their clients at import time. SSM, Secrets Manager, S3 and
+the Bedrock runtime are replaced in-process by the fakes of `benchmarks.fakes`.
+DynamoDB and Postgres are real local services, DynamoDB Local and Postgres with the
+pgvector extension, so the history, SQL and vector search costs stay representative.
+"""
+import importlib.util
+import json
+import os
+import sys
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import boto3
+
+from .fakes import FakeBedrockRuntime, FakeS3, FakeSecretsManager, FakeSSM
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+LAMBDA_FUNCTIONS_DIR = REPO_ROOT / "serverless_llm_assistant" / "lib" / "lambda-functions"
+DATA_DIR = REPO_ROOT / "data_pipelines" / "data"
+
+HANDLER_DIRECTORIES = {
+    "single": LAMBDA_FUNCTIONS_DIR / "agent-executor-single",
+    "api": LAMBDA_FUNCTIONS_DIR / "agent-executor-api",
+}
+
+BEDROCK_REGION_PARAMETER = "/benchmark/bedrock_region"
+LLM_MODEL_ID_PARAMETER = "/benchmark/llm_model_id"
+# Read by agent-executor-api at import time.
+AGENT_DATA_BUCKET_PARAMETER = "/AgenticLLMAssistantWorkshop/AgentDataBucketParameter"
+
+
+@dataclass
+class LocalStack:
+    postgres_host: str = os.environ.get("BENCHMARK_POSTGRES_HOST", "localhost")
+    postgres_port: int = int(os.environ.get("BENCHMARK_POSTGRES_PORT", "5432"))
+    postgres_database: str = os.environ.get("BENCHMARK_POSTGRES_DB", "postgres")
+    postgres_user: str = os.environ.get("BENCHMARK_POSTGRES_USER", "postgres")
+    postgres_password: str = os.environ.get("BENCHMARK_POSTGRES_PASSWORD", "postgres")
+    dynamodb_endpoint: str = os.environ.get("BENCHMARK_DYNAMODB_ENDPOINT", "http://localhost:8000")
+    chat_message_history_table: str = "BenchmarkChatMessageHistory"
+    bucket_name: str = "benchmark-agent-data"
+    region: str = "us-east-1"
+    # Admission control limits, in Bedrock calls. The defaults keep admission control
+    # out of the measurements, lower them to benchmark the 429s and degraded answers.
+    session_request_burst: float = float(os.environ.get("BENCHMARK_SESSION_REQUEST_BURST", "1000000"))
+    session_request_rate: float = float(os.environ.get("BENCHMARK_SESSION_REQUEST_RATE", "1000000"))
+    global_request_burst: float = float(os.environ.get("BENCHMARK_GLOBAL_REQUEST_BURST", "1000000"))
+    global_request_rate: float = float(os.environ.get("BENCHMARK_GLOBAL_REQUEST_RATE", "1000000"))
+    bedrock: FakeBedrockRuntime = field(default_factory=FakeBedrockRuntime)
+    s3: FakeS3 = field(default_factory=FakeS3)
+
+    @property
+    def db_secret(self):
+        return {
+            "host": self.postgres_host,
+            "port": self.postgres_port,
+            "dbname": self.postgres_database,
+            "username": self.postgres_user,
+            "password": self.postgres_password,
+        }
+
+    @property
+    def sqlalchemy_url(self):
+        return (
+            f"postgresql+psycopg://{self.postgres_user}:{self.postgres_password}"
+            f"@{self.postgres_host}:{self.postgres_port}/{self.postgres_database}"
+        )
+
+
+def install(stack, metrics_sample_rate=0.0):
+    """Set the environment and route boto3 clients to the local stack."""
+    os.environ.update(
+        {
+            "BEDROCK_REGION_PARAMETER": BEDROCK_REGION_PARAMETER,
+            "LLM_MODEL_ID_PARAMETER": LLM_MODEL_ID_PARAMETER,
+            "CHAT_MESSAGE_HISTORY_TABLE": stack.chat_message_history_table,
+            "AGENT_DB_SECRET_ID": "benchmark-agent-db-secret",
+            "AWS_DEFAULT_REGION": stack.region,
+            "AWS_ACCESS_KEY_ID": os.environ.get("AWS_ACCESS_KEY_ID", "benchmark"),
+            "AWS_SECRET_ACCESS_KEY": os.environ.get("AWS_SECRET_ACCESS_KEY", "benchmark"),
+            # Read by botocore for every DynamoDB client and resource.
+            "AWS_ENDPOINT_URL_DYNAMODB": stack.dynamodb_endpoint,
+            "METRICS_SAMPLE_RATE": str(metrics_sample_rate),
+            # Token buckets in memory, with the limits of the stack.
+            "ADMISSION_CONTROL_TABLE": "",
+            "SESSION_REQUEST_BURST": str(stack.session_request_burst),
+            "SESSION_REQUEST_RATE": str(stack.session_request_rate),
+            "GLOBAL_REQUEST_BURST": str(stack.global_request_burst),
+            "GLOBAL_REQUEST_RATE": str(stack.global_request_rate),
+        }
+    )
+
+    fake_clients = {
+        "bedrock-runtime": stack.bedrock,
+        "ssm": FakeSSM(
+            {
+                BEDROCK_REGION_PARAMETER: stack.region,
+                LLM_MODEL_ID_PARAMETER: "amazon.nova-lite-v1:0",
+                AGENT_DATA_BUCKET_PARAMETER: stack.bucket_name,
+            }
+        ),
+        "secretsmanager": FakeSecretsManager(stack.db_secret),
+        "s3": stack.s3,
+    }
+    boto3_client = boto3.client
+
+    def client(service_name, *args, **kwargs):
+        if service_name in fake_clients:
+            return fake_clients[service_name]
+        return boto3_client(service_name, *args, **kwargs)
+
+    boto3.client = client
+
+
+def load_handler(target):
+    """Import the handler module of `target` ("single" or "api") under its own name."""
+    directory = HANDLER_DIRECTORIES[target]
+    # agent-executor-single imports its `assistant` package relative to the function root.
+    sys.path.insert(0, str(directory))
+    spec = importlib.util.spec_from_file_location(f"benchmark_{target}_handler", directory / "handler.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _create_chat_history_table(stack):
+    dynamodb = boto3.resource("dynamodb", region_name=stack.region)
+    existing = [table.name for table in dynamodb.tables.all()]
+    if stack.chat_message_history_table in existing:
+        return
+    dynamodb.create_table(
+        TableName=stack.chat_message_history_table,
+        KeySchema=[{"AttributeName": "SessionId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "SessionId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    ).wait_until_exists()
+
+
+def _page_chunks(documents_processed, chunk_size=1000):
+    for document in documents_processed:
+        for page in document["pages"]:
+            text = page["page_text"]
+            for start in range(0, len(text), chunk_size):
+                yield text[start:start + chunk_size], {
+                    "file_name": document["name"],
+                    "source": document["source_location"],
+                    "company": document["metadata"]["company"],
+                    "year": document["metadata"]["year"],
+                    "page_number": page["page"],
+                }
+
+
+def _seed_embeddings():
+    from langchain_core.embeddings import Embeddings
+
+    class SeedEmbeddings(Embeddings):
+        """The fake Bedrock embeddings without the simulated latency."""
+
+        def embed_documents(self, texts):
+            return [FakeBedrockRuntime.embed(text) for text in texts]
+
+        def embed_query(self, text):
+            return FakeBedrockRuntime.embed(text)
+
+    return SeedEmbeddings()
+
+
+def seed_tables(stack):
+    """Create the DynamoDB table and the SQL tables, loading `extracted_entities.csv`.
+
+    Runs before the assistant config is imported, since the config inspects
+    `extracted_entities` when it is imported.
+    """
+    import pandas as pd
+    import psycopg
+    import sqlalchemy
+
+    _create_chat_history_table(stack)
+
+    with psycopg.connect(
+        host=stack.postgres_host,
+        port=stack.postgres_port,
+        dbname=stack.postgres_database,
+        user=stack.postgres_user,
+        password=stack.postgres_password,
+        autocommit=True,
+    ) as connection:
+        connection.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_documents (
+                id TEXT PRIMARY KEY,
+                job TEXT,
+                year INTEGER,
+                file_name TEXT,
+                doc_url TEXT,
+                status INTEGER,
+                session_id TEXT
+            )
+            """
+        )
+
+    engine = sqlalchemy.create_engine(stack.sqlalchemy_url)
+    entities = pd.read_csv(DATA_DIR / "extracted_entities.csv", index_col=0)
+    entities.to_sql("extracted_entities", engine, if_exists="replace", index=False)
+    return len(entities)
+
+
+def seed_vector_store(stack, collection_names):
+    """Embed the pages of `documents_processed.json` into every collection."""
+    from langchain_postgres import PGVector
+
+    with open(DATA_DIR / "documents_processed.json", "r") as f:
+        documents_processed = json.load(f)
+    texts, metadatas = zip(*_page_chunks(documents_processed))
+    for collection_name in collection_names:
+        PGVector(
+            embeddings=_seed_embeddings(),
+            collection_name=collection_name,
+            connection=stack.sqlalchemy_url,
+            pre_delete_collection=True,
+        ).add_texts(list(texts), metadatas=list(metadatas))
+    return len(texts)
+
+
+def register_uploads(stack, session_ids, file_name):
+    """Record `file_name` as uploaded by every session, chatcv only reads the uploads of a session.
+
+    The uploads point at the source location of the document of `documents_processed.json`
+    with that name, chatcv reads the chunks of an upload by its source location.
+    """
+    import psycopg
+
+    with open(DATA_DIR / "documents_processed.json", "r") as f:
+        source_locations = [
+            document["source_location"] for document in json.load(f) if document["name"] == file_name
+        ]
+    if len(source_locations) != 1:
+        raise ValueError(f"{len(source_locations)} documents are named {file_name}, expected one")
+
+    with psycopg.connect(
+        host=stack.postgres_host,
+        port=stack.postgres_port,
+        dbname=stack.postgres_database,
+        user=stack.postgres_user,
+        password=stack.postgres_password,
+        autocommit=True,
+    ) as connection:
+        for session_id in session_ids:
+            connection.execute(
+                "INSERT INTO upload_documents (id, job, year, file_name, doc_url, status, session_id)"
+                " VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (str(uuid.uuid4()), "benchmark", 2024, file_name, source_locations[0], 1, session_id),
+            )
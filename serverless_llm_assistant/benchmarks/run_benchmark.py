@@ -0,0 +1,339 @@
+"""Benchmark the Lambda handlers in-process against the local stack.
+
+Cold starts are measured in fresh subprocesses: module import plus the first request.
+Warm requests run in one process after a warm-up request, `--concurrency` at a time.
+The report gives the p50/p95/p99 latency of both, the warm throughput and the peak
+resident memory.
+
+Usage, from the `serverless_llm_assistant` directory:
+
+    python -m benchmarks.run_benchmark --seed
+    python -m benchmarks.run_benchmark --chatbot-types basic agentic rag chatcv api \\
+        --requests 50 --concurrency 4 --cold-runs 3 --output benchmark.json
+"""
+import argparse
+import base64
+import json
+import math
+import resource
+import subprocess
+import sys
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .fakes import FakeBedrockRuntime
+from .local_stack import (
+    HANDLER_DIRECTORIES,
+    LocalStack,
+    install,
+    load_handler,
+    register_uploads,
+    seed_tables,
+    seed_vector_store,
+)
+
+CHATBOT_TYPES = ["basic", "agentic", "rag", "chatcv"]
+# The upload handler of agent-executor-api.
+API_TARGET = "api"
+ERROR_RESPONSE_PREFIX = "Unable to respond"
+
+SAMPLE_CV = """
+Nguyen Van A - Software Engineer
+Education: Bachelor of Computer Science, Hanoi University of Science and Technology, GPA 3.6.
+Experience: 3 years as a backend engineer working with Python, AWS and Docker.
+Projects: a machine learning project for CV ranking, a mobile application for food delivery,
+and a data pipeline processing 10 million events per day.
+"""
+
+# Smallest valid PDF, the upload handler only checks the type and size.
+SAMPLE_PDF = (
+    b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n%%EOF"
+)
+
+
+class FakeLambdaContext:
+    def __init__(self, timeout_seconds=120):
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+def session_id_for(run_id, index, sessions):
+    return f"benchmark-{run_id}-{index % sessions}"
+
+
+def register_chatcv_reference(args, chatbot_type, run_id, sessions):
+    """Make the chatcv reference an upload of every session of the run."""
+    if chatbot_type == "chatcv" and args.chatcv_reference:
+        register_uploads(
+            make_stack(args),
+            [session_id_for(run_id, index, sessions) for index in range(sessions)],
+            args.chatcv_reference,
+        )
+
+
+def make_event(chatbot_type, run_id, index, sessions, chatcv_reference=None):
+    session_id = session_id_for(run_id, index, sessions)
+    if chatbot_type == API_TARGET:
+        return {
+            "session_id": session_id,
+            "files": [
+                {
+                    "fileName": f"benchmark-{run_id}-{index}.pdf",
+                    "fileType": "application/pdf",
+                    "fileContent": base64.b64encode(SAMPLE_PDF).decode("utf-8"),
+                    "category": "benchmark",
+                }
+            ],
+        }
+    event = {"session_id": session_id, "chatbot_type": chatbot_type}
+    if chatbot_type == "basic":
+        event["user_input"] = "Hello, what can you help me with?"
+    elif chatbot_type == "agentic":
+        event["user_input"] = "How many CVs have a GPA above 3.5?"
+    elif chatbot_type == "rag":
+        event["user_input"] = "Which candidates worked on machine learning projects?"
+        event["querry_k"] = 5
+    elif chatbot_type == "chatcv":
+        event["user_input"] = "How many projects does the candidate mention?"
+        if chatcv_reference:
+            event["file_name"] = chatcv_reference
+        else:
+            event["page_content"] = SAMPLE_CV
+    return event
+
+
+def outcome_of(chatbot_type, result):
+    """Classify a response as "ok", "error", "rejected" (429) or "degraded" by admission control."""
+    if chatbot_type == API_TARGET:
+        return "ok" if result.get("statusCode") == 200 else "error"
+    if result.get("statusCode") == 429:
+        return "rejected"
+    if result.get("statusCode") != 200 or str(result.get("response", "")).startswith(ERROR_RESPONSE_PREFIX):
+        return "error"
+    if result.get("degraded_to"):
+        return "degraded"
+    return "ok"
+
+
+def count_outcomes(outcomes):
+    return {
+        "errors": outcomes.count("error"),
+        "rejected": outcomes.count("rejected"),
+        "degraded": outcomes.count("degraded"),
+    }
+
+
+def percentile(values, q):
+    """Nearest rank percentile of a non empty list."""
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies_ms):
+    if not latencies_ms:
+        return {}
+    return {
+        "count": len(latencies_ms),
+        "p50_ms": round(percentile(latencies_ms, 50), 1),
+        "p95_ms": round(percentile(latencies_ms, 95), 1),
+        "p99_ms": round(percentile(latencies_ms, 99), 1),
+        "max_ms": round(max(latencies_ms), 1),
+    }
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def make_stack(args):
+    return LocalStack(
+        bedrock=FakeBedrockRuntime(
+            chat_latency=args.chat_latency,
+            seconds_per_output_token=args.seconds_per_output_token,
+            embedding_latency=args.embedding_latency,
+            throttle_rate=args.throttle_rate,
+        )
+    )
+
+
+def target_of(chatbot_type):
+    return API_TARGET if chatbot_type == API_TARGET else "single"
+
+
+def invoke(handler, chatbot_type, event, timeout_seconds):
+    start_time = time.perf_counter()
+    try:
+        result = handler.lambda_handler(event, FakeLambdaContext(timeout_seconds))
+        outcome = outcome_of(chatbot_type, result)
+    except Exception:
+        traceback.print_exc()
+        outcome = "error"
+    return (time.perf_counter() - start_time) * 1000, outcome
+
+
+def cold_worker(args):
+    """Measure one cold start in this fresh process and print it as JSON."""
+    install(make_stack(args), metrics_sample_rate=args.metrics_sample_rate)
+    chatbot_type = args.cold_worker
+    start_time = time.perf_counter()
+    handler = load_handler(target_of(chatbot_type))
+    init_ms = (time.perf_counter() - start_time) * 1000
+    run_id = uuid.uuid4().hex[:8]
+    register_chatcv_reference(args, chatbot_type, run_id, 1)
+    event = make_event(chatbot_type, run_id, 0, 1, args.chatcv_reference)
+    first_request_ms, outcome = invoke(handler, chatbot_type, event, args.timeout)
+    print(
+        json.dumps(
+            {
+                "init_ms": init_ms,
+                "first_request_ms": first_request_ms,
+                "outcome": outcome,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+    )
+
+
+def run_cold(args, chatbot_type):
+    init_ms, totals_ms, rss_mb, outcomes = [], [], [], []
+    for _ in range(args.cold_runs):
+        command = [sys.executable, "-m", "benchmarks.run_benchmark", "--cold-worker", chatbot_type]
+        command += forwarded_arguments(args)
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        # The handlers log to stdout too, the measurement is the last line.
+        sample = json.loads(completed.stdout.strip().splitlines()[-1])
+        init_ms.append(sample["init_ms"])
+        totals_ms.append(sample["init_ms"] + sample["first_request_ms"])
+        rss_mb.append(sample["peak_rss_mb"])
+        outcomes.append(sample["outcome"])
+    return {
+        "init": summarize(init_ms),
+        "init_plus_first_request": summarize(totals_ms),
+        **count_outcomes(outcomes),
+        "peak_rss_mb": max(rss_mb) if rss_mb else None,
+    }
+
+
+def run_warm(args, handlers, chatbot_type):
+    handler = handlers[target_of(chatbot_type)]
+    run_id = uuid.uuid4().hex[:8]
+    register_chatcv_reference(args, chatbot_type, run_id, args.sessions)
+    # Warm-up request, out of the measurements.
+    invoke(
+        handler,
+        chatbot_type,
+        make_event(chatbot_type, run_id, 0, args.sessions, args.chatcv_reference),
+        args.timeout,
+    )
+
+    events = [
+        make_event(chatbot_type, run_id, index, args.sessions, args.chatcv_reference)
+        for index in range(args.requests)
+    ]
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(
+            executor.map(lambda event: invoke(handler, chatbot_type, event, args.timeout), events)
+        )
+    wall_time = time.perf_counter() - start_time
+    latencies_ms = [latency for latency, _ in results]
+    return {
+        **summarize(latencies_ms),
+        **count_outcomes([outcome for _, outcome in results]),
+        "throughput_rps": round(len(results) / wall_time, 2),
+        "concurrency": args.concurrency,
+    }
+
+
+def forwarded_arguments(args):
+    return [
+        "--chat-latency", str(args.chat_latency),
+        "--seconds-per-output-token", str(args.seconds_per_output_token),
+        "--embedding-latency", str(args.embedding_latency),
+        "--throttle-rate", str(args.throttle_rate),
+        "--metrics-sample-rate", str(args.metrics_sample_rate),
+        "--timeout", str(args.timeout),
+    ] + (["--chatcv-reference", args.chatcv_reference] if args.chatcv_reference else [])
+
+
+def seed(args):
+    stack = make_stack(args)
+    install(stack)
+    entities = seed_tables(stack)
+    # The collection names come from the assistant config, imported once the tables exist.
+    sys.path.insert(0, str(HANDLER_DIRECTORIES["single"]))
+    from assistant.config import AgenticAssistantConfig
+
+    chunks = seed_vector_store(stack, AgenticAssistantConfig.rag_collection_names)
+    print(f"Seeded {entities} entity rows and {chunks} chunks per collection.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chatbot-types", nargs="+", default=CHATBOT_TYPES + [API_TARGET],
+                        choices=CHATBOT_TYPES + [API_TARGET])
+    parser.add_argument("--requests", type=int, default=50, help="Warm requests per chatbot type.")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--sessions", type=int, default=8, help="Distinct chat sessions per run.")
+    parser.add_argument("--cold-runs", type=int, default=3, help="Cold start subprocesses per chatbot type.")
+    parser.add_argument("--chat-latency", type=float, default=0.5)
+    parser.add_argument("--seconds-per-output-token", type=float, default=0.005)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Share of chat calls the fake Bedrock runtime throttles.")
+    parser.add_argument("--metrics-sample-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=120, help="Simulated Lambda timeout in seconds.")
+    parser.add_argument("--chatcv-reference",
+                        help="Send chatcv requests with this file name instead of the CV content.")
+    parser.add_argument("--seed", action="store_true", help="Create and load the local tables, then exit.")
+    parser.add_argument("--output", help="Also write the report to this JSON file.")
+    parser.add_argument("--cold-worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args)
+        return
+    if args.cold_worker:
+        cold_worker(args)
+        return
+
+    report = {"cold": {}, "warm": {}}
+    for chatbot_type in args.chatbot_types:
+        if args.cold_runs:
+            report["cold"][chatbot_type] = run_cold(args, chatbot_type)
+
+    stack = make_stack(args)
+    install(stack, metrics_sample_rate=args.metrics_sample_rate)
+    handlers = {}
+    for target in sorted({target_of(chatbot_type) for chatbot_type in args.chatbot_types}):
+        handlers[target] = load_handler(target)
+    for chatbot_type in args.chatbot_types:
+        report["warm"][chatbot_type] = run_warm(args, handlers, chatbot_type)
+
+    report["bedrock_calls"] = stack.bedrock.calls
+    # Imported by the handlers, counts which path answered each chat model call.
+    from assistant.models import invocation_stats
+
+    report["model_invocations"] = dict(invocation_stats)
+    report["peak_rss_mb"] = {
+        "warm_process": peak_rss_mb(),
+        "cold_processes": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
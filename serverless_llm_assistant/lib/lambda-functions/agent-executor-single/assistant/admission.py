@@ -0,0 +1,329 @@
+"""Admission control of the requests, before they spend any Bedrock quota.
+
+Every request takes tokens from two token buckets: one per session, limiting the burst
+of a single user, and one shared by all the requests, sized below the Bedrock quota of
+the account. A request costs about as many tokens as the model calls it can make, so an
+agentic request costs more than a basic one.
+
+The buckets live in DynamoDB, shared by all the Lambda containers, and each take is a
+single conditional UpdateItem, see `DynamoDBTokenBucketStore`. The session bucket is
+checked first, so a user over their own budget does not touch the global bucket.
+`InMemoryTokenBucketStore` is a per-container stand-in for tests and local runs.
+
+When a bucket is empty the request:
+
+- waits for the tokens if they come back within `max_queue_seconds`;
+- otherwise runs in a cheaper mode if it has one, e.g. an agentic request returns the
+  `rag` search results without an LLM answer;
+- otherwise is rejected with the seconds after which to retry.
+
+If the store cannot be reached, or a bucket is too contended to read its level, the
+request is admitted, the limiter must not take the assistant down with it.
+"""
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from .instrumentation import current_trace
+
+logger = logging.getLogger(__name__)
+
+ADMIT = "admit"
+DEGRADE = "degrade"
+REJECT = "reject"
+
+GLOBAL_BUCKET = "global"
+
+# Tokens of a request, about the number of Bedrock calls it can make.
+REQUEST_COSTS = {
+    "agentic": 6.0,
+    "basic": 1.0,
+    "chatcv": 1.0,
+    "rag": 1.0,
+}
+DEFAULT_REQUEST_COST = 1.0
+
+# Cheaper mode of a request when its budget is exhausted.
+DEGRADED_MODES = {
+    "agentic": "rag",
+}
+
+# Buckets left untouched this long are removed by the DynamoDB TTL.
+BUCKET_TTL_SECONDS = 24 * 3600
+
+
+def _refill(tokens, updated_at, now, capacity, refill_rate):
+    if tokens is None:
+        return capacity
+    return min(capacity, tokens + max(0.0, now - updated_at) * refill_rate)
+
+
+def _wait_seconds(tokens, cost, refill_rate):
+    if refill_rate <= 0:
+        return math.inf
+    return (cost - tokens) / refill_rate
+
+
+class InMemoryTokenBucketStore:
+    """Token buckets held by the current process."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key, cost, capacity, refill_rate):
+        """Take `cost` tokens from the bucket `key`.
+
+        Returns:
+            tuple: (True, 0.0) when the tokens were taken, else (False, the seconds
+            until the bucket holds them).
+        """
+        with self._lock:
+            now = self.clock()
+            tokens, updated_at = self._buckets.get(key, (None, now))
+            tokens = _refill(tokens, updated_at, now, capacity, refill_rate)
+            if tokens < cost:
+                return False, _wait_seconds(tokens, cost, refill_rate)
+            self._buckets[key] = (tokens - cost, now)
+            return True, 0.0
+
+    def release(self, key, cost, capacity, refill_rate):
+        """Give back tokens taken by a request that was not admitted after all."""
+        self.try_acquire(key, -cost, capacity, refill_rate)
+
+
+class BucketContendedError(RuntimeError):
+    """The bucket kept changing under the conditional updates, its level is unknown."""
+
+    def __init__(self, key):
+        super().__init__(f"Token bucket {key} is contended")
+        self.key = key
+
+
+class DynamoDBTokenBucketStore:
+    """Token buckets shared through a DynamoDB table with a `BucketKey` partition key.
+
+    A bucket is stored as `FullAt`, the time at which it is full again: it holds
+    `capacity - (FullAt - now) * refill_rate` tokens. Taking tokens moves `FullAt`
+    later, and a bucket with `FullAt` in the past is full. Each call is a single
+    conditional UpdateItem: `FullAt + interval` while the bucket is in use, or
+    `now + interval` once it refilled, picked from the last `FullAt` this container
+    saw. A failed condition returns the stored `FullAt`, which tells whether the
+    bucket is empty or the other update applies.
+
+    Args:
+        table_name (str): The admission control table.
+        client: A boto3 DynamoDB client.
+        max_attempts (int): Updates tried before reporting a contended bucket, the
+            second one only runs when the bucket refilled or emptied in between.
+        clock (callable): Wall clock, shared by all the containers.
+    """
+
+    def __init__(self, table_name, client=None, max_attempts=3, clock=time.time):
+        self.table_name = table_name
+        self.client = client or boto3.client("dynamodb")
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._last_full_at = {}
+
+    def _update(self, key, update_expression, condition_expression, values):
+        """Run a conditional update, returning whether it applied and the `FullAt` it left."""
+        try:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={"BucketKey": {"S": key}},
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeValues={name: {"N": repr(value)} for name, value in values.items()},
+                ReturnValues="UPDATED_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            applied, item = True, response.get("Attributes") or {}
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+                raise
+            applied, item = False, e.response.get("Item") or {}
+        full_at = float(item["FullAt"]["N"]) if "FullAt" in item else -math.inf
+        self._last_full_at[key] = full_at
+        return applied, full_at
+
+    def try_acquire(self, key, cost, capacity, refill_rate):
+        """Take `cost` tokens from the bucket `key`, see InMemoryTokenBucketStore.
+
+        Raises:
+            BucketContendedError: When the bucket changed under every attempt.
+        """
+        if refill_rate <= 0 or cost > capacity:
+            return False, math.inf
+        now = self.clock()
+        interval = cost / refill_rate
+        # Latest FullAt still leaving `cost` tokens in the bucket.
+        latest_full_at = now + (capacity - cost) / refill_rate
+        expires_at = int(now + BUCKET_TTL_SECONDS)
+        full_at = self._last_full_at.get(key, -math.inf)
+        for _ in range(self.max_attempts):
+            if full_at < now:
+                applied, full_at = self._update(
+                    key,
+                    "SET FullAt = :full_at, ExpiresAt = :expires_at",
+                    "attribute_not_exists(FullAt) OR FullAt < :now",
+                    {":full_at": now + interval, ":expires_at": expires_at, ":now": now},
+                )
+            else:
+                applied, full_at = self._update(
+                    key,
+                    "SET FullAt = FullAt + :interval, ExpiresAt = :expires_at",
+                    "FullAt BETWEEN :now AND :latest_full_at",
+                    {
+                        ":interval": interval,
+                        ":expires_at": expires_at,
+                        ":now": now,
+                        ":latest_full_at": latest_full_at,
+                    },
+                )
+            if applied:
+                return True, 0.0
+            if full_at > latest_full_at:
+                return False, full_at - latest_full_at
+        raise BucketContendedError(key)
+
+    def release(self, key, cost, capacity, refill_rate):
+        """Give back tokens with an unconditional update, which cannot be contended."""
+        if refill_rate <= 0:
+            return
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={"BucketKey": {"S": key}},
+            UpdateExpression="ADD FullAt :interval",
+            ExpressionAttributeValues={":interval": {"N": repr(-cost / refill_rate)}},
+        )
+
+
+@dataclass
+class BucketLimits:
+    """Burst size, in tokens, and sustained rate, in tokens per second, of a bucket."""
+
+    capacity: float
+    refill_rate: float
+
+
+@dataclass
+class AdmissionDecision:
+    action: str
+    mode: str
+    retry_after: float = 0.0
+    waited: float = 0.0
+    reason: str = ""
+
+
+class AdmissionController:
+    """Decide whether a request runs as asked, in a cheaper mode, or not at all.
+
+    Args:
+        store: An InMemoryTokenBucketStore or DynamoDBTokenBucketStore.
+        session_limits (BucketLimits): Limits of the bucket of each session.
+        global_limits (BucketLimits): Limits of the bucket shared by all the sessions.
+        max_queue_seconds (float): Longest wait for tokens before degrading or rejecting.
+    """
+
+    def __init__(self, store, session_limits, global_limits, max_queue_seconds=2.0):
+        self.store = store
+        self.session_limits = session_limits
+        self.global_limits = global_limits
+        self.max_queue_seconds = max_queue_seconds
+
+    def _try_acquire(self, session_id, cost):
+        """Take `cost` from both buckets, returning (granted, wait seconds, empty bucket)."""
+        session_bucket = f"session#{session_id}"
+        granted, wait_seconds = self.store.try_acquire(
+            session_bucket, cost, self.session_limits.capacity, self.session_limits.refill_rate
+        )
+        if not granted:
+            return False, wait_seconds, "session"
+        # A contended global bucket admits the request, which keeps its session tokens.
+        granted, wait_seconds = self.store.try_acquire(
+            GLOBAL_BUCKET, cost, self.global_limits.capacity, self.global_limits.refill_rate
+        )
+        if not granted:
+            self.store.release(
+                session_bucket, cost, self.session_limits.capacity, self.session_limits.refill_rate
+            )
+            return False, wait_seconds, GLOBAL_BUCKET
+        return True, 0.0, None
+
+    def admit(self, session_id, mode, deadline=None):
+        """Admit a request of `mode`, waiting at most until `deadline` (a `time.monotonic()` value)."""
+        started_at = time.monotonic()
+        try:
+            decision = self._admit(session_id, mode, deadline, started_at)
+        except BucketContendedError as e:
+            logger.warning(f"{e}, admitting the request")
+            decision = AdmissionDecision(ADMIT, mode, reason="bucket_contended")
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f"Admission control unavailable, admitting the request: {e!r}")
+            decision = AdmissionDecision(ADMIT, mode, reason="store_unavailable")
+        decision.waited = time.monotonic() - started_at
+
+        trace = current_trace()
+        if trace is not None:
+            trace.record(
+                "admission",
+                decision.waited * 1000,
+                action=decision.action,
+                mode=decision.mode,
+                reason=decision.reason,
+            )
+        if decision.action != ADMIT:
+            logger.warning(
+                f"Request of session {session_id} in {mode} mode: {decision.action} ({decision.reason})"
+            )
+        return decision
+
+    def _admit(self, session_id, mode, deadline, started_at):
+        cost = REQUEST_COSTS.get(mode, DEFAULT_REQUEST_COST)
+        queue_until = started_at + self.max_queue_seconds
+        if deadline is not None:
+            queue_until = min(queue_until, deadline)
+
+        while True:
+            granted, wait_seconds, empty_bucket = self._try_acquire(session_id, cost)
+            if granted:
+                return AdmissionDecision(ADMIT, mode)
+            if time.monotonic() + wait_seconds > queue_until:
+                break
+            time.sleep(wait_seconds)
+
+        degraded_mode = DEGRADED_MODES.get(mode)
+        if degraded_mode is not None:
+            degraded_cost = REQUEST_COSTS.get(degraded_mode, DEFAULT_REQUEST_COST)
+            granted, degraded_wait_seconds, _ = self._try_acquire(session_id, degraded_cost)
+            if granted:
+                return AdmissionDecision(DEGRADE, degraded_mode, reason=f"{empty_bucket}_budget")
+            wait_seconds = min(wait_seconds, degraded_wait_seconds)
+
+        return AdmissionDecision(
+            REJECT,
+            mode,
+            retry_after=math.ceil(max(wait_seconds, 1.0)) if math.isfinite(wait_seconds) else 60,
+            reason=f"{empty_bucket}_budget",
+        )
+
+
+def get_admission_controller(config):
+    """Build the admission controller from the admission settings of the config."""
+    if config.admission_control_table:
+        store = DynamoDBTokenBucketStore(config.admission_control_table)
+    else:
+        store = InMemoryTokenBucketStore()
+    return AdmissionController(
+        store,
+        session_limits=BucketLimits(config.session_request_burst, config.session_request_rate),
+        global_limits=BucketLimits(config.global_request_burst, config.global_request_rate),
+        max_queue_seconds=config.admission_max_queue_seconds,
+    )
@@ -4,52 +4,284 @@
 # https://python.langchain.com/docs/modules/agents/tools/custom_tools
 # and (https://github.com/langchain-ai/langchain/blob/master/libs/
 #      langchain/langchain/chains/llm_math/base.py#L82)
+#
+# Expressions are evaluated over NumPy arrays, so they can reference the columns of
+# the AnalyticsQA results of the request, e.g. `mean(result_1.revenue)` or
+# `result_1.company[result_1.revenue > 1e9]`, and compute over whole columns at once.
 
+import ast
 import math
+import operator
 from typing import Optional, Type
 
+import numpy as np
 from langchain.callbacks.manager import (AsyncCallbackManagerForToolRun,
                                          CallbackManagerForToolRun)
 from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
 
+from .results import TabularResult, current_result_store
+
+MAX_EXPRESSION_LENGTH = 1000
+# Values of an array result written back to the LLM.
+MAX_OUTPUT_VALUES = 50
+
 
 class CalculatorInput(BaseModel):
     question: str = Field()
 
 
-def _evaluate_expression(expression: str) -> str:
-    import numexpr  # noqa: F401
+def _count(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return int(np.count_nonzero(~np.isnan(values)))
+    if values.dtype.kind == "O":
+        return int(sum(value is not None for value in values.ravel()))
+    return int(values.size)
 
-    try:
-        local_dict = {"pi": math.pi, "e": math.e}
-        output = str(
-            numexpr.evaluate(
-                expression.strip(),
-                global_dict={},  # restrict access to globals
-                local_dict=local_dict,  # add common mathematical functions
-            )
+
+def _rank(values):
+    """Rank of each value, 1 for the largest, NaN values last."""
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(np.where(np.isnan(values), np.inf, -values), kind="stable")
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.arange(1, len(values) + 1)
+    return ranks
+
+
+def _top(labels, values, k=5):
+    """The k labels with the largest values, with their value."""
+    labels = np.asarray(labels)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(np.where(np.isnan(values), np.inf, -values), kind="stable")[: int(k)]
+    return [(labels[index], values[index]) for index in order]
+
+
+FUNCTIONS = {
+    "mean": np.nanmean,
+    "sum": np.nansum,
+    "min": np.nanmin,
+    "max": np.nanmax,
+    "median": np.nanmedian,
+    "std": np.nanstd,
+    "var": np.nanvar,
+    "percentile": np.nanpercentile,
+    "count": _count,
+    "len": len,
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "log10": np.log10,
+    "exp": np.exp,
+    "round": np.round,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "cumsum": np.nancumsum,
+    "sort": np.sort,
+    "unique": np.unique,
+    "where": np.where,
+    "rank": _rank,
+    "top": _top,
+}
+
+CONSTANTS = {"pi": math.pi, "e": math.e, "nan": math.nan, "inf": math.inf}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    # Powers are computed on float64, so their size is bounded whatever the base and
+    # the exponent, e.g. (9 ** 999) ** 999 overflows to inf instead of building an
+    # unbounded integer.
+    ast.Pow: lambda base, exponent: np.power(
+        np.asarray(base, dtype=np.float64), np.asarray(exponent, dtype=np.float64)
+    ),
+    # & and | combine boolean filters.
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+}
+
+UNARY_OPERATORS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: np.logical_not,
+    ast.Invert: np.logical_not,
+}
+
+COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+class _Evaluator:
+    """Evaluate a parsed expression, allowing only arithmetic, comparisons,
+    the FUNCTIONS and the columns of the stored results."""
+
+    def __init__(self, result_store=None):
+        self.result_store = result_store
+
+    def evaluate(self, node):
+        method = getattr(self, f"_{type(node).__name__}", None)
+        if method is None:
+            raise ValueError(f"{type(node).__name__} is not supported in expressions")
+        return method(node)
+
+    def _Expression(self, node):
+        return self.evaluate(node.body)
+
+    def _Constant(self, node):
+        if not isinstance(node.value, (int, float, str, bool)):
+            raise ValueError(f"Unsupported constant {node.value!r}")
+        return node.value
+
+    def _Name(self, node):
+        if node.id in CONSTANTS:
+            return CONSTANTS[node.id]
+        if self.result_store is not None and node.id in self.result_store.results:
+            return self.result_store.get(node.id)
+        raise ValueError(f"Unknown name {node.id}")
+
+    def _Attribute(self, node):
+        value = self.evaluate(node.value)
+        if not isinstance(value, TabularResult):
+            raise ValueError(f"Only result columns can be accessed with '.', not {node.attr}")
+        return value.column(node.attr)
+
+    def _Subscript(self, node):
+        value = self.evaluate(node.value)
+        index = self.evaluate(node.slice)
+        if isinstance(value, TabularResult):
+            return value.column(index)
+        if isinstance(index, list):
+            index = np.asarray(index)
+        return np.asarray(value)[index]
+
+    def _Slice(self, node):
+        return slice(
+            *(self.evaluate(part) if part is not None else None for part in (node.lower, node.upper, node.step))
+        )
+
+    def _List(self, node):
+        return [self.evaluate(element) for element in node.elts]
+
+    _Tuple = _List
+
+    def _BinOp(self, node):
+        operator_function = BINARY_OPERATORS.get(type(node.op))
+        if operator_function is None:
+            raise ValueError(f"Operator {type(node.op).__name__} is not supported")
+        left, right = self.evaluate(node.left), self.evaluate(node.right)
+        if isinstance(left, str) or isinstance(right, str):
+            raise ValueError("Text can only be compared, not used in arithmetic")
+        return operator_function(_operand(left), _operand(right))
+
+    def _UnaryOp(self, node):
+        return UNARY_OPERATORS[type(node.op)](_operand(self.evaluate(node.operand)))
+
+    def _BoolOp(self, node):
+        values = [_operand(self.evaluate(value)) for value in node.values]
+        combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+        result = values[0]
+        for value in values[1:]:
+            result = combine(result, value)
+        return result
+
+    def _Compare(self, node):
+        left = _operand(self.evaluate(node.left))
+        result = True
+        for comparison, right_node in zip(node.ops, node.comparators):
+            right = _operand(self.evaluate(right_node))
+            result = np.logical_and(result, COMPARISON_OPERATORS[type(comparison)](left, right))
+            left = right
+        return result
+
+    def _Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            name = node.func.id if isinstance(node.func, ast.Name) else ast.unparse(node.func)
+            raise ValueError(f"Unknown function {name}, the functions are {sorted(FUNCTIONS)}")
+        args = [_operand(self.evaluate(arg)) for arg in node.args]
+        kwargs = {keyword.arg: _operand(self.evaluate(keyword.value)) for keyword in node.keywords}
+        return FUNCTIONS[node.func.id](*args, **kwargs)
+
+
+def _operand(value):
+    if isinstance(value, TabularResult):
+        raise ValueError(f"Use a column of {value.handle}, such as {value.handle}.{next(iter(value.columns), 'column')}")
+    if isinstance(value, list):
+        return np.asarray(value)
+    return value
+
+
+def _format_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return f"{value:.10g}"
+    return str(value)
+
+
+def _format_output(value):
+    if isinstance(value, TabularResult):
+        return value.preview()
+    if isinstance(value, np.ndarray) and value.ndim == 0:
+        value = value.item()
+    if isinstance(value, (np.ndarray, list, tuple)):
+        values = list(value)
+        text = ", ".join(
+            "(" + ", ".join(_format_value(part) for part in item) + ")" if isinstance(item, tuple) else _format_value(item)
+            for item in values[:MAX_OUTPUT_VALUES]
         )
+        if len(values) > MAX_OUTPUT_VALUES:
+            text += f", ... ({len(values)} values)"
+        return f"[{text}]"
+    return _format_value(value)
+
+
+def _evaluate_expression(expression: str, result_store=None) -> str:
+    expression = expression.strip()
+    try:
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            raise ValueError(f"Expressions are limited to {MAX_EXPRESSION_LENGTH} characters")
+        tree = ast.parse(expression, mode="eval")
+        with np.errstate(all="ignore"):
+            output = _Evaluator(result_store).evaluate(tree)
     except Exception as e:
         raise ValueError(
-            f'LLMMathChain._evaluate("{expression}") raised error: {e}.'
+            f'Calculator._evaluate("{expression}") raised error: {e}.'
             " Please try again with a valid numerical expression"
         )
 
-    return output.strip()
+    return _format_output(output).strip()
 
 
 class CustomCalculatorTool(BaseTool):
-    name = "Calculator"
-    description = "useful for when you need to answer questions about math"
+    name: str = "Calculator"
+    description: str = (
+        "Use this tool for math, and for computations over the results of AnalyticsQA."
+        " The input is one expression, such as '(10 + 20) * 5', 'mean(result_1.revenue)',"
+        " 'max(result_1.revenue) / min(result_1.revenue)', 'top(result_1.company, result_1.revenue, 3)'"
+        " or 'result_1.company[result_1.year == 2022]'."
+        f" Available functions: {', '.join(sorted(FUNCTIONS))}."
+    )
     args_schema: Type[BaseModel] = CalculatorInput
 
     def _run(
-        self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None
+        self, question: str, run_manager: Optional[CallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool."""
         try:
-            return _evaluate_expression(query.strip())
+            return _evaluate_expression(question.strip(), current_result_store())
         except Exception as e:
             return (
                 f"Failed to evaluate the expression with error {e}."
@@ -57,7 +289,7 @@ class CustomCalculatorTool(BaseTool):
             )
 
     async def _arun(
-        self, query: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None
+        self, question: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None
     ) -> str:
         """Use the tool asynchronously."""
-        raise NotImplementedError("Calculator does not support async")
\ No newline at end of file
+        raise NotImplementedError("Calculator does not support async")
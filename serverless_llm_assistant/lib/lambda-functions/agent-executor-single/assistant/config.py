@@ -13,7 +13,12 @@ ssm = boto3.client("ssm")
 secretsmanager_client = boto3.client("secretsmanager")
 
 # TODO: put in parameter store and read with a default factory in the dataclass
-SQL_TABLE_NAMES = ["extracted_entities"]
+# The summary tables are pre-aggregated from extracted_entities by the SQL table loader.
+SQL_TABLE_NAMES = [
+    "extracted_entities_by_company",
+    "extracted_entities_by_year",
+    "extracted_entities",
+]
 
 @dataclass
 class AgenticAssistantConfig:
@@ -27,8 +32,59 @@ class AgenticAssistantConfig:
     # llm_model_id:str ="us.anthropic.claude-3-5-haiku-20241022-v1:0"
 
     chat_message_history_table_name: str = os.environ["CHAT_MESSAGE_HISTORY_TABLE"]
+    agent_data_bucket_name: str = ssm.get_parameter(
+        Name=os.environ.get(
+            "AGENT_DATA_BUCKET_PARAMETER",
+            "/AgenticLLMAssistantWorkshop/AgentDataBucketParameter",
+        )
+    )["Parameter"]["Value"]
+    # processed documents written by the document extraction pipeline.
+    processed_documents_key: str = "documents_processed.jsonl.gz"
+    # token budget of the CV in the chatcv prompt.
+    cv_max_prompt_tokens: int = int(os.environ.get("CV_MAX_PROMPT_TOKENS", "6000"))
     agent_db_secret_id: str = os.environ.get("AGENT_DB_SECRET_ID", "NOSECRET")
 
+    # chat model of every chain, the models tried in order when it is throttled, and
+    # the model, possibly in another region, receiving a copy of slow requests.
+    chat_model_id: str = os.environ.get("CHAT_MODEL_ID", "amazon.nova-lite-v1:0")
+    chat_fallback_model_ids: tuple = tuple(
+        model_id.strip()
+        for model_id in os.environ.get(
+            "CHAT_FALLBACK_MODEL_IDS", "us.amazon.nova-lite-v1:0,amazon.nova-micro-v1:0"
+        ).split(",")
+        if model_id.strip()
+    )
+    chat_hedge_model_id: str = os.environ.get("CHAT_HEDGE_MODEL_ID", "us.amazon.nova-lite-v1:0")
+    chat_hedge_region: str = os.environ.get("CHAT_HEDGE_REGION", "")
+    # seconds: deadline of a chat model call, and wait before hedging it.
+    llm_timeout: float = float(os.environ.get("LLM_TIMEOUT", "30"))
+    llm_hedge_delay: float = float(os.environ.get("LLM_HEDGE_DELAY", "4"))
+    # seconds: kept before the Lambda timeout to return the response, and kept by
+    # the agent to write a final answer when it is stopped early.
+    lambda_response_margin: float = float(os.environ.get("LAMBDA_RESPONSE_MARGIN", "2"))
+    agent_final_answer_reserve: float = float(os.environ.get("AGENT_FINAL_ANSWER_RESERVE", "6"))
+
+    # DynamoDB table of the admission control token buckets, kept in memory by each
+    # container when empty. The buckets count Bedrock calls: burst size and calls per
+    # second of each session and of all the sessions together, and seconds a request
+    # may wait for its tokens before being degraded or rejected. A session may send five
+    # agentic requests in a row, then one every six seconds, faster than anyone chats.
+    admission_control_table: str = os.environ.get("ADMISSION_CONTROL_TABLE", "")
+    session_request_burst: float = float(os.environ.get("SESSION_REQUEST_BURST", "30"))
+    session_request_rate: float = float(os.environ.get("SESSION_REQUEST_RATE", "1"))
+    global_request_burst: float = float(os.environ.get("GLOBAL_REQUEST_BURST", "60"))
+    global_request_rate: float = float(os.environ.get("GLOBAL_REQUEST_RATE", "5"))
+    admission_max_queue_seconds: float = float(os.environ.get("ADMISSION_MAX_QUEUE_SECONDS", "2"))
+
+    # similarity of the best route, and lead over the second one, for the intent
+    # router to call a tool directly instead of running the agent.
+    router_min_score: float = float(os.environ.get("ROUTER_MIN_SCORE", "0.55"))
+    router_min_margin: float = float(os.environ.get("ROUTER_MIN_MARGIN", "0.05"))
+    # key of the route centroids in the agent data bucket, computed by the first container.
+    router_centroids_key: str = os.environ.get(
+        "ROUTER_CENTROIDS_KEY", "intent_router/centroids.json"
+    )
+
     if agent_db_secret_id != "NOSECRET":
         _db_secret_string = secretsmanager_client.get_secret_value(
             SecretId=agent_db_secret_id
@@ -45,6 +101,11 @@ class AgenticAssistantConfig:
         )
 
         collection_name: str = "agentic_assistant_vector_store_part_2"
+        # collections searched together by the federated retriever.
+        rag_collection_names: tuple = (
+            "agentic_assistant_lv_160",
+            collection_name,
+        )
         embedding_model_id: str = "amazon.titan-embed-text-v2:0"
 
         sqlalchemy_connection_url: str = sqlalchemy.URL.create(
@@ -68,10 +129,18 @@ class AgenticAssistantConfig:
             )
         except ValueError as e:
             if "include_tables" in str(e):
-                print(f"Warning: Table {SQL_TABLE_NAMES[0]} not found in the database. Proceeding without including this table.")
+                # e.g. the summary tables are created by the next SQL table load.
+                _inspector = sqlalchemy.inspect(sql_engine)
+                _available_tables, _missing_tables = [], []
+                for _table_name in SQL_TABLE_NAMES:
+                    if _inspector.has_table(_table_name):
+                        _available_tables.append(_table_name)
+                    else:
+                        _missing_tables.append(_table_name)
+                print(f"Warning: Tables {_missing_tables} not found in the database. Proceeding without including these tables.")
                 entities_db = SQLDatabase(
                     engine=sql_engine,
-                    include_tables=[],  # Include all tables
+                    include_tables=_available_tables,  # All tables when empty
                     sample_rows_in_table_info=num_sql_table_sample_rows,
                 )
             else:
@@ -0,0 +1,310 @@
+"""Agent executor keeping the agent loop within the time left to the Lambda invocation.
+
+`DeadlineAwareAgentExecutor` runs the same loop as `AgentExecutor` with a deadline,
+usually derived from `context.get_remaining_time_in_millis()`. Before each step it
+compares the time left with the expected duration of the step, learned from the
+previous LLM and tool calls of the container:
+
+- a tool call that cannot finish in time is skipped, and a running tool call is cut
+  at the time left, its observation saying so;
+- the LLM call of a step must end before the final answer reserve, see
+  `models.call_deadline`, else the agent is stopped;
+- when the time left only covers the final answer, or the iterations are exhausted,
+  the agent is stopped and a final answer is written from the observations gathered
+  so far, in a single LLM call.
+
+The outputs hold `partial`, True when the answer was forced, and `stop_reason`.
+"""
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.agents import AgentExecutor
+from langchain.agents.format_scratchpad import format_xml
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+from langchain_core.prompts import ChatPromptTemplate
+
+from .instrumentation import current_trace
+from .models import DeadlineExceededError, call_deadline
+from .utils import XMLTagStreamParser, get_chunk_text
+
+logger = logging.getLogger(__name__)
+
+FINISHED = "finished"
+DEADLINE = "deadline"
+ITERATION_LIMIT = "iteration_limit"
+
+LLM_STEP = "llm"
+# Expected durations, in seconds, before the first call of a step was measured.
+DEFAULT_LLM_STEP_SECONDS = 4.0
+DEFAULT_TOOL_SECONDS = 5.0
+# Tool calls are not worth starting with less time than this.
+MIN_TOOL_SECONDS = 1.0
+# Characters of each observation listed by the answer written without the LLM.
+MAX_FALLBACK_OBSERVATION_CHARS = 500
+
+# Tool calls run here so they can be abandoned at the deadline.
+_tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-tool")
+# Seconds spent in tools by the current step, to measure the LLM part of the step.
+_step_timing = threading.local()
+
+
+class StepLatencyEstimator:
+    """Exponentially weighted moving average of the duration of each kind of step.
+
+    Args:
+        alpha (float): Weight of the last measurement.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._estimates = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            previous = self._estimates.get(key)
+            self._estimates[key] = (
+                seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+            )
+
+    def estimate(self, key, default):
+        with self._lock:
+            return self._estimates.get(key, default)
+
+
+# Shared by the requests of the container.
+step_latency = StepLatencyEstimator()
+
+
+forced_answer_system_message = """
+You are a helpful assistant. There is no time left to use tools.
+Answer the <user_input> using only the <observations> gathered so far and the <conversation_history>.
+If the observations are not enough to answer fully, give the best partial answer and say what is missing.
+Provide the answer in markdown within <final_answer></final_answer>.
+"""
+
+forced_answer_user_message = """
+Previous conversation history:
+<conversation_history>
+{chat_history}
+</conversation_history>
+
+User input message:
+<user_input>
+{input}
+</user_input>
+
+<observations>
+{observations}
+</observations>
+"""
+
+FORCED_ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", forced_answer_system_message),
+        ("human", forced_answer_user_message),
+    ]
+)
+
+
+def _fallback_answer(intermediate_steps):
+    """Answer without the LLM, listing the observations gathered so far."""
+    observations = []
+    for action, observation in intermediate_steps:
+        observation = " ".join(str(observation).split())
+        if not observation:
+            continue
+        if len(observation) > MAX_FALLBACK_OBSERVATION_CHARS:
+            observation = observation[:MAX_FALLBACK_OBSERVATION_CHARS].rstrip() + "..."
+        observations.append(f"- {action.tool}: {observation}")
+    if not observations:
+        return "Sorry, I could not answer in time. Please try again or ask a simpler question."
+    return "I could not finish in time. Here is what I found so far:\n" + "\n".join(observations)
+
+
+class DeadlineAwareAgentExecutor(AgentExecutor):
+    """`AgentExecutor` stopping in time to answer before `deadline`.
+
+    Args:
+        deadline (float): `time.monotonic()` value by which the answer must be returned,
+            None for no deadline.
+        llm: Chat model writing the forced final answer.
+        final_answer_reserve (float): Seconds kept for the forced final answer.
+    """
+
+    deadline: Optional[float] = None
+    llm: Any = None
+    final_answer_reserve: float = 6.0
+
+    @property
+    def output_keys(self) -> List[str]:
+        return super().output_keys + ["partial", "stop_reason"]
+
+    def _time_left(self):
+        if self.deadline is None:
+            return float("inf")
+        return self.deadline - time.monotonic()
+
+    def _step_budget(self):
+        """Seconds the agent steps can still use, the final answer reserve excluded."""
+        return self._time_left() - self.final_answer_reserve
+
+    def _step_deadline(self):
+        """`time.monotonic()` value by which a step must end, None for no deadline."""
+        if self.deadline is None:
+            return None
+        return self.deadline - self.final_answer_reserve
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        started_at = time.monotonic()
+        try:
+            return self._perform_timed_agent_action(
+                name_to_tool_map, color_mapping, agent_action, run_manager
+            )
+        finally:
+            _step_timing.tool_seconds = (
+                getattr(_step_timing, "tool_seconds", 0.0) + time.monotonic() - started_at
+            )
+
+    def _perform_timed_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager):
+        budget = self._step_budget()
+        expected = step_latency.estimate(agent_action.tool, DEFAULT_TOOL_SECONDS)
+        if budget < max(expected, MIN_TOOL_SECONDS):
+            logger.warning(f"Skipping {agent_action.tool}, {budget:.1f}s left for {expected:.1f}s expected")
+            return AgentStep(
+                action=agent_action,
+                observation=f"The {agent_action.tool} tool was skipped: not enough time left to run it.",
+            )
+        if budget == float("inf"):
+            return super()._perform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+
+        started_at = time.monotonic()
+        # A copy of the context keeps the tool call in the request trace.
+        future = _tool_executor.submit(
+            contextvars.copy_context().run,
+            super()._perform_agent_action,
+            name_to_tool_map,
+            color_mapping,
+            agent_action,
+            run_manager,
+        )
+        try:
+            step = future.result(timeout=budget)
+        except FutureTimeoutError:
+            # The call keeps running in its thread, its result is ignored.
+            logger.warning(f"{agent_action.tool} did not answer within {budget:.1f}s")
+            step_latency.observe(agent_action.tool, time.monotonic() - started_at)
+            return AgentStep(
+                action=agent_action,
+                observation=f"The {agent_action.tool} tool did not answer in time.",
+            )
+        step_latency.observe(agent_action.tool, time.monotonic() - started_at)
+        return step
+
+    def _force_final_answer(self, inputs, intermediate_steps, run_manager=None):
+        """Write the final answer from the observations gathered so far."""
+        time_left = self._time_left()
+        if self.llm is None or time_left <= 0:
+            return _fallback_answer(intermediate_steps)
+
+        memory_variables = self.memory.load_memory_variables({}) if self.memory is not None else {}
+        prompt_inputs = {
+            "chat_history": memory_variables.get("chat_history", ""),
+            "input": inputs["input"],
+            "observations": format_xml(intermediate_steps),
+        }
+        config = {"callbacks": run_manager.get_child()} if run_manager is not None else None
+        with call_deadline(self.deadline):
+            future = _tool_executor.submit(
+                contextvars.copy_context().run,
+                (FORCED_ANSWER_PROMPT | self.llm).invoke,
+                prompt_inputs,
+                config,
+            )
+        try:
+            response = future.result(timeout=None if time_left == float("inf") else time_left)
+        except Exception as e:
+            logger.warning(f"Forced final answer failed: {e!r}")
+            return _fallback_answer(intermediate_steps)
+
+        text = get_chunk_text(response)
+        parser = XMLTagStreamParser(tags=["final_answer"], terminal_tags=["final_answer"])
+        events = parser.feed(text) + parser.close()
+        return events[0][1] if events else text.strip()
+
+    def _finish(self, output, intermediate_steps, partial, stop_reason, started_at, run_manager=None):
+        if isinstance(output, AgentFinish):
+            output = AgentFinish(
+                return_values={**output.return_values, "partial": partial, "stop_reason": stop_reason},
+                log=output.log,
+            )
+        trace = current_trace()
+        if trace is not None:
+            trace.record(
+                "agent_loop",
+                (time.monotonic() - started_at) * 1000,
+                iterations=len(intermediate_steps),
+                partial=partial,
+                stop_reason=stop_reason,
+            )
+        return self._return(output, intermediate_steps, run_manager=run_manager)
+
+    def _call(self, inputs: Dict[str, str], run_manager=None) -> Dict[str, Any]:
+        name_to_tool_map = {tool.name: tool for tool in self.tools}
+        color_mapping = {tool.name: "green" for tool in self.tools}
+        intermediate_steps: List[Tuple[AgentAction, str]] = []
+        iterations = 0
+        time_elapsed = 0.0
+        start_time = time.time()
+        started_at = time.monotonic()
+        stop_reason = ITERATION_LIMIT
+        while self._should_continue(iterations, time_elapsed):
+            if self._step_budget() < step_latency.estimate(LLM_STEP, DEFAULT_LLM_STEP_SECONDS):
+                stop_reason = DEADLINE
+                break
+            step_started_at = time.monotonic()
+            _step_timing.tool_seconds = 0.0
+            try:
+                # The LLM call of the step gets the step budget as its deadline.
+                with call_deadline(self._step_deadline()):
+                    next_step_output = self._take_next_step(
+                        name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=run_manager
+                    )
+            except DeadlineExceededError:
+                stop_reason = DEADLINE
+                break
+            finally:
+                step_latency.observe(
+                    LLM_STEP, time.monotonic() - step_started_at - _step_timing.tool_seconds
+                )
+            if isinstance(next_step_output, AgentFinish):
+                return self._finish(
+                    next_step_output, intermediate_steps, False, FINISHED, started_at, run_manager
+                )
+
+            intermediate_steps.extend(next_step_output)
+            if len(next_step_output) == 1:
+                tool_return = self._get_tool_return(next_step_output[0])
+                if tool_return is not None:
+                    return self._finish(
+                        tool_return, intermediate_steps, False, FINISHED, started_at, run_manager
+                    )
+            iterations += 1
+            time_elapsed = time.time() - start_time
+
+        logger.warning(
+            f"Agent stopped ({stop_reason}) after {iterations} steps, {self._time_left():.1f}s left"
+        )
+        answer = self._force_final_answer(inputs, intermediate_steps, run_manager)
+        return self._finish(
+            AgentFinish(return_values={"output": answer}, log=answer),
+            intermediate_steps,
+            True,
+            stop_reason,
+            started_at,
+            run_manager,
+        )
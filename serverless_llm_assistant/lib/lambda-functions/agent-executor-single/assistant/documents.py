@@ -0,0 +1,315 @@
+"""Resolve a CV reference sent by the client into the text used by the chatcv prompt.
+
+The client sends an `upload_documents.id` or a file name instead of the whole CV. Either
+is looked up in `upload_documents` with the session id of the request, so a session only
+reads the documents it uploaded. The extracted pages are read from the processed
+documents in S3, the gzip JSON Lines file written by the document extraction pipeline,
+with a ranged GET using its index. Documents not processed yet fall back to their
+chunks in the vector store, selected by the source location of the upload rather than
+its file name, so uploads of the same name in other sessions are never mixed in. A
+file name matching several processed documents is rejected for the same reason.
+
+The text is packed to the prompt token budget once per document version and cached in
+an in-memory LRU, and compressed under /tmp, so the next turns of a CV conversation in
+the same container skip S3 and the packing. Cache keys hold the source location of the
+document and the ETag of the index, which changes whenever the documents are processed
+again, so a reprocessed document is not served from an old cache entry. Vector store
+entries are keyed by the `upload_documents.id` of the upload, a new upload of a file
+getting a new id.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import sqlalchemy
+from botocore.exceptions import ClientError
+
+from .instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+# Rough number of characters per token, used to pack the CV without a tokenizer.
+CHARS_PER_TOKEN = 4
+TRUNCATION_NOTE = "\n[The rest of the CV was truncated.]"
+# The index of the processed documents is reloaded at most this often.
+INDEX_REFRESH_SECONDS = 300
+
+
+class DocumentNotFoundError(Exception):
+    pass
+
+
+def pack_to_token_budget(pages, max_tokens):
+    """Join the pages, collapse whitespace and cut the text to about `max_tokens` tokens.
+
+    The text is cut at the last line break within the budget, so no line is split.
+    """
+    text = "\n\n".join(page.strip() for page in pages if page and page.strip())
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n\s*\n+", "\n\n", text)
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n", 0, max_chars - len(TRUNCATION_NOTE))
+    if cut <= 0:
+        cut = max_chars - len(TRUNCATION_NOTE)
+    return text[:cut].rstrip() + TRUNCATION_NOTE
+
+
+class DocumentResolver:
+    """Find, pack and cache the text of uploaded documents.
+
+    Args:
+        sql_engine: SQLAlchemy engine of the database with `upload_documents` and the vector store.
+        s3_client: A boto3 S3 client.
+        bucket_name (str): Bucket holding the processed documents.
+        processed_documents_key (str): Key of the processed documents gzip JSON Lines file.
+        collection_names (list): Vector store collections searched when the document
+            is not in the processed documents.
+        max_tokens (int): Token budget of the CV in the prompt.
+        cache_dir (str): Directory of the compressed cache, on /tmp in Lambda.
+        max_entries (int): Number of packed documents kept in memory.
+    """
+
+    def __init__(
+        self,
+        sql_engine,
+        s3_client,
+        bucket_name,
+        processed_documents_key="documents_processed.jsonl.gz",
+        collection_names=(),
+        max_tokens=6000,
+        cache_dir="/tmp/cv_documents",
+        max_entries=64,
+    ):
+        self.sql_engine = sql_engine
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.processed_documents_key = processed_documents_key
+        self.collection_names = list(collection_names)
+        self.max_tokens = max_tokens
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_etag = None
+        self._index_loaded_at = None
+        # (session id, upload_documents.id) -> (id, file name, doc_url), ids are never reused.
+        self._references = {}
+
+    # ----------------------------------------------------------- references
+
+    def _reference_for(self, session_id, document_id=None, file_name=None):
+        """Look the upload of the session up by `upload_documents.id` or file name.
+
+        Returns:
+            tuple: The `upload_documents.id`, file name and doc_url of the upload.
+
+        Raises:
+            DocumentNotFoundError: If the session did not upload such a document.
+        """
+        if document_id is not None:
+            cache_key = (session_id, str(document_id))
+            if cache_key in self._references:
+                return self._references[cache_key]
+            query = sqlalchemy.text(
+                "SELECT id, file_name, doc_url FROM upload_documents"
+                " WHERE id = :id AND session_id = :session_id"
+            )
+            parameters = {"id": str(document_id), "session_id": session_id}
+        else:
+            # The upload API keeps a single upload of a file name per session.
+            query = sqlalchemy.text(
+                "SELECT id, file_name, doc_url FROM upload_documents"
+                " WHERE file_name = :file_name AND session_id = :session_id"
+            )
+            parameters = {"file_name": file_name, "session_id": session_id}
+        with self.sql_engine.connect() as connection:
+            row = connection.execute(query, parameters).first()
+        if row is None:
+            raise DocumentNotFoundError(
+                f"No document {document_id if document_id is not None else file_name}"
+                " was uploaded in this session"
+            )
+        reference = (str(row[0]), row[1], row[2])
+        if document_id is not None:
+            self._references[cache_key] = reference
+        return reference
+
+    # --------------------------------------------------------------- caches
+
+    def _cache_path(self, cache_key):
+        key = hashlib.sha256(f"{cache_key}:{self.max_tokens}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.txt.gz")
+
+    def _get_cached(self, cache_key):
+        with self._lock:
+            if cache_key in self._lru:
+                self._lru.move_to_end(cache_key)
+                return self._lru[cache_key]
+        try:
+            with gzip.open(self._cache_path(cache_key), "rt", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(cache_key, text)
+        return text
+
+    def _remember(self, cache_key, text):
+        with self._lock:
+            self._lru[cache_key] = text
+            self._lru.move_to_end(cache_key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def _store(self, cache_key, text):
+        self._remember(cache_key, text)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path(cache_key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache {cache_key} on disk: {e}")
+
+    # -------------------------------------------------------------- sources
+
+    def _processed_documents_index(self):
+        stale = (
+            self._index_loaded_at is not None
+            and time.monotonic() - self._index_loaded_at > INDEX_REFRESH_SECONDS
+        )
+        if self._index is None or stale:
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=f"{self.processed_documents_key}.index.json"
+                )
+                self._index = json.loads(response["Body"].read())
+                self._index_etag = response.get("ETag", "").strip('"')
+            except ClientError as e:
+                logger.warning(f"Processed documents index unavailable: {e}")
+                self._index = {}
+                self._index_etag = None
+            self._index_loaded_at = time.monotonic()
+        return self._index
+
+    def _locate(self, file_name, doc_url):
+        """Return the source location and index entry of an upload, None if not processed.
+
+        The index is keyed by source location, matched against the S3 location of the
+        upload first, then against the file name when a single document has it.
+
+        Raises:
+            DocumentNotFoundError: If several processed documents have the file name,
+                since picking one of them may answer about another company's document.
+        """
+        index = self._processed_documents_index()
+        source_location = _s3_location(doc_url)
+        if source_location in index:
+            return source_location, index[source_location]
+        matches = [(location, entry) for location, entry in index.items() if entry["name"] == file_name]
+        if len(matches) > 1:
+            raise DocumentNotFoundError(
+                f"{len(matches)} processed documents are named {file_name}, the reference is ambiguous"
+            )
+        return matches[0] if matches else None
+
+    def _pages_from_s3(self, entry):
+        byte_range = f"bytes={entry['offset']}-{entry['offset'] + entry['length'] - 1}"
+        response = self.s3_client.get_object(
+            Bucket=self.bucket_name, Key=self.processed_documents_key, Range=byte_range
+        )
+        document = json.loads(gzip.decompress(response["Body"].read()))
+        return [
+            "\n".join([page["page_text"], *page.get("page_tables", [])])
+            for page in document["pages"]
+        ]
+
+    def _pages_from_vector_store(self, doc_url):
+        """Return the chunks of the upload at `doc_url`, None if it has none.
+
+        Chunks are matched on their source location, `source` for the uploads and
+        `document_source_location` for the documents loaded by notebook 04.
+        """
+        source_locations = sorted({doc_url, _s3_location(doc_url)})
+        query = sqlalchemy.text(
+            """
+            SELECT c.name, e.document
+            FROM langchain_pg_embedding e
+            JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+            WHERE c.name = ANY(:collection_names)
+            AND COALESCE(e.cmetadata->>'source', e.cmetadata->>'document_source_location')
+                = ANY(:source_locations)
+            ORDER BY c.name, (e.cmetadata->>'page_number')::int NULLS LAST, e.id
+            """
+        )
+        with self.sql_engine.connect() as connection:
+            rows = connection.execute(
+                query, {"collection_names": self.collection_names, "source_locations": source_locations}
+            ).all()
+        if not rows:
+            return None
+        # The same document can be loaded in several collections, one is enough.
+        first_collection = rows[0][0]
+        return [document for collection_name, document in rows if collection_name == first_collection]
+
+    # ---------------------------------------------------------------- public
+
+    def resolve(self, session_id, document_id=None, file_name=None):
+        """Return the CV text of a document uploaded in the session, packed to the token budget.
+
+        Raises:
+            DocumentNotFoundError: If the session did not upload the document, its file
+                name matches several processed documents or its extracted text is unknown.
+        """
+        if document_id is None and not file_name:
+            raise DocumentNotFoundError("A document_id or a file_name is required")
+        with timed("document_resolution") as record:
+            upload_id, file_name, doc_url = self._reference_for(session_id, document_id, file_name)
+            located = self._locate(file_name, doc_url)
+            if located is not None:
+                source_location, entry = located
+                cache_key = f"s3:{source_location}:{self._index_etag}:{entry['offset']}:{entry['length']}"
+            elif doc_url:
+                cache_key = f"vector_store:{upload_id}:{_s3_location(doc_url)}"
+            else:
+                raise DocumentNotFoundError(f"{file_name} is not processed and has no source location")
+            text = self._get_cached(cache_key)
+            if text is not None:
+                record["source"] = "cache"
+                return text
+
+            pages = None
+            if located is not None:
+                pages = self._pages_from_s3(located[1])
+                record["source"] = "s3"
+            if pages is None:
+                pages = self._pages_from_vector_store(doc_url)
+                record["source"] = "vector_store"
+            if pages is None:
+                raise DocumentNotFoundError(f"No extracted text found for {file_name}")
+
+            text = pack_to_token_budget(pages, self.max_tokens)
+            self._store(cache_key, text)
+            return text
+
+
+def _s3_location(doc_url):
+    """Return the s3:// location of an upload URL, e.g. https://<bucket>.s3.<region>.amazonaws.com/<key>."""
+    if not doc_url:
+        return None
+    url = urlparse(doc_url)
+    if url.scheme == "s3":
+        return doc_url
+    bucket_name = url.netloc.split(".s3", 1)[0]
+    return f"s3://{bucket_name}{url.path}"
@@ -0,0 +1,258 @@
+"""Per-request timing of the assistant phases, emitted as CloudWatch EMF log lines.
+
+A request is wrapped in `trace_request`, which holds the trace in a context variable.
+Phases are recorded with the `timed` context manager wherever they run (history load,
+embeddings, vector search, SQL execution) and LLM and tool calls are recorded by
+`InstrumentationCallbackHandler`, passed to the chains as a callback.
+
+The records of a trace are written when it ends, one JSON line per record in the
+CloudWatch embedded metric format, so CloudWatch extracts the metrics from the logs.
+Only a `sample_rate` share of the traces is recorded. Tests can swap the log sink for
+a `MemorySink` with `set_default_sink`.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ServerlessLLMAssistant")
+DEFAULT_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+
+# Record fields sent to CloudWatch as metrics, with their unit.
+METRIC_UNITS = {
+    "Latency": "Milliseconds",
+    "InputTokens": "Count",
+    "OutputTokens": "Count",
+}
+DIMENSIONS = ["ChatbotType", "Phase"]
+
+_current_trace = contextvars.ContextVar("assistant_trace", default=None)
+# Duration of the module initialization, reported by the first trace of the container.
+_init_duration_ms = None
+
+
+class EMFLogSink:
+    """Write records as CloudWatch embedded metric format JSON lines on stdout."""
+
+    def __init__(self, namespace=METRICS_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+
+    def emit(self, records):
+        stream = self.stream or sys.stdout
+        for record in records:
+            metrics = [
+                {"Name": name, "Unit": unit}
+                for name, unit in METRIC_UNITS.items()
+                if record.get(name) is not None
+            ]
+            document = {
+                "_aws": {
+                    "Timestamp": record["timestamp"],
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": self.namespace,
+                            "Dimensions": [DIMENSIONS],
+                            "Metrics": metrics,
+                        }
+                    ],
+                },
+                **{key: value for key, value in record.items() if key != "timestamp"},
+            }
+            # Lambda forwards stdout as is, a logger would prefix the line and break EMF parsing.
+            stream.write(json.dumps(document, default=str) + "\n")
+        stream.flush()
+
+
+class MemorySink:
+    """Keep the records in memory, for tests and local runs."""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, records):
+        self.records.extend(records)
+
+
+_default_sink = EMFLogSink()
+
+
+def set_default_sink(sink):
+    global _default_sink
+    _default_sink = sink
+
+
+class Trace:
+    """The records of one request."""
+
+    def __init__(self, trace_id, chatbot_type, sampled, sink):
+        self.trace_id = trace_id
+        self.chatbot_type = chatbot_type
+        self.sampled = sampled
+        self.sink = sink
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, phase, latency_ms=None, **properties):
+        if not self.sampled:
+            return
+        record = {
+            "timestamp": int(time.time() * 1000),
+            "trace_id": self.trace_id,
+            "ChatbotType": self.chatbot_type,
+            "Phase": phase,
+            "Latency": None if latency_ms is None else round(latency_ms, 2),
+            **properties,
+        }
+        with self._lock:
+            self.records.append(record)
+
+    def flush(self):
+        with self._lock:
+            records, self.records = self.records, []
+        if records:
+            try:
+                self.sink.emit(records)
+            except Exception as e:
+                # Metrics must never fail the request.
+                logger.warning(f"Failed to emit metrics: {e}")
+
+
+def mark_init_complete(init_started_at):
+    """Store the module initialization time, measured from `time.perf_counter()`."""
+    global _init_duration_ms
+    _init_duration_ms = (time.perf_counter() - init_started_at) * 1000
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(chatbot_type, trace_id=None, sample_rate=None, sink=None):
+    """Record the phases of a request and emit them when it ends.
+
+    Args:
+        chatbot_type (str): The chatbot type, used as a metric dimension.
+        trace_id (str): The request identifier, a new one is generated if missing.
+        sample_rate (float): Share of the requests recorded, defaults to METRICS_SAMPLE_RATE.
+        sink: Where records are written, defaults to the sink set with `set_default_sink`.
+    """
+    global _init_duration_ms
+    sample_rate = DEFAULT_SAMPLE_RATE if sample_rate is None else sample_rate
+    trace = Trace(
+        trace_id=trace_id or str(uuid.uuid4()),
+        chatbot_type=chatbot_type,
+        sampled=random.random() < sample_rate,
+        sink=sink or _default_sink,
+    )
+    cold_start = _init_duration_ms is not None
+    if cold_start:
+        trace.record("cold_start_init", _init_duration_ms)
+        _init_duration_ms = None
+
+    token = _current_trace.set(trace)
+    start_time = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        trace.record("request", (time.perf_counter() - start_time) * 1000, cold_start=cold_start)
+        _current_trace.reset(token)
+        trace.flush()
+
+
+@contextmanager
+def timed(phase, **properties):
+    """Record the duration of the block as `phase` in the current trace, if any.
+
+    The block can add properties to the record through the yielded dict.
+    """
+    trace = _current_trace.get()
+    extra = dict(properties)
+    start_time = time.perf_counter()
+    try:
+        yield extra
+    except Exception as e:
+        extra["error"] = type(e).__name__
+        raise
+    finally:
+        if trace is not None:
+            trace.record(phase, (time.perf_counter() - start_time) * 1000, **extra)
+
+
+def _token_usage(response):
+    """Return the input and output token counts of an LLMResult, when reported."""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("usage") or {}
+    return (
+        usage.get("input_tokens", usage.get("prompt_tokens")),
+        usage.get("output_tokens", usage.get("completion_tokens")),
+    )
+
+
+class InstrumentationCallbackHandler(BaseCallbackHandler):
+    """Record every LLM call and tool call of the chains it is passed to.
+
+    The trace is captured when the handler is created, since LangChain may call
+    the handler from worker threads that do not see the context variable.
+    """
+
+    def __init__(self, trace=None):
+        self.trace = trace or _current_trace.get()
+        self._runs = {}
+
+    def _start(self, run_id, **properties):
+        self._runs[run_id] = (time.perf_counter(), properties)
+
+    def _end(self, run_id, phase, **properties):
+        start_time, start_properties = self._runs.pop(run_id, (None, {}))
+        if self.trace is None or start_time is None:
+            return
+        self.trace.record(
+            phase, (time.perf_counter() - start_time) * 1000, **start_properties, **properties
+        )
+
+    @staticmethod
+    def _model_name(serialized, kwargs):
+        invocation_params = kwargs.get("invocation_params") or {}
+        return (
+            invocation_params.get("model")
+            or invocation_params.get("model_id")
+            or (serialized or {}).get("name")
+        )
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, model=self._model_name(serialized, kwargs))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, model=self._model_name(serialized, kwargs))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        input_tokens, output_tokens = _token_usage(response)
+        self._end(run_id, "llm_call", InputTokens=input_tokens, OutputTokens=output_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "llm_call", error=type(error).__name__)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, tool=(serialized or {}).get("name") or kwargs.get("name"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id, "tool_call")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "tool_call", error=type(error).__name__)
@@ -0,0 +1,357 @@
+"""Chat model invocation with a deadline, a hedged request and fallbacks on throttling.
+
+`ResilientChatModel` is a LangChain chat model wrapping an ordered list of models:
+the primary model first, then the fallbacks. A call runs the primary model and, if
+it has not answered after `hedge_delay` seconds, sends the same request to the hedge
+model (an alternate model or region) and keeps whichever answers first. A stream,
+as used by the agent, is hedged the same way on its first chunk, then relayed from
+the model that produced it. When a model is throttled or unavailable, the next model
+of the list is tried. The whole call must finish within `timeout` seconds, or by the deadline set with `call_deadline`
+when it is sooner, e.g. the time left to an agent step.
+
+Every model request runs on its own daemon thread. A request abandoned at the
+deadline, or beaten by its hedge, keeps running until the Bedrock read timeout ends
+it, but never holds a worker that other calls would wait for.
+
+Which path answered (primary, hedge or fallback_<n>) is recorded in the request
+trace and counted in `invocation_stats`.
+"""
+import contextvars
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, List, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, ReadTimeoutError
+from langchain_aws import ChatBedrockConverse
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .instrumentation import current_trace
+
+# Bedrock errors meaning "try another model or region".
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "InternalServerException",
+}
+
+invocation_stats = Counter()
+_stats_lock = threading.Lock()
+
+# `time.monotonic()` value by which the model calls of the current context must finish.
+_call_deadline = contextvars.ContextVar("model_call_deadline", default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+def is_retryable(error):
+    if isinstance(error, (DeadlineExceededError, ReadTimeoutError, BotocoreConnectionError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    # Some integrations wrap the botocore error in a ValueError with its message.
+    return any(code in str(error) for code in RETRYABLE_ERROR_CODES)
+
+
+@contextmanager
+def call_deadline(deadline):
+    """Make the model calls of the block finish by `deadline`, a `time.monotonic()` value.
+
+    The deadline only shortens the `timeout` of the calls, None leaves it unchanged.
+    """
+    outer_deadline = _call_deadline.get()
+    if deadline is not None and outer_deadline is not None:
+        deadline = min(deadline, outer_deadline)
+    token = _call_deadline.set(deadline if deadline is not None else outer_deadline)
+    try:
+        yield
+    finally:
+        _call_deadline.reset(token)
+
+
+def _deadline(timeout):
+    deadline = time.monotonic() + timeout
+    outer_deadline = _call_deadline.get()
+    return deadline if outer_deadline is None else min(deadline, outer_deadline)
+
+
+def _start(fn, *args, **kwargs):
+    """Run `fn` on its own daemon thread and return its future."""
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="model-invocation", daemon=True).start()
+    return future
+
+
+class _StreamPump:
+    """Read the stream of a model on its own thread into a queue shared by a race.
+
+    Events are (pump, kind, value) tuples, kind being "chunk", "end" or "error".
+    A closed pump stops reading at its next chunk.
+    """
+
+    def __init__(self, model, messages, stop, kwargs, events):
+        self.model = model
+        self.events = events
+        self.closed = threading.Event()
+        _start(self._run, messages, stop, kwargs)
+
+    def _run(self, messages, stop, kwargs):
+        try:
+            # The wrapped models get no callbacks, the call is reported once, by this model.
+            chunks = self.model.stream(messages, stop=stop, config={"callbacks": []}, **kwargs)
+            try:
+                for chunk in chunks:
+                    if self.closed.is_set():
+                        return
+                    self.events.put((self, "chunk", chunk))
+            finally:
+                chunks.close()
+            self.events.put((self, "end", None))
+        except Exception as e:
+            self.events.put((self, "error", e))
+
+    def close(self):
+        self.closed.set()
+
+
+def _model_name(model):
+    return getattr(model, "model_id", None) or getattr(model, "model", None) or type(model).__name__
+
+
+def _record(path, model, started_at, streamed=False):
+    with _stats_lock:
+        invocation_stats[path] += 1
+    trace = current_trace()
+    if trace is not None:
+        trace.record(
+            "model_invocation",
+            (time.perf_counter() - started_at) * 1000,
+            path=path,
+            model=_model_name(model),
+            streamed=streamed,
+        )
+
+
+class ResilientChatModel(BaseChatModel):
+    """Chat model calling `models` in order, hedging the first one with `hedge_model`.
+
+    Args:
+        models (list): The primary chat model followed by the fallback models.
+        hedge_model: Optional chat model receiving a copy of the primary request when
+            the primary has not answered after `hedge_delay` seconds.
+        hedge_delay (float): Seconds to wait for the primary before hedging.
+        timeout (float): Deadline of a call in seconds, including hedges and fallbacks.
+    """
+
+    models: List[Any]
+    hedge_model: Optional[Any] = None
+    hedge_delay: float = 2.0
+    timeout: float = 30.0
+
+    @property
+    def _llm_type(self):
+        return "resilient-chat-model"
+
+    @property
+    def _identifying_params(self):
+        return {
+            "model": _model_name(self.models[0]),
+            "fallbacks": [_model_name(model) for model in self.models[1:]],
+            "hedge_model": _model_name(self.hedge_model) if self.hedge_model is not None else None,
+        }
+
+    def _submit(self, model, messages, stop, kwargs):
+        # The wrapped models get no callbacks, the call is reported once, by this model.
+        return _start(model.invoke, messages, stop=stop, config={"callbacks": []}, **kwargs)
+
+    def _race(self, model, hedge_model, messages, stop, kwargs, deadline):
+        """Return the first successful answer of the model and of its hedge, with its path."""
+        futures = {self._submit(model, messages, stop, kwargs): "primary"}
+        hedged = hedge_model is None
+        errors = []
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceededError(f"No answer from {_model_name(model)} before the deadline")
+            wait_time = remaining if hedged else min(self.hedge_delay, remaining)
+            done, _ = wait(futures, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                try:
+                    return future.result(), path
+                except Exception as e:
+                    errors.append(e)
+            if not hedged and (not done or not futures):
+                # The primary is slow, or failed, the hedge gets the request.
+                futures[self._submit(hedge_model, messages, stop, kwargs)] = "hedge"
+                hedged = True
+        raise errors[-1]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        started_at = time.perf_counter()
+        deadline = _deadline(self.timeout)
+        last_error = None
+        for index, model in enumerate(self.models):
+            hedge_model = self.hedge_model if index == 0 else None
+            try:
+                message, path = self._race(model, hedge_model, messages, stop, kwargs, deadline)
+            except Exception as e:
+                if not is_retryable(e) or time.monotonic() >= deadline:
+                    raise
+                last_error = e
+                continue
+            if index > 0:
+                path = f"fallback_{index}"
+            _record(path, model if path != "hedge" else hedge_model, started_at)
+            return ChatResult(generations=[ChatGeneration(message=message)])
+        raise last_error
+
+    def _first_event(self, model, hedge_model, messages, stop, kwargs, deadline):
+        """Stream from the model and its hedge, returning the first stream to produce a chunk.
+
+        Returns:
+            tuple: (events queue, winning pump, path, first event kind, first event value).
+            The kind is "end" for a stream without any chunk.
+        """
+        events = queue.Queue()
+        pumps = {_StreamPump(model, messages, stop, kwargs, events): "primary"}
+        hedged = hedge_model is None
+        errors = []
+        while pumps:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for pump in pumps:
+                    pump.close()
+                raise DeadlineExceededError(f"No chunk from {_model_name(model)} before the deadline")
+            wait_time = remaining if hedged else min(self.hedge_delay, remaining)
+            try:
+                pump, kind, value = events.get(timeout=wait_time)
+            except queue.Empty:
+                pump = None
+            if pump in pumps:
+                path = pumps.pop(pump)
+                if kind == "error":
+                    errors.append(value)
+                else:
+                    for other_pump in pumps:
+                        other_pump.close()
+                    return events, pump, path, kind, value
+            if not hedged and (pump is None or not pumps):
+                # The primary is slow to start, or failed, the hedge gets the request.
+                pumps[_StreamPump(hedge_model, messages, stop, kwargs, events)] = "hedge"
+                hedged = True
+        raise errors[-1]
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        """Stream from the first model that starts answering.
+
+        The first model is hedged on its first chunk, the stream is then relayed
+        from whichever model produced it. A model failing before its first chunk
+        falls back to the next model. The deadline applies between chunks too.
+        """
+        started_at = time.perf_counter()
+        deadline = _deadline(self.timeout)
+        last_error = None
+        for index, model in enumerate(self.models):
+            hedge_model = self.hedge_model if index == 0 else None
+            try:
+                events, pump, path, kind, value = self._first_event(
+                    model, hedge_model, messages, stop, kwargs, deadline
+                )
+            except Exception as e:
+                if not is_retryable(e) or time.monotonic() >= deadline:
+                    raise
+                last_error = e
+                continue
+            try:
+                while kind != "end":
+                    if kind == "error":
+                        raise value
+                    generation_chunk = ChatGenerationChunk(message=value)
+                    if run_manager is not None and isinstance(value.content, str):
+                        run_manager.on_llm_new_token(value.content, chunk=generation_chunk)
+                    yield generation_chunk
+                    source = None
+                    while source is not pump:
+                        remaining = deadline - time.monotonic()
+                        try:
+                            source, kind, value = events.get(timeout=max(remaining, 0))
+                        except queue.Empty:
+                            raise DeadlineExceededError(
+                                f"Stream of {_model_name(pump.model)} did not end before the deadline"
+                            )
+            finally:
+                pump.close()
+            if index > 0:
+                path = f"fallback_{index}"
+            _record(path, pump.model, started_at, streamed=True)
+            return
+        raise last_error
+
+
+_bedrock_clients = {}
+
+
+def _bedrock_runtime(region, read_timeout):
+    # Few botocore retries: throttled calls move on to the next model instead.
+    key = (region, read_timeout)
+    if key not in _bedrock_clients:
+        _bedrock_clients[key] = boto3.client(
+            "bedrock-runtime",
+            region_name=region,
+            config=Config(
+                read_timeout=read_timeout,
+                connect_timeout=5,
+                retries={"max_attempts": 2, "mode": "standard"},
+            ),
+        )
+    return _bedrock_clients[key]
+
+
+def get_chat_model(config, temperature=0.99, max_tokens=None):
+    """Build the chat model used by every chain from the model settings of the config."""
+
+    def converse_model(model_id, region):
+        return ChatBedrockConverse(
+            model=model_id,
+            temperature=temperature,
+            client=_bedrock_runtime(region, config.llm_timeout),
+            max_tokens=max_tokens,
+        )
+
+    models = [converse_model(config.chat_model_id, config.bedrock_region)]
+    models += [
+        converse_model(model_id, config.bedrock_region)
+        for model_id in config.chat_fallback_model_ids
+    ]
+    hedge_model = None
+    if config.chat_hedge_model_id:
+        hedge_model = converse_model(
+            config.chat_hedge_model_id, config.chat_hedge_region or config.bedrock_region
+        )
+    return ResilientChatModel(
+        models=models,
+        hedge_model=hedge_model,
+        hedge_delay=config.llm_hedge_delay,
+        timeout=config.llm_timeout,
+    )
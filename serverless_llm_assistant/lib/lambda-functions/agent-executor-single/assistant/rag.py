@@ -1,19 +1,96 @@
 # from langchain.chains import RetrievalQA
 # from langchain_community.chains import RetrievalQA
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_community.embeddings import BedrockEmbeddings
 from langchain_postgres import PGVector
 from langchain_postgres.vectorstores import PGVector
 from langchain_core.prompts import ChatPromptTemplate
-def format_docs(docs):
-    content = ""
-    for doc in docs:
-        content+= f"Below is document exceprt from file: {doc.metadata["file_name"]} --------- \n\n {doc.page_content} \n"
-    # return "\n\n".join(doc.page_content for doc in docs)
-    return content
-def get_rag_chain(config, llm, bedrock_runtime):
-    """Prepare a RAG question answering chain.
+from langchain_core.runnables import RunnableLambda
+
+from .instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+
+class FederatedRetriever:
+    """Search several PGVector collections concurrently and merge the results.
+
+    The query is embedded once and the same vector is sent to every collection.
+    The collections share the embedding model and the distance strategy, so their
+    distances can be ranked together, lowest first, as returned by PGVector.
+    Every returned document carries the collection it came from in
+    `metadata["collection_name"]`.
+    """
+
+    def __init__(self, embedding_model, vector_stores, k=4):
+        self.embedding_model = embedding_model
+        # mapping of collection name -> PGVector store
+        self.vector_stores = dict(vector_stores)
+        self.k = k
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(len(self.vector_stores), 1),
+            thread_name_prefix="federated-search",
+        )
+
+    def _search_collection(self, collection_name, query_embedding, k):
+        vector_store = self.vector_stores[collection_name]
+        with timed("vector_search", collection=collection_name):
+            results = vector_store.similarity_search_with_score_by_vector(
+                query_embedding, k=k
+            )
+        scored_docs = []
+        for doc, distance in results:
+            metadata = dict(doc.metadata)
+            metadata["collection_name"] = collection_name
+            doc = doc.__class__(page_content=doc.page_content, metadata=metadata)
+            scored_docs.append((doc, distance))
+        return scored_docs
+
+    def search_with_score(self, query, k=None):
+        """Return the overall top-k (document, distance) pairs, closest first."""
+        k = k or self.k
+        with timed("embedding", purpose="retrieval"):
+            query_embedding = self.embedding_model.embed_query(query)
+
+        # Each search runs in a copy of the context so it is recorded in the request trace.
+        futures = {
+            collection_name: self._executor.submit(
+                contextvars.copy_context().run,
+                self._search_collection,
+                collection_name,
+                query_embedding,
+                k,
+            )
+            for collection_name in self.vector_stores
+        }
+
+        merged = []
+        errors = {}
+        for collection_name, future in futures.items():
+            try:
+                merged.extend(future.result())
+            except Exception as e:
+                # One missing or failing collection should not fail the whole search.
+                logger.warning(f"Search on collection {collection_name} failed: {e}")
+                errors[collection_name] = e
+
+        if errors and len(errors) == len(futures):
+            raise RuntimeError(f"Search failed on all collections: {errors}")
+
+        merged.sort(key=lambda doc_and_distance: doc_and_distance[1])
+        return merged[:k]
+
+    def get_relevant_documents(self, query, k=None):
+        return [doc for doc, _ in self.search_with_score(query, k=k)]
+
+
+def get_federated_retriever(config, bedrock_runtime, k=4):
+    """Prepare a retriever over all the collections listed in the config.
 
       Note: Must use the same embedding model used for creating the semantic search index
       to be used for real-time semantic search.
@@ -22,11 +99,25 @@ def get_rag_chain(config, llm, bedrock_runtime):
         model_id=config.embedding_model_id, client=bedrock_runtime
     )
 
-    vector_store = PGVector.from_existing_index(
-        embedding=embedding_model,
-        collection_name="agentic_assistant_lv_160",
-        connection=config.postgres_connection_string,
-    )
+    vector_stores = {
+        collection_name: PGVector.from_existing_index(
+            embedding=embedding_model,
+            collection_name=collection_name,
+            connection=config.postgres_connection_string,
+        )
+        for collection_name in config.rag_collection_names
+    }
+    return FederatedRetriever(embedding_model, vector_stores, k=k)
+
+
+def format_docs(docs):
+    content = ""
+    for doc in docs:
+        content+= f"Below is document exceprt from file: {doc.metadata["file_name"]} --------- \n\n {doc.page_content} \n"
+    # return "\n\n".join(doc.page_content for doc in docs)
+    return content
+def get_rag_chain(retriever):
+    """Prepare a RAG chain returning the formatted excerpts found by the retriever."""
     # system_prompt = (
     #     "Use the given context to answer the question. "
     #     "If you don't know the answer, say you don't know. "
@@ -48,4 +139,4 @@ def get_rag_chain(config, llm, bedrock_runtime):
     #     return_source_documents=False,
     #     input_key="question",
     # )
-    return vector_store.as_retriever(search_kwargs={"k": 4})| format_docs
\ No newline at end of file
+    return RunnableLambda(retriever.get_relevant_documents) | format_docs
\ No newline at end of file
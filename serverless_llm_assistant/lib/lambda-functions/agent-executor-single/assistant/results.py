@@ -0,0 +1,136 @@
+"""Typed columnar results of the AnalyticsQA queries, kept per request under a handle.
+
+AnalyticsQA stores the rows of each query as a `TabularResult`, one NumPy array per
+column, in the result store of the request and returns its handle (`result_1`,
+`result_2`, ...) with a preview of the rows. The calculator then computes over whole
+columns, e.g. `mean(result_1.revenue)`, without sending the rows back to the LLM.
+
+A request is wrapped in `request_result_store`, which holds the store in a context
+variable, so the results are dropped with the request.
+"""
+import contextvars
+import decimal
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Rows and characters per cell shown to the LLM, the full result stays in the store.
+PREVIEW_ROWS = 20
+PREVIEW_CELL_CHARS = 300
+
+_current_store = contextvars.ContextVar("assistant_result_store", default=None)
+
+
+def _column_array(values):
+    """Convert the values of a column to the narrowest NumPy array that holds them.
+
+    Integers without NULL become int64, numbers with NULL become float64 with NaN,
+    booleans become bool and anything else an object array of the values.
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, bool) for value in present) and len(present) == len(values):
+        return np.array(values, dtype=bool)
+    if present and all(
+        isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+        for value in present
+    ):
+        if len(present) == len(values) and all(isinstance(value, int) for value in present):
+            return np.array(values, dtype=np.int64)
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+def _dtype_name(array):
+    if array.dtype.kind in "iu":
+        return "integer"
+    if array.dtype.kind == "f":
+        return "float"
+    if array.dtype.kind == "b":
+        return "boolean"
+    return "text"
+
+
+@dataclass
+class TabularResult:
+    """Rows of a query as one typed array per column, in query order."""
+
+    columns: dict
+    sql: str = ""
+    handle: str = ""
+
+    @classmethod
+    def from_rows(cls, column_names, rows, sql=""):
+        rows = [tuple(row) for row in rows]
+        columns = {}
+        for index, column_name in enumerate(column_names):
+            columns[str(column_name)] = _column_array([row[index] for row in rows])
+        return cls(columns=columns, sql=sql)
+
+    @property
+    def num_rows(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def column(self, name):
+        if name not in self.columns:
+            raise KeyError(
+                f"{self.handle or 'The result'} has no column {name}, its columns are {list(self.columns)}"
+            )
+        return self.columns[name]
+
+    def rows(self, limit=None):
+        arrays = list(self.columns.values())
+        count = self.num_rows if limit is None else min(limit, self.num_rows)
+        return [tuple(array[index] for array in arrays) for index in range(count)]
+
+    def describe(self):
+        columns = ", ".join(f"{name} ({_dtype_name(array)})" for name, array in self.columns.items())
+        return f"{self.handle or 'Result'}: {self.num_rows} rows, columns {columns}"
+
+    def preview(self, max_rows=PREVIEW_ROWS):
+        """Describe the result and list its first rows, in the text returned to the LLM."""
+
+        def cell(value):
+            text = str(value)
+            return text if len(text) <= PREVIEW_CELL_CHARS else text[:PREVIEW_CELL_CHARS] + "..."
+
+        lines = [self.describe()]
+        lines += [str(tuple(cell(value) for value in row)) for row in self.rows(max_rows)]
+        if self.num_rows > max_rows:
+            lines.append(f"... {self.num_rows - max_rows} more rows, use the Calculator to compute over them.")
+        return "\n".join(lines)
+
+
+@dataclass
+class ResultStore:
+    """Results of one request, under the handles `result_1`, `result_2`, ..."""
+
+    results: dict = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, result):
+        with self._lock:
+            result.handle = f"result_{len(self.results) + 1}"
+            self.results[result.handle] = result
+        return result.handle
+
+    def get(self, handle):
+        if handle not in self.results:
+            raise KeyError(f"No result named {handle}, the results are {list(self.results) or 'none yet'}")
+        return self.results[handle]
+
+
+def current_result_store():
+    return _current_store.get()
+
+
+@contextmanager
+def request_result_store():
+    """Hold a fresh result store for the duration of a request."""
+    store = ResultStore()
+    token = _current_store.set(store)
+    try:
+        yield store
+    finally:
+        _current_store.reset(token)
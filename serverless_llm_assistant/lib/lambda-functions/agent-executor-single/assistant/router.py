@@ -0,0 +1,433 @@
+"""Route agentic queries to a single tool without running the full agent loop.
+
+Each route (one per tool, plus a direct answer route) is described by a few example
+questions. Their embeddings are averaged into one normalized centroid per route. The
+centroids are stored in S3 with a fingerprint of the embedding model and the examples,
+and loaded when the container starts. Only the first container started after a change
+of the model or the examples computes them, and stores them for the others, so the
+request path never embeds the examples.
+
+A query is embedded once and compared to every centroid with a dot product. When the
+best route is both similar enough and clearly ahead of the runner up, the handler calls
+that tool directly and makes one synthesis call. Otherwise, or when the centroids could
+not be loaded, the query goes through the XML agent as before.
+
+Like the agent, a routed request answers by the Lambda deadline: the tool call must end
+before the final answer reserve and the synthesis call by the deadline. Only a failed
+tool call hands the query to the agent, a failed synthesis answers with the observation
+instead of calling the tool again.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+
+import numpy as np
+from botocore.exceptions import BotoCoreError, ClientError
+from langchain_core.prompts import ChatPromptTemplate
+
+from .deadline_agent import MAX_FALLBACK_OBSERVATION_CHARS
+from .instrumentation import timed
+from .models import DeadlineExceededError, call_deadline
+from .utils import XMLTagStreamParser, get_chunk_text
+
+logger = logging.getLogger(__name__)
+
+DIRECT_ANSWER_ROUTE = "DirectAnswer"
+AGENT_ROUTE = "Agent"
+
+# Example questions per route. The tool routes must match the tool names in tools.py.
+ROUTE_EXAMPLES = {
+    "AnalyticsQA": [
+        "How many CVs have a GPA above 3.5?",
+        "How many CVs are there in the database?",
+        "What is the average GPA of the candidates?",
+        "List the source documents of candidates with more than 3 projects.",
+        "Which candidate has the most years of work experience?",
+        "Count the candidates with at least 2 years of experience.",
+        "Show the top 5 candidates ranked by GPA.",
+        "What is the number of projects per candidate?",
+    ],
+    "CVEntitySearch": [
+        "Which candidates mention a machine learning project in their CV?",
+        "Which university did the candidate attend?",
+        "Who worked on a mobile application project?",
+        "Find candidates with experience in AWS and Docker.",
+        "Which CV mentions an internship at a bank?",
+        "What projects are described in the CV of this candidate?",
+        "Who has a certificate in cloud computing?",
+        "Find the CV of the candidate who studied computer science.",
+    ],
+    "WebSearch": [
+        "What is the latest news about artificial intelligence?",
+        "Who won the football world cup?",
+        "What is the weather like in Hanoi today?",
+        "What is the current price of Bitcoin?",
+        "Tell me about recent events in the technology industry.",
+        "Who is the CEO of Amazon?",
+    ],
+    DIRECT_ANSWER_ROUTE: [
+        "Hello!",
+        "Hi, how are you?",
+        "Thank you for your help.",
+        "Good morning.",
+        "What can you do?",
+        "Can you rephrase your last answer?",
+        "Goodbye.",
+    ],
+}
+
+# Similarity of the best route, and its lead over the runner up, needed to skip the agent.
+DEFAULT_MIN_SCORE = 0.55
+DEFAULT_MIN_MARGIN = 0.05
+
+
+@dataclass
+class RouteDecision:
+    route: str
+    score: float
+    margin: float
+    confident: bool
+    scores: dict = field(default_factory=dict)
+
+
+class IntentRouter:
+    """Classify a query against the centroid embeddings of the routes.
+
+    Args:
+        embedding_model: A LangChain embedding model.
+        route_examples (dict): Maps a route name to its example questions.
+        min_score (float): Minimum cosine similarity of the best route to be confident.
+        min_margin (float): Minimum lead of the best route over the second one.
+        s3_client: Optional boto3 S3 client storing the centroids.
+        bucket_name (str): Bucket of the stored centroids.
+        centroids_key (str): Key of the stored centroids, reused while the embedding
+            model and the examples stay the same.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        route_examples=ROUTE_EXAMPLES,
+        min_score=DEFAULT_MIN_SCORE,
+        min_margin=DEFAULT_MIN_MARGIN,
+        s3_client=None,
+        bucket_name=None,
+        centroids_key=None,
+    ):
+        self.embedding_model = embedding_model
+        self.route_examples = route_examples
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.centroids_key = centroids_key
+        self._route_names = None
+        self._centroids = None
+
+    @property
+    def fingerprint(self):
+        model_id = getattr(self.embedding_model, "model_id", type(self.embedding_model).__name__)
+        payload = json.dumps({"model_id": model_id, "examples": self.route_examples}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @property
+    def _stores_centroids(self):
+        return self.s3_client is not None and self.bucket_name and self.centroids_key
+
+    def _load_centroids(self):
+        if not self._stores_centroids:
+            return None
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.centroids_key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") != "NoSuchKey":
+                logger.warning(f"Could not load the router centroids: {e}")
+            return None
+        stored = json.loads(response["Body"].read())
+        if stored.get("fingerprint") != self.fingerprint:
+            return None
+        return stored["centroids"]
+
+    def _save_centroids(self, centroids):
+        if not self._stores_centroids:
+            return
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.centroids_key,
+                Body=json.dumps({"fingerprint": self.fingerprint, "centroids": centroids}),
+            )
+        except (BotoCoreError, ClientError) as e:
+            logger.warning(f"Could not store the router centroids: {e}")
+
+    def _compute_centroids(self):
+        texts = [text for examples in self.route_examples.values() for text in examples]
+        # Bedrock embedding models take one text per call, the examples are embedded concurrently.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            embeddings = list(executor.map(self.embedding_model.embed_query, texts))
+        centroids = {}
+        start = 0
+        for route, examples in self.route_examples.items():
+            vectors = np.asarray(embeddings[start:start + len(examples)], dtype=np.float32)
+            start += len(examples)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            centroid = vectors.mean(axis=0)
+            centroids[route] = (centroid / np.linalg.norm(centroid)).tolist()
+        return centroids
+
+    def warm_up(self):
+        """Load the stored centroids, or compute and store them, when the container starts.
+
+        Returns:
+            bool: True if the router has centroids. Without them every query goes to the agent.
+        """
+        if self._centroids is not None:
+            return True
+        try:
+            centroids = self._load_centroids()
+            if centroids is None:
+                logger.info("No stored router centroids for the current examples, computing them")
+                centroids = self._compute_centroids()
+                self._save_centroids(centroids)
+        except Exception as e:
+            logger.warning(f"Intent router disabled, the centroids are unavailable: {e!r}")
+            return False
+        self._route_names = list(centroids)
+        self._centroids = np.asarray([centroids[route] for route in self._route_names], dtype=np.float32)
+        return True
+
+    def route(self, query):
+        """Return the RouteDecision for a query, None when the router has no centroids."""
+        if self._centroids is None:
+            return None
+        with timed("embedding", purpose="intent_routing"):
+            query_embedding = np.asarray(self.embedding_model.embed_query(query), dtype=np.float32)
+        query_embedding /= np.linalg.norm(query_embedding)
+        similarities = self._centroids @ query_embedding
+        order = np.argsort(similarities)[::-1]
+        best, second = order[0], order[1] if len(order) > 1 else order[0]
+        score = float(similarities[best])
+        margin = score - float(similarities[second]) if best != second else score
+        return RouteDecision(
+            route=self._route_names[best],
+            score=score,
+            margin=margin,
+            confident=score >= self.min_score and margin >= self.min_margin,
+            scores={name: float(value) for name, value in zip(self._route_names, similarities)},
+        )
+
+
+class RouterMetrics:
+    """Running routing metrics of a container.
+
+    Routing accuracy is counted for requests labeled with their expected route.
+    The latency saved by a routed request is estimated against the running average
+    latency of the requests that went through the agent.
+    """
+
+    def __init__(self):
+        self.routed_requests = 0
+        self.agent_requests = 0
+        self.labeled_requests = 0
+        self.correct_routes = 0
+        self.agent_latency_total = 0.0
+        self.latency_saved_total = 0.0
+
+    @property
+    def average_agent_latency(self):
+        if not self.agent_requests:
+            return None
+        return self.agent_latency_total / self.agent_requests
+
+    @property
+    def routing_accuracy(self):
+        if not self.labeled_requests:
+            return None
+        return self.correct_routes / self.labeled_requests
+
+    def record(self, decision, path, latency, expected_route=None):
+        """Record one request and return its metrics as a dict, ready to be logged.
+
+        Args:
+            decision (RouteDecision): The router decision.
+            path (str): The route that answered, AGENT_ROUTE for the agent fallback.
+            latency (float): The latency of the request in seconds.
+            expected_route (str): Optional label of the request, used for accuracy.
+        """
+        latency_saved = None
+        if path == AGENT_ROUTE:
+            self.agent_requests += 1
+            self.agent_latency_total += latency
+        else:
+            self.routed_requests += 1
+            if self.average_agent_latency is not None:
+                latency_saved = self.average_agent_latency - latency
+                self.latency_saved_total += latency_saved
+
+        correct = None
+        if expected_route is not None:
+            self.labeled_requests += 1
+            correct = decision.route == expected_route
+            self.correct_routes += int(correct)
+
+        return {
+            "route": decision.route,
+            "path": path,
+            "score": round(decision.score, 4),
+            "margin": round(decision.margin, 4),
+            "confident": decision.confident,
+            "latency_ms": round(latency * 1000, 1),
+            "latency_saved_ms": None if latency_saved is None else round(latency_saved * 1000, 1),
+            "correct": correct,
+            "routing_accuracy": self.routing_accuracy,
+            "routed_share": self.routed_requests / (self.routed_requests + self.agent_requests),
+        }
+
+
+def evaluate_router(router, labeled_queries):
+    """Measure the router on (query, expected_route) pairs.
+
+    Returns:
+        dict: The accuracy over all queries, the share of confident decisions and
+            the accuracy of the confident decisions, which are the ones that skip the agent.
+    """
+    router.warm_up()
+    decisions = [(router.route(query), expected) for query, expected in labeled_queries]
+    confident = [(decision, expected) for decision, expected in decisions if decision.confident]
+    return {
+        "queries": len(decisions),
+        "accuracy": sum(d.route == e for d, e in decisions) / len(decisions),
+        "coverage": len(confident) / len(decisions),
+        "confident_accuracy": (
+            sum(d.route == e for d, e in confident) / len(confident) if confident else None
+        ),
+    }
+
+
+synthesis_system_message = """
+You are a helpful assistant. Leverage the <conversation_history> to keep the answer consistent with the conversation.
+Answer the <user_input> using the <observation> returned by the {tool_name} tool when it is relevant.
+If the user input is a greeting, respond directly.
+Provide the answer in markdown within <final_answer></final_answer>.
+"""
+
+synthesis_user_message = """
+Previous conversation history:
+<conversation_history>
+{chat_history}
+</conversation_history>
+
+User input message:
+<user_input>
+{input}
+</user_input>
+
+<observation>
+{observation}
+</observation>
+"""
+
+ROUTED_SYNTHESIS_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", synthesis_system_message),
+        ("human", synthesis_user_message),
+    ]
+)
+
+
+class RoutedToolError(RuntimeError):
+    """The tool of a routed request failed or did not answer in time, the agent may answer instead."""
+
+
+# Routed calls run here so they can be abandoned at the deadline.
+_routed_call_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="routed-call")
+
+
+def _call_by(deadline, fn, *args, **kwargs):
+    """Return `fn(*args, **kwargs)`, raising DeadlineExceededError if it has not ended by `deadline`."""
+    if deadline is None:
+        return fn(*args, **kwargs)
+    time_left = deadline - time.monotonic()
+    if time_left <= 0:
+        raise DeadlineExceededError("No time left for the call")
+    # A copy of the context keeps the call in the request trace and under its call deadline.
+    future = _routed_call_executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    try:
+        return future.result(timeout=time_left)
+    except FutureTimeoutError:
+        # The call keeps running in its thread, its result is ignored.
+        raise DeadlineExceededError(f"No answer within {time_left:.1f}s") from None
+
+
+def _observation_answer(tool_name, observation):
+    """Answer without the LLM from the observation of the tool."""
+    observation = " ".join(str(observation).split())
+    if not observation:
+        return "Sorry, I could not answer in time. Please try again or ask a simpler question."
+    if len(observation) > MAX_FALLBACK_OBSERVATION_CHARS:
+        observation = observation[:MAX_FALLBACK_OBSERVATION_CHARS].rstrip() + "..."
+    return f"I could not finish in time. Here is what I found so far:\n- {tool_name}: {observation}"
+
+
+def run_routed_request(
+    decision,
+    user_input,
+    chat_history,
+    tools,
+    llm,
+    config=None,
+    deadline=None,
+    final_answer_reserve=6.0,
+):
+    """Answer a confidently routed query with at most one tool call and one LLM call.
+
+    Args:
+        decision (RouteDecision): A confident router decision.
+        user_input (str): The user question, used as the tool input.
+        chat_history (str): The formatted conversation history.
+        tools (list): The agent tools, looked up by name.
+        llm: The chat model writing the answer.
+        config (dict): Optional runnable config, such as callbacks, for the tool and LLM calls.
+        deadline (float): `time.monotonic()` value by which the answer must be written.
+        final_answer_reserve (float): Seconds before the deadline kept for the synthesis call.
+
+    Returns:
+        tuple: The final answer, and True when it was written without the synthesis call.
+
+    Raises:
+        RoutedToolError: If the tool call failed or did not end before the final answer reserve.
+    """
+    tool_name = decision.route
+    observation = ""
+    if tool_name != DIRECT_ANSWER_ROUTE:
+        tool = next(tool for tool in tools if tool.name == tool_name)
+        tool_deadline = None if deadline is None else deadline - final_answer_reserve
+        try:
+            observation = _call_by(tool_deadline, tool.invoke, user_input, config=config)
+        except Exception as e:
+            raise RoutedToolError(f"The {tool_name} tool failed: {e!r}") from e
+
+    try:
+        with call_deadline(deadline):
+            response = _call_by(
+                deadline,
+                (ROUTED_SYNTHESIS_PROMPT | llm).invoke,
+                {
+                    "tool_name": tool_name,
+                    "chat_history": chat_history,
+                    "input": user_input,
+                    "observation": observation,
+                },
+                config=config,
+            )
+    except Exception as e:
+        logger.warning(f"Routed synthesis after {tool_name} failed, answering with its observation: {e!r}")
+        return _observation_answer(tool_name, observation), True
+    text = get_chunk_text(response)
+    parser = XMLTagStreamParser(tags=["final_answer"], terminal_tags=["final_answer"])
+    events = parser.feed(text) + parser.close()
+    return (events[0][1] if events else text.strip()), False
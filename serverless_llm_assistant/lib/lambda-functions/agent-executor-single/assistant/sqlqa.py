@@ -1,9 +1,26 @@
+import sqlalchemy
 from langchain.prompts.prompt import PromptTemplate
 from langchain.chains import create_sql_query_chain
 from .config import AgenticAssistantConfig
+from .instrumentation import timed
+from .results import TabularResult, current_result_store
 # from .sql_chain import create_sql_query_generation_chain
 
 config = AgenticAssistantConfig()
+
+# rows kept from a query result, the LIMIT asked in the prompt is usually far lower.
+MAX_RESULT_ROWS = 10000
+
+
+def run_tabular_query(sql_query, max_rows=MAX_RESULT_ROWS):
+    """Run a query and return its rows as a `TabularResult`, one typed array per column."""
+    with config.sql_engine.connect() as connection:
+        cursor = connection.execute(sqlalchemy.text(sql_query))
+        if not cursor.returns_rows:
+            return TabularResult(columns={}, sql=sql_query)
+        return TabularResult.from_rows(list(cursor.keys()), cursor.fetchmany(max_rows), sql=sql_query)
+
+
 def get_sql_chain(llm):
     """Prepare a RAG question answering chain.
 
@@ -27,6 +44,10 @@ def get_sql_chain(llm):
     #             )
     template = '''Given an input question, first create a syntactically correct {dialect} query to run, then look at the results of the query and only return the SQL querry statement without explaination.
     Always have LIMIT at the end of SQL querry and value of it take from <limit> XML tag below.
+    Prefer the pre-aggregated summary tables when they answer the question:
+    extracted_entities_by_company has one row per company and revenue unit with its report count, years, revenue and human capital aggregates,
+    extracted_entities_by_year has one row per year and revenue unit with company counts, revenue and human capital totals, averages and ranges.
+    Only query extracted_entities for row level details, such as risks, or for filters the summary tables do not cover.
     Only use the following tables:
     limit:
     <limit>{top_k}</limit>
@@ -55,19 +76,28 @@ def get_sql_qa_tool(user_question, text_to_sql_chain,initial_context=""):
     if not sql_query.endswith(";"):
         sql_query += ";"
 
-    print(sql_query)
-
     # fixed_query = sqlfluff.fix(sql=sql_query, dialect="postgres")
     try:
-        result = config.entities_db.run(sql_query)
+        with timed("sql_execution", sql=sql_query[:1000]) as record:
+            result = run_tabular_query(sql_query)
+            record["rows"] = result.num_rows
     except Exception as e:
-        result = (
+        return (
             f"Failed to run the SQL query {sql_query} with error {e}"
             " Appologize, ask the user for further specifications,"
             " or to try again later."
         )
 
-    return result
+    result_store = current_result_store()
+    if result_store is None:
+        return result.preview()
+    # The full result stays in the request result store for the Calculator.
+    handle = result_store.add(result)
+    return (
+        f"{result.preview()}\n"
+        f"The full result is stored as {handle}, compute over its columns with the Calculator,"
+        f" for example count({handle}.{next(iter(result.columns), 'column')})."
+    )
 
 # sql_tables_content_description = {
 #     "extracted_entities": (
@@ -3,12 +3,13 @@ import boto3
 from langchain.agents import Tool
 # from langchain_aws import BedrockLLM
 from langchain_aws import ChatBedrock
-from langchain_aws import ChatBedrockConverse
 
 from langchain_community.tools import DuckDuckGoSearchRun
-# from .calculator import CustomCalculatorTool
+from .calculator import CustomCalculatorTool
 from .config import AgenticAssistantConfig
-from .rag import get_rag_chain
+from .models import get_chat_model
+from .rag import get_federated_retriever, get_rag_chain
+from .router import IntentRouter
 from .sqlqa import get_sql_qa_tool, get_sql_chain
 
 config = AgenticAssistantConfig()
@@ -36,17 +37,23 @@ bedrock_runtime = boto3.client("bedrock-runtime", region_name=config.bedrock_reg
 #         "top_p": 0.99
 #     },
 # )
-claude_chat_llm = ChatBedrockConverse(
-    model="amazon.nova-lite-v1:0",
-    temperature=0.99,
-    client=bedrock_runtime,
-    max_tokens=None,
-    # other params...
-    )
+claude_chat_llm = get_chat_model(config)
 
 search = DuckDuckGoSearchRun()
-# custom_calculator = CustomCalculatorTool()
-rag_qa_chain = get_rag_chain(config, claude_chat_llm, bedrock_runtime)
+custom_calculator = CustomCalculatorTool()
+rag_retriever = get_federated_retriever(config, bedrock_runtime)
+rag_qa_chain = get_rag_chain(rag_retriever)
+# routes queries that need a single tool, sharing the retriever embedding model.
+# The centroids are loaded here, during the container initialization.
+intent_router = IntentRouter(
+    rag_retriever.embedding_model,
+    min_score=config.router_min_score,
+    min_margin=config.router_min_margin,
+    s3_client=boto3.client("s3"),
+    bucket_name=config.agent_data_bucket_name,
+    centroids_key=config.router_centroids_key,
+)
+intent_router.warm_up()
 sql_chain = get_sql_chain(claude_chat_llm)
 #    Tool(
 #         name="Calculator",
@@ -84,6 +91,8 @@ LLM_AGENT_TOOLS = [
             "Use this tool to perform analytical queries and calculations on CV data."
             " This tool is suitable for questions that require aggregating, filtering number of CV related source_doc,gpa,number of project, work exprience."
             "The input should be a natural language question related to analyzing like number of CV, list source doc."
+            " The result is stored as result_1, result_2, ... for the Calculator tool."
         ),
-    )
+    ),
+    custom_calculator,
 ]
@@ -1,20 +1,109 @@
-from bs4 import BeautifulSoup
+import html
+
+
+class XMLTagStreamParser:
+    """Incrementally extract the content of known XML tags from streamed text.
+
+    Text is fed chunk by chunk as the LLM produces it. The content of a tag is
+    returned as soon as its closing tag arrives, and `done` is set once a closing
+    tag listed in `terminal_tags` is seen, so the caller can stop reading the stream.
+    Text outside the known tags, such as <thinking>, is skipped.
+    """
+
+    def __init__(self, tags, terminal_tags=()):
+        self.tags = tuple(tags)
+        self.terminal_tags = set(terminal_tags)
+        self.done = False
+        self._buffer = ""
+        self._open_tag = None
+        self._content = []
+        # Longest text that could still become an opening tag.
+        self._max_open_tag_length = max(len(f"<{tag}>") for tag in self.tags)
+
+    def feed(self, text):
+        """Consume a chunk of text and return the list of completed (tag, content) pairs."""
+        if self.done:
+            return []
+        self._buffer += text
+        events = []
+        while not self.done:
+            if self._open_tag is None:
+                positions = [
+                    (self._buffer.find(f"<{tag}>"), tag)
+                    for tag in self.tags
+                    if f"<{tag}>" in self._buffer
+                ]
+                if not positions:
+                    # Keep only a tail that may be the start of a split opening tag.
+                    self._buffer = self._buffer[-(self._max_open_tag_length - 1):]
+                    break
+                position, tag = min(positions)
+                self._open_tag = tag
+                self._buffer = self._buffer[position + len(f"<{tag}>"):]
+            else:
+                closing_tag = f"</{self._open_tag}>"
+                position = self._buffer.find(closing_tag)
+                if position == -1:
+                    # Everything but a possible split closing tag is content.
+                    safe_length = max(len(self._buffer) - len(closing_tag) + 1, 0)
+                    self._content.append(self._buffer[:safe_length])
+                    self._buffer = self._buffer[safe_length:]
+                    break
+                self._content.append(self._buffer[:position])
+                events.append(self._emit())
+                self._buffer = self._buffer[position + len(closing_tag):]
+        return events
+
+    def close(self):
+        """Signal the end of the stream.
+
+        A tag still open is returned as completed, since LLM stop sequences such as
+        `</final_answer>` end the generation without including the closing tag.
+        """
+        if self.done or self._open_tag is None:
+            return []
+        self._content.append(self._buffer)
+        self._buffer = ""
+        return [self._emit()]
+
+    def _emit(self):
+        tag = self._open_tag
+        content = "".join(self._content).strip()
+        self._open_tag = None
+        self._content = []
+        if tag in self.terminal_tags:
+            self.done = True
+        return tag, content
 
 
 def parse_markdown_content(text):
     """
     Parses the content between <markdown> and </markdown> tags from the given text.
-    
+
     Args:
         text (str): The input text containing the markdown tag content.
-        
+
     Returns:
-        str: The content between the markdown tags, or an empty string if not found.
+        str: The content between the markdown tags, with HTML entities such as
+            &amp; unescaped, or an empty string if not found.
     """
-    soup = BeautifulSoup(text, 'html.parser')
-    markdown_tag = soup.find('markdown')
-    
-    if markdown_tag:
-        return markdown_tag.get_text()
+    parser = XMLTagStreamParser(tags=["markdown"], terminal_tags=["markdown"])
+    events = parser.feed(text) + parser.close()
+    if events:
+        return html.unescape(events[0][1])
     else:
-        return ''
\ No newline at end of file
+        return ''
+
+
+def get_chunk_text(chunk):
+    """Return the text of a streamed message chunk.
+
+    Converse based chat models stream content as a list of blocks instead of a string.
+    """
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block.get("text", "") if isinstance(block, dict) else str(block)
+        for block in content
+    )
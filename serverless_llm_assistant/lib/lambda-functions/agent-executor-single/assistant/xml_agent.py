@@ -0,0 +1,77 @@
+from langchain.agents.format_scratchpad import format_xml
+from langchain_core.agents import AgentAction, AgentFinish
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.tools import render_text_description
+
+from .utils import XMLTagStreamParser, get_chunk_text
+
+AGENT_TAGS = ["tool", "tool_input", "final_answer"]
+# A tool call is complete once its input is closed, an answer once it is closed.
+AGENT_TERMINAL_TAGS = ["tool_input", "final_answer"]
+
+
+def parse_xml_agent_stream(chunks):
+    """
+    Parses a streamed XML agent completion into an agent action or a final answer.
+
+    The tags are parsed as the chunks arrive and anything after the closed tool input
+    or final answer is ignored. The stream is still read to its end, which the stop
+    sequences make immediate, so the LLM run and its callbacks finish normally.
+
+    Args:
+        chunks (iterable): The streamed message chunks or strings.
+
+    Returns:
+        AgentAction | AgentFinish: The tool to call with its input, or the final answer.
+    """
+    parser = XMLTagStreamParser(tags=AGENT_TAGS, terminal_tags=AGENT_TERMINAL_TAGS)
+    text = ""
+    tags = {}
+    for chunk in chunks:
+        chunk_text = get_chunk_text(chunk)
+        text += chunk_text
+        tags.update(parser.feed(chunk_text))
+    tags.update(parser.close())
+
+    if "final_answer" in tags:
+        return AgentFinish(return_values={"output": tags["final_answer"]}, log=text)
+    if "tool" in tags:
+        return AgentAction(tool=tags["tool"], tool_input=tags.get("tool_input", ""), log=text)
+    raise OutputParserException(
+        f"Could not parse LLM output: {text}", llm_output=text
+    )
+
+
+def create_streaming_xml_agent(llm, tools, prompt, stop_sequence=True):
+    """
+    Creates an XML agent that parses the LLM output while it streams.
+
+    Same prompt and scratchpad as `langchain.agents.create_xml_agent`, with the
+    completion read through `parse_xml_agent_stream` instead of being parsed once
+    the whole generation is done.
+
+    Args:
+        llm: The chat model, it must support `stream`.
+        tools (list): The tools the agent can use.
+        prompt: The agent prompt, with `tools` and `agent_scratchpad` variables.
+        stop_sequence (bool | list): True for the default stop sequences, False for none,
+            or the list of stop sequences.
+
+    Returns:
+        Runnable: The agent, to be used with an AgentExecutor.
+    """
+    if stop_sequence is True:
+        stop_sequence = ["</tool_input>"]
+    stop = stop_sequence or None
+
+    def stream_agent_step(prompt_value, config):
+        return parse_xml_agent_stream(llm.stream(prompt_value, config=config, stop=stop))
+
+    return (
+        RunnablePassthrough.assign(
+            agent_scratchpad=lambda x: format_xml(x["intermediate_steps"]),
+        )
+        | prompt.partial(tools=render_text_description(list(tools)))
+        | RunnableLambda(stream_agent_step)
+    )
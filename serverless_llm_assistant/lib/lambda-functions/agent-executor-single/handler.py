@@ -1,3 +1,8 @@
+import time
+
+# start of the cold start initialization, reported with the first request.
+_init_started_at = time.perf_counter()
+
 import logging
 import traceback
 
@@ -8,18 +13,26 @@ from langchain_aws import ChatBedrock
 from langchain.memory import ConversationBufferMemory
 from langchain_community.chat_message_histories import DynamoDBChatMessageHistory
 import json
+from assistant.admission import DEGRADE, REJECT, get_admission_controller
 from assistant.config import AgenticAssistantConfig
+from assistant.deadline_agent import DeadlineAwareAgentExecutor
+from assistant.documents import DocumentNotFoundError, DocumentResolver
+from assistant.models import get_chat_model
+from assistant.instrumentation import (
+    InstrumentationCallbackHandler,
+    mark_init_complete,
+    timed,
+    trace_request,
+)
 from assistant.prompts import CLAUDE_PROMPT
+from assistant.results import request_result_store
 from assistant.prompts import CLAUDE_AGENT_PROMPT
 from assistant.prompts import CV_PROMPT
 from assistant.utils import parse_markdown_content
+from assistant.xml_agent import create_streaming_xml_agent
 ## placeholder for lab 3, step 4.2, replace this with imports as instructed
-from langchain.agents import AgentExecutor, create_xml_agent
-from assistant.tools import LLM_AGENT_TOOLS
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain_postgres import PGVector
-from langchain_postgres.vectorstores import PGVector
-from langchain_aws import ChatBedrockConverse
+from assistant.tools import LLM_AGENT_TOOLS, rag_retriever, intent_router
+from assistant.router import AGENT_ROUTE, RoutedToolError, RouterMetrics, run_routed_request
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -50,18 +63,40 @@ claude_llm = ChatBedrock(
 #         "top_p": 0.99
 #     },
 # )
-claude_chat_llm = ChatBedrockConverse(
-    model="amazon.nova-lite-v1:0",
-    temperature=0.99,
-    client=bedrock_runtime,
-    max_tokens=None,
-    # other params...
-    )
+# deadline, hedging and throttling fallbacks are handled by the model layer.
+claude_chat_llm = get_chat_model(config)
+cv_llm = get_chat_model(config)
+
+# token buckets shared by the containers, checked before any Bedrock call.
+admission_controller = get_admission_controller(config)
+
+# routing metrics of this container, logged with every agentic request.
+router_metrics = RouterMetrics()
+
+# resolves the CV references of chatcv requests, caching the packed CV per document version.
+document_resolver = DocumentResolver(
+    sql_engine=config.sql_engine,
+    s3_client=boto3.client("s3"),
+    bucket_name=config.agent_data_bucket_name,
+    processed_documents_key=config.processed_documents_key,
+    collection_names=config.rag_collection_names,
+    max_tokens=config.cv_max_prompt_tokens,
+)
+
+
+class TimedDynamoDBChatMessageHistory(DynamoDBChatMessageHistory):
+    """Chat history recording each load from DynamoDB in the request trace."""
+
+    @property
+    def messages(self):
+        with timed("history_load"):
+            return super().messages
+
 
 def get_basic_chatbot_conversation_chain(
     user_input, session_id, clean_history, verbose=False
 ):
-    message_history = DynamoDBChatMessageHistory(
+    message_history = TimedDynamoDBChatMessageHistory(
         table_name=config.chat_message_history_table_name, session_id=session_id
     )
 
@@ -84,74 +119,173 @@ def get_basic_chatbot_conversation_chain(
     return conversation_chain
 
 def get_basic_cv_conversation_chain():
-    cv_llm  = ChatBedrockConverse(
-    model="amazon.nova-lite-v1:0",
-    temperature=0.99,
-    client=bedrock_runtime,
-    max_tokens=None,
-    # other params...
-    )
-    return CV_PROMPT | cv_llm    
+    return CV_PROMPT | cv_llm
 
 
-## placeholder for lab 3, step 4.3, replace this with the get_agentic_chatbot_conversation_chain helper.
-def get_agentic_chatbot_conversation_chain(
-    user_input, session_id, clean_history, verbose=False
-):
-    message_history = DynamoDBChatMessageHistory(
+def get_agentic_memory(session_id, clean_history):
+    message_history = TimedDynamoDBChatMessageHistory(
         table_name=config.chat_message_history_table_name, session_id=session_id
     )
     if clean_history:
         message_history.clear()
 
-    memory = ConversationBufferMemory(
+    return ConversationBufferMemory(
         memory_key="chat_history",
         # Change the human_prefix from Human to something else
         # to not conflict with Human keyword in Anthropic Claude model.
         human_prefix="Hu",
         chat_memory=message_history,
         return_messages=False,
+        # the agent also returns whether the answer is partial.
+        output_key="output",
     )
 
-    agent = create_xml_agent(
+## placeholder for lab 3, step 4.3, replace this with the get_agentic_chatbot_conversation_chain helper.
+def get_agentic_chatbot_conversation_chain(
+    user_input, session_id, clean_history, verbose=False, memory=None, deadline=None
+):
+    if memory is None:
+        memory = get_agentic_memory(session_id, clean_history)
+
+    agent = create_streaming_xml_agent(
         llm=claude_chat_llm,
         tools=LLM_AGENT_TOOLS,
         prompt=CLAUDE_AGENT_PROMPT,
         stop_sequence=["</tool_input>", "</final_answer>"]
     )
 
-    agent_chain = AgentExecutor(
+    agent_chain = DeadlineAwareAgentExecutor(
         agent=agent,
         tools=LLM_AGENT_TOOLS,
         return_intermediate_steps=False,
         verbose=verbose,
         memory=memory,
         max_iterations=6,
-        handle_parsing_errors="Check your output and make sure it conforms!"
+        handle_parsing_errors="Check your output and make sure it conforms!",
+        deadline=deadline,
+        llm=claude_chat_llm,
+        final_answer_reserve=config.agent_final_answer_reserve,
     )
     return agent_chain
 
-def get_rag_chain(user_input,k=5, verbose=False):
-    embedding_model = BedrockEmbeddings(
-        model_id=config.embedding_model_id, client=bedrock_runtime
-    )
+def get_routed_agentic_chatbot_conversation_chain(
+    user_input,
+    session_id,
+    clean_history,
+    use_router=True,
+    expected_route=None,
+    verbose=False,
+    deadline=None,
+):
+    """Answer with a single tool call when the intent router is confident, else with the agent.
 
-    vector_store = PGVector.from_existing_index(
-        embedding=embedding_model,
-        collection_name=config.collection_name,
-        connection=config.postgres_connection_string,
-    )
-    results= vector_store.similarity_search_with_score(user_input,k=k)
+    Returns a callable with the same input and output as the agent executor `invoke`.
+    `deadline` is the `time.monotonic()` value by which the agent must have answered.
+    """
+    memory = get_agentic_memory(session_id, clean_history)
+    # Seconds kept for the answer, the routed tool call must end before them.
+    final_answer_reserve = config.agent_final_answer_reserve
+
+    def invoke(inputs, config=None):
+        start_time = time.perf_counter()
+        decision = None
+        if use_router:
+            try:
+                decision = intent_router.route(inputs["input"])
+            except Exception:
+                logger.warning(f"Intent routing failed, using the agent: {traceback.format_exc()}")
+
+        path = AGENT_ROUTE
+        output = None
+        partial = False
+        if decision is not None and decision.confident:
+            chat_history = memory.load_memory_variables({})["chat_history"]
+            try:
+                output, partial = run_routed_request(
+                    decision,
+                    inputs["input"],
+                    chat_history,
+                    LLM_AGENT_TOOLS,
+                    claude_chat_llm,
+                    config=config,
+                    deadline=deadline,
+                    final_answer_reserve=final_answer_reserve,
+                )
+                path = decision.route
+            except RoutedToolError:
+                # Only the tool failed, the agent may still answer with another tool.
+                logger.warning(f"Routed request to {decision.route} failed, using the agent: {traceback.format_exc()}")
+            if output is not None:
+                memory.save_context({"input": inputs["input"]}, {"output": output})
+
+        if output is None:
+            result = get_agentic_chatbot_conversation_chain(
+                inputs["input"],
+                session_id,
+                clean_history,
+                verbose=verbose,
+                memory=memory,
+                deadline=deadline,
+            ).invoke(inputs, config=config)
+            output = result["output"]
+            partial = result["partial"]
+
+        if decision is not None:
+            metrics = router_metrics.record(
+                decision, path, time.perf_counter() - start_time, expected_route=expected_route
+            )
+            logger.info(json.dumps({"router_metrics": metrics}))
+        return {"input": inputs["input"], "output": output, "partial": partial}
+
+    return invoke
+
+def get_rag_chain(user_input,k=5, verbose=False):
+    results = rag_retriever.search_with_score(user_input, k=k)
     current_data = []
     for doc, score in results:
         data = {}
         data["score"]= score
+        data["collection_name"]=doc.metadata["collection_name"]
         data["page_content"]=doc.page_content
         data["metadata"]=doc.metadata
         current_data.append(data)
     return current_data
+
+mark_init_complete(_init_started_at)
+
 def lambda_handler(event, context):
     logger.info(event)
+    trace_id = event.get("trace_id") or getattr(context, "aws_request_id", None)
+    with trace_request(event.get("chatbot_type", "basic"), trace_id=trace_id), request_result_store():
+        decision = admission_controller.admit(
+            event.get("session_id"),
+            event.get("chatbot_type", "basic"),
+            deadline=get_deadline(context),
+        )
+        if decision.action == REJECT:
+            return {
+                "statusCode": 429,
+                "response": (
+                    "The assistant is receiving too many requests."
+                    f" Please try again in {int(decision.retry_after)} seconds."
+                ),
+                "retry_after": decision.retry_after,
+                "partial": False,
+            }
+        if decision.action == DEGRADE:
+            # e.g. the search results of the question instead of an agent answer.
+            response = handle_event({**event, "chatbot_type": decision.mode}, context)
+            return {**response, "degraded_to": decision.mode}
+        return handle_event(event, context)
+
+def get_deadline(context):
+    """Return the `time.monotonic()` value by which the response must be ready, or None."""
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining_seconds - config.lambda_response_margin
+
+def handle_event(event, context=None):
     user_input = event["user_input"]
     session_id = event["session_id"]
     chatbot_type = event.get("chatbot_type", "basic")
@@ -166,9 +300,15 @@ def lambda_handler(event, context):
             user_input, session_id, clean_history
         ).invoke
     elif chatbot_type == "agentic":
-        conversation_chain = get_agentic_chatbot_conversation_chain(
-            user_input, session_id, clean_history
-        ).invoke
+        conversation_chain = get_routed_agentic_chatbot_conversation_chain(
+            user_input,
+            session_id,
+            clean_history,
+            use_router=event.get("use_router", True),
+            # optional label of the query, counted in the routing accuracy.
+            expected_route=event.get("expected_route"),
+            deadline=get_deadline(context),
+        )
     elif chatbot_type=="rag":
         a = 1+1
         # conversation_chain = get_rag_chain(
@@ -185,28 +325,46 @@ def lambda_handler(event, context):
             ),
         }
 
+    # records the LLM and tool calls of the chains in the request trace.
+    run_config = {"callbacks": [InstrumentationCallbackHandler()]}
+    # True when the agent ran out of time or iterations and answered with what it had.
+    partial = False
+
     try:
 
         if chatbot_type == "basic":
-            response = conversation_chain({"input": user_input})
+            response = conversation_chain({"input": user_input}, config=run_config)
             response = response["response"]
             response = parse_markdown_content(response)
         elif chatbot_type == "agentic":
-            response = conversation_chain({"input": user_input})
+            response = conversation_chain({"input": user_input}, config=run_config)
+            partial = response["partial"]
             response = response["output"]
         elif chatbot_type == "rag":
             # response = conversation_chain(user_input)
             response = json.dumps(get_rag_chain(user_input,querry_k))
         elif chatbot_type == "chatcv":
             page_content = event.get("page_content", "")
+            if not page_content and (event.get("document_id") or event.get("file_name")):
+                try:
+                    page_content = document_resolver.resolve(
+                        session_id,
+                        document_id=event.get("document_id"),
+                        file_name=event.get("file_name"),
+                    )
+                except DocumentNotFoundError as e:
+                    return {"statusCode": 200, "response": f"Unable to find the CV: {e}"}
             if not page_content:
                 return {
                     "statusCode": 200,
                     "response": (
-                        "Please provide the page content for the CV."
+                        "Please provide the page content, the document_id"
+                        " or the file_name of the CV."
                     ),
                 }
-            response = conversation_chain({"input": user_input, "content": page_content})
+            response = conversation_chain(
+                {"input": user_input, "content": page_content}, config=run_config
+            )
             response = response.content
 
     except Exception:
@@ -214,6 +372,6 @@ def lambda_handler(event, context):
             "Unable to respond due to an internal issue."
             " Please try again later"
         )
-        print(traceback.format_exc())
+        logger.error(traceback.format_exc())
 
-    return {"statusCode": 200, "response": response}
\ No newline at end of file
+    return {"statusCode": 200, "response": response, "partial": partial}
\ No newline at end of file
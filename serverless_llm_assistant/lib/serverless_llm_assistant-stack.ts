@@ -165,6 +165,24 @@ export class ServerlessLlmAssistantStack extends cdk.Stack {
 			}
 		);
 
+		// Token buckets of the admission control, shared by the agent executor containers.
+		// Idle buckets expire through the ExpiresAt TTL attribute.
+		const AdmissionControlTable = new dynamodb.Table(
+			this,
+			"AdmissionControlTable",
+			{
+				partitionKey: {
+					name: "BucketKey",
+					type: dynamodb.AttributeType.STRING,
+				},
+				billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+				tableClass: dynamodb.TableClass.STANDARD,
+				timeToLiveAttribute: "ExpiresAt",
+				removalPolicy: cdk.RemovalPolicy.DESTROY,
+				encryption: dynamodb.TableEncryption.AWS_MANAGED,
+			}
+		);
+
 		// -----------------------------------------------------------------------
 		var currentNetworkMode = NetworkMode.DEFAULT;
 		// if you run the cdk stack in SageMaker editor, you need to pass --network sagemaker
@@ -223,6 +241,7 @@ export class ServerlessLlmAssistantStack extends cdk.Stack {
 					LLM_MODEL_ID_PARAMETER: ssm_llm_model_id_parameter.parameterName,
 					CHAT_MESSAGE_HISTORY_TABLE: ChatMessageHistoryTable.tableName,
 					AGENT_DB_SECRET_ID: AgentDB.secret?.secretArn as string,
+					ADMISSION_CONTROL_TABLE: AdmissionControlTable.tableName,
 				},
 			}
 		);
@@ -300,6 +319,7 @@ export class ServerlessLlmAssistantStack extends cdk.Stack {
 		ChatMessageHistoryTable.grantReadWriteData(agent_executor_lambda);
 		ChatMessageHistoryTable.grantReadWriteData(agent_api_lambda);
 		ChatMessageHistoryTable.grantReadWriteData(agent_executor_get);
+		AdmissionControlTable.grantReadWriteData(agent_executor_lambda);
 
 		// Allow the Lambda function to use Bedrock
 		agent_executor_lambda.role?.addManagedPolicy(
@@ -354,6 +374,10 @@ export class ServerlessLlmAssistantStack extends cdk.Stack {
 		// }
 		agentDataBucketParameter.grantRead(agent_executor_lambda);
 		agentDataBucketParameter.grantWrite(agent_executor_lambda);
+		// chatcv reads the processed documents to resolve document references.
+		agent_data_bucket.grantRead(agent_executor_lambda);
+		// the first container after a change of the intent routes stores their centroids.
+		agent_data_bucket.grantPut(agent_executor_lambda, "intent_router/*");
 		agentDataBucketParameter.grantRead(agent_api_lambda);
 		agent_data_bucket.grantReadWrite(agent_api_lambda);
 		agentDataBucketParameter.grantRead(agent_executor_get);